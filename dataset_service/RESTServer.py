@@ -6,13 +6,17 @@ import shutil
 from enum import Enum
 from datetime import datetime
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Callable
 import bottle
 import logging
 import json
+import hashlib
+import zlib
+import gzip
 #from kubernetes.client import exceptions
 import yaml
 import time
+import socket
 #from kubernetes import client, config
 #from kubernetes.client.rest import ApiException
 import jwt
@@ -20,10 +24,12 @@ from jwt import PyJWKClient
 import urllib
 import urllib.error
 import uuid
-from . import authorization, k8s, pid, tracer, keycloak, config, hash
+from . import authorization, k8s, pid, tracer, keycloak, config, hash, json_stream
 from .auth import AuthClient, LoginException
-from .storage import DB, DBDatasetsOperator, DBProjectsOperator, DBDatasetAccessesOperator
-from .storage import DBDatasetsEUCAIMSearcher, SearchValidationException 
+from .storage import DB, DBSession, DBDatasetsOperator, DBProjectsOperator, DBDatasetAccessesOperator
+from .storage import PageCursor, PageCursorException, StreamedRows
+from .storage import DBDatasetsEUCAIMSearcher, SearchValidationException, EUCAIMSearchResultsCache
+from .dataset_creation_executor import createDatasetCreationExecutor
 from . import dataset as dataset_file_system
 from . import utils
 from dataset_service import __version__, __appname__
@@ -63,21 +69,101 @@ def exception_catch(func):
             raise e
     return wrapper
 
+# All the DB objects created while serving a request share one connection (only taken if used)
+def db_session(func):
+    def wrapper(*args,**kwargs):
+        with DBSession():
+            return func(*args,**kwargs)
+    return wrapper
+
+def _acceptsGzip() -> bool:
+    header = bottle.request.get_header('Accept-Encoding')
+    if header is None: return False
+    for item in header.split(','):
+        params = item.split(';')
+        if params[0].strip().lower() != 'gzip': continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() != 'q': continue
+            try: 
+                return float(value) > 0
+            except ValueError: return False
+        return True
+    return False
+
+def _gzipChunks(chunks: Iterable, level: int):
+    ''' Compresses a response sent in streaming, flushing each chunk to not delay it. '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)   # gzip format
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str): chunk = chunk.encode()
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if len(data) > 0: yield data
+        yield compressor.flush()
+    finally:
+        # In case of client disconnection, the generator of chunks must be closed too (to release the DB cursor).
+        if hasattr(chunks, 'close'): chunks.close()
+
+# The JSON responses are compressed if the client accepts it (the big ones and the ones sent in streaming).
+def gzip_response(func):
+    def wrapper(*args,**kwargs):
+        body = func(*args,**kwargs)
+        if CONFIG is None or CONFIG.self.response_gzip_min_size < 0: return body
+        if not bottle.response.content_type.startswith('application/json'): return body
+        bottle.response.add_header('Vary', 'Accept-Encoding')
+        if 'Content-Encoding' in bottle.response or not _acceptsGzip(): return body
+        # Without body (e.g. 304 Not Modified, which keeps the ETag matched by the client)
+        if bottle.response.status_code in (204, 304) or body is None: return body
+        level = CONFIG.self.response_gzip_level
+        if isinstance(body, str): body = body.encode()
+        if isinstance(body, bytes):
+            if len(body) == 0 or len(body) < CONFIG.self.response_gzip_min_size: return body
+            body = gzip.compress(body, level)
+        elif not hasattr(body, '__iter__') or isinstance(body, (dict, bottle.HTTPResponse)): return body
+        else: body = _gzipChunks(body, level)
+        bottle.response.set_header('Content-Encoding', 'gzip')
+        # The representations with different encoding must have different strong ETags.
+        etag = bottle.response.get_header('ETag')
+        if etag is not None: bottle.response.set_header('ETag', _gzipETag(etag))
+        return body
+    return wrapper
+
 #app = bottle.Bottle()
 app = MyBottle()
 app.install(exception_catch)
+app.install(gzip_response)
+app.install(db_session)
 thisRESTServer = None
 CONFIG = None
 AUTH_PUBLIC_KEY = None
 AUTH_CLIENT = None
 AUTH_ADMIN_CLIENT = None
+EUCAIM_SEARCH_CACHE = None
+VALIDATED_TOKENS_CACHE = None
+DATASET_CREATION_EXECUTOR = None
 
 class RESTServer (bottle.ServerAdapter):
     def run(self, handler):
         # https://bottlepy.org/docs/stable/deployment.html#switching-the-server-backend
         # https://github.com/bottlepy/bottle/blob/release-0.12/bottle.py#L2834
         from cheroot import wsgi
-        server = wsgi.Server((self.host, self.port), handler, request_queue_size=32)
+        if CONFIG is None: raise Exception()
+        listeningSocket = self.options.get("listeningSocket")
+        if listeningSocket is None: 
+            serverClass = wsgi.Server
+        else:
+            # The socket is already bound and listening (created by the parent process and shared by all the pre-forked processes).
+            class serverClass(wsgi.Server):
+                def bind(self, family, type, proto=0):
+                    self.socket = listeningSocket
+                    return listeningSocket
+        server = serverClass((self.host, self.port), handler, 
+                             numthreads=CONFIG.self.server_threads, 
+                             request_queue_size=CONFIG.self.server_accept_backlog, 
+                             accepted_queue_size=CONFIG.self.server_accepted_queue_size, 
+                             timeout=CONFIG.self.server_keep_alive_timeout_seconds, 
+                             shutdown_timeout=CONFIG.self.server_shutdown_timeout_seconds)
+        server.keep_alive_conn_limit = CONFIG.self.server_keep_alive_connections_limit
         # old version:
         # from cherrypy import wsgiserver
         # server = wsgiserver.CherryPyWSGIServer((self.host, self.port), handler, request_queue_size=32)
@@ -92,12 +178,23 @@ class RESTServer (bottle.ServerAdapter):
             self.srv.stop()
 
 def run(host, port, config: config.Config):
-    global thisRESTServer, LOG, CONFIG, AUTH_PUBLIC_KEY, AUTH_CLIENT, AUTH_ADMIN_CLIENT
+    init(config)
+    serve(host, port)
+
+def init(config: config.Config):
+    ''' Initialization previous to serve: it loads the config, the auth public key and checks (and updates) the database. 
+        In pre-fork mode it is called in the parent process, only once. 
+    '''
+    global LOG, CONFIG, AUTH_PUBLIC_KEY, AUTH_CLIENT, AUTH_ADMIN_CLIENT, EUCAIM_SEARCH_CACHE, VALIDATED_TOKENS_CACHE, DATASET_CREATION_EXECUTOR
     CONFIG = config
+    DATASET_CREATION_EXECUTOR = createDatasetCreationExecutor(CONFIG)
+    EUCAIM_SEARCH_CACHE = EUCAIMSearchResultsCache(CONFIG.self.eucaim_search_cache_max_entries, 
+                                                   CONFIG.self.eucaim_search_cache_ttl_seconds)
     authorization.User.roles = authorization.Roles(CONFIG.auth.token_validation.roles)
     authorization.User.client_id = CONFIG.auth.token_validation.client_id
     authorization.User.PROJECT_GROUP_PREFIX = CONFIG.auth.token_validation.project_group_prefix
     authorization.User.PROJECT_ADMINS_GROUP_PREFIX = CONFIG.auth.token_validation.project_admins_group_prefix
+    VALIDATED_TOKENS_CACHE = authorization.ValidatedTokensCache(CONFIG.auth.token_validation.cache_max_entries)
     AUTH_CLIENT = AuthClient(CONFIG.auth.client.auth_url, CONFIG.auth.client.client_id, CONFIG.auth.client.client_secret)
     AUTH_ADMIN_CLIENT = keycloak.KeycloakAdminAPIClient(AUTH_CLIENT, CONFIG.auth.admin_api.url, CONFIG.auth.admin_api.client_id_to_request_user_tokens)
 
@@ -143,18 +240,30 @@ def run(host, port, config: config.Config):
         LOG.warn("tracer.url is empty: actions will not be notified to the tracer-service.")
     else: 
         tracer.check_connection(AUTH_CLIENT, CONFIG.tracer.url)
-        
-    thisRESTServer = RESTServer(host=host, port=port)
+
+def createListeningSocket(host, port) -> socket.socket:
+    ''' Creates the socket to be shared by the pre-forked processes. '''
+    if CONFIG is None: raise Exception()
+    return socket.create_server((host, int(port)), backlog=CONFIG.self.server_accept_backlog)
+
+def serve(host, port, listeningSocket: socket.socket | None = None):
+    global thisRESTServer
+    if DATASET_CREATION_EXECUTOR is None: raise Exception()
+    DATASET_CREATION_EXECUTOR.start()
+    thisRESTServer = RESTServer(host=host, port=port, listeningSocket=listeningSocket)
     LOG.info("Running the service in %s:%s..." % (host, port))
     bottle.BaseRequest.MEMFILE_MAX = 120 * 1024 * 1024   # In bytes, default 102400
                                                         # We have to increase to avoid error "413: request entity too large" 
-                                                        # when creating dataset.
+                                                        # when creating dataset with multipart/form-data
+                                                        # (the JSON body is read in streaming, without this limit).
     bottle.run(app, server=thisRESTServer, quiet=True)
 
 def stop():
     if thisRESTServer:
         LOG.info("Shutting down the service...")
         thisRESTServer.shutdown()
+    if DATASET_CREATION_EXECUTOR:
+        DATASET_CREATION_EXECUTOR.stop()
 
 
 def setErrorResponse(code, message):
@@ -189,12 +298,18 @@ def getTokenFromAuthorizationHeader(serviceAccount=False) -> str | None | dict:
         encodedToken = encodedToken[7:]
     except Exception as e:
         return setErrorResponse(401, "invalid authorization header")
+    if VALIDATED_TOKENS_CACHE is None: raise Exception()
+    token = VALIDATED_TOKENS_CACHE.get(encodedToken)
+    if token != None and (serviceAccount or all(p in token.keys() for p in ["preferred_username", "name", "email"])):
+        LOG.debug("User: %s (token already validated)" % token.get('preferred_username', token['sub']))
+        return token
     token = validate_token(encodedToken)
     ok, missingProperty = authorization.User.validateToken(token, serviceAccount)
     if ok: LOG.debug("User: " + token['preferred_username'])
     else: 
         LOG.debug(json.dumps(token))
         return setErrorResponse(401, "invalid access token: missing '%s'" % missingProperty)
+    VALIDATED_TOKENS_CACHE.put(encodedToken, token)
     return token
 
 def getTokenOfAUserFromAuthAdminClient(userId) -> str | dict:
@@ -314,6 +429,97 @@ def getDatalakeInfo(file_path):
 
 class WrongInputException(Exception): pass
 
+def _getPageCursorParam() -> PageCursor | None:
+    ''' Returns the optional query param 'cursor' (nextCursor returned along with the previous page), 
+        which can be used instead of skip to get the next page faster. '''
+    if 'cursor' not in bottle.request.query: return None
+    return PageCursor.decode(str(bottle.request.query['cursor']))
+
+def _encodePageCursor(pageCursor: PageCursor | None) -> str | None:
+    return pageCursor.encode() if pageCursor is not None else None
+
+def _buildETag(*parts) -> str:
+    ''' Strong ETag from the values which determine the response (e.g. the revision of a dataset and the user). '''
+    return '"%s"' % hashlib.sha256(json.dumps([__version__] + list(parts)).encode()).hexdigest()[:32]
+
+def _gzipETag(etag: str) -> str:
+    return etag[:-1] + '-gzip"'
+
+def _checkNotModified(etag: str) -> bool:
+    ''' Sets the ETag of the response and returns True if the client already has that version (header If-None-Match), 
+        in that case the status 304 is set and the handler must return an empty body.
+    '''
+    bottle.response.set_header('ETag', etag)
+    # The client can cache the response but must revalidate it on each use.
+    bottle.response.set_header('Cache-Control', 'private, no-cache')
+    header = bottle.request.get_header('If-None-Match')
+    if header is None: return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'): tag = tag[2:]
+        if tag == '*' or tag == etag or tag == _gzipETag(etag):
+            bottle.response.status = 304
+            if tag != '*': bottle.response.set_header('ETag', tag)
+            return True
+    return False
+
+def _bodyWithContentETag(body: str) -> str:
+    ''' For the responses without a revision to build the ETag: the hash of the body is used, 
+        so only the transfer is saved on 304. '''
+    if _checkNotModified('"%s"' % hashlib.sha256(body.encode()).hexdigest()[:32]): return ''
+    return body
+
+STREAMING_BUFFER_SIZE = 64 * 1024   # Chars of each chunk of the responses sent in streaming.
+STREAMING_FETCH_SIZE = 1000         # Rows read from DB at once for the responses sent in streaming.
+
+def _streamJSONArray(items: Iterable, getTrailingProperties: Callable[[], dict] | None = None, 
+                     bufferSize: int = STREAMING_BUFFER_SIZE):
+    ''' Generator of the body of a response with the JSON array of the items, sent while they are obtained 
+        (chunked transfer encoding), so they are never all in memory and the client receives the first ones soon.
+        If getTrailingProperties is set, the body is an object with the array in the property "list", 
+        followed by the properties returned by that function (called at the end, e.g. to add the total of items).
+        The chunks are sent when they reach bufferSize chars, or each item as soon as it is obtained if bufferSize is 0.
+        Note the status has been sent before the body, so an error in the middle can only be notified by closing 
+        the connection: the client receives an incomplete JSON.
+    '''
+    try:
+        buffer, bufferLength, count = ['{"list": [' if getTrailingProperties != None else '['], 0, 0
+        for item in items:
+            chunk = json.dumps(item)
+            if count > 0: chunk = ', ' + chunk
+            count += 1
+            buffer.append(chunk)
+            bufferLength += len(chunk)
+            if bufferLength >= bufferSize:
+                yield ''.join(buffer)
+                buffer, bufferLength = [], 0
+        if getTrailingProperties is None: buffer.append(']')
+        else:
+            properties = json.dumps(getTrailingProperties())
+            buffer.append(']}' if properties == '{}' else '], ' + properties[1:])
+        yield ''.join(buffer)
+    except Exception as e:
+        LOG.exception(e)
+        raise e
+
+def _streamListFromDB(getRows: Callable[[DB], StreamedRows], adjustItem: Callable[[dict], dict], skip: int):
+    ''' Generator of the body of a response with the entire list of items read from DB in streaming (see _streamJSONArray), 
+        in the same format as a page of the list (with total, returned, skipped...). 
+        The body is produced after the return of the request handler, so it uses its own DB connection.
+    '''
+    if CONFIG is None: raise Exception()
+    with DB(CONFIG.db) as db:
+        try:
+            rows = getRows(db)
+        except PageCursorException as e:
+            raise bottle.HTTPError(400, str(e))   # still in time to return the error (nothing sent yet)
+        try:
+            yield from _streamJSONArray((adjustItem(item) for item in rows), 
+                                        lambda: dict(total = rows.total, returned = rows.returned, skipped = skip, 
+                                                     limit = 0, nextCursor = None))
+        finally:
+            rows.close()
+
 def _checkPropertyAsString(propName:str, value: str, possible_values: list[str] | None = None, min_length: int = 0, max_length: int = 0, 
                            only_alphanum_or_dash: bool = False):
     if not isinstance(value, str): 
@@ -432,13 +638,102 @@ def _buildDatasetSubjectsListFromCSV(csvfile):
             })
     return subjects
 
+class _DatasetInputChecker:
+    ''' Checks the studies and subjects of a new dataset while writing them to the files for the creation job,
+        one by one as they are read, keeping in memory only what is needed for the checks (not the entire lists).
+    '''
+    def __init__(self, datasetDirPath: str):
+        self.datasetDirPath = datasetDirPath
+        self.studiesCount = -1     # -1 until written
+        self.subjectsCount = -1    # -1 until written
+        self.subjects = set()
+        self.subjectsOfStudies = dict()   # subjectName -> studyId of the first study of the subject
+        self.studyPaths = set()
+        self.firstStudyWithPath = None    # studyId of the first study with 'path' instead of 'pathInDatalake'
+
+    def writeStudies(self, studies: Iterable):
+        if CONFIG is None: raise Exception()
+        if self.studiesCount >= 0: raise WrongInputException("'studies' property is duplicated.")
+        LOG.debug('Writing studies temporal list: ' + CONFIG.self.studies_tmp_file_name)
+        self.studiesCount = 0
+        with open(os.path.join(self.datasetDirPath, CONFIG.self.studies_tmp_file_name) , 'w') as outputStream:
+            outputStream.write('[')
+            for study in studies:
+                self._checkStudy(study)
+                if self.studiesCount > 0: outputStream.write(', ')
+                json.dump(study, outputStream)
+                self.studiesCount += 1
+            outputStream.write(']')
+        LOG.debug("%s studies received." % self.studiesCount)
+
+    def writeSubjects(self, subjects: Iterable):
+        if CONFIG is None: raise Exception()
+        if self.subjectsCount >= 0: raise WrongInputException("'subjects' property is duplicated.")
+        LOG.debug('Writing E-FORMs file: ' + CONFIG.self.eforms_file_name)
+        self.subjectsCount = 0
+        with open(os.path.join(self.datasetDirPath, CONFIG.self.eforms_file_name) , 'w') as outputStream:
+            outputStream.write('[')
+            for subject in subjects:
+                if not isinstance(subject, dict) or not isinstance(subject.get("subjectName"), str):
+                    raise WrongInputException("All the items in 'subjects' array must be objects with the property 'subjectName'.")
+                if subject["subjectName"] in self.subjects:
+                    raise WrongInputException("The subjectName '%s' is duplicated in 'subjects' array of the dataset." % subject["subjectName"])
+                self.subjects.add(subject["subjectName"])
+                if self.subjectsCount > 0: outputStream.write(', ')
+                json.dump(subject, outputStream)
+                self.subjectsCount += 1
+            outputStream.write(']')
+
+    def _checkStudy(self, study):
+        if not isinstance(study, dict) or not "studyId" in study or not isinstance(study.get("subjectName"), str):
+            raise WrongInputException("All the items in 'studies' array must be objects with the properties 'studyId' and 'subjectName'.")
+        if not study["subjectName"] in self.subjectsOfStudies:
+            self.subjectsOfStudies[study["subjectName"]] = study["studyId"]
+        studyDirName = ''
+        if 'pathInDatalake' in study:
+            study['pathInDatalake'] = str(study['pathInDatalake']).removesuffix('/')
+            studyDirName = os.path.basename(study['pathInDatalake'])
+            study_path = os.path.join(study["subjectName"], studyDirName)
+        elif 'path' in study:
+            if self.firstStudyWithPath is None: self.firstStudyWithPath = study["studyId"]
+            study_path = str(study['path']).removesuffix('/')
+        else:
+            raise WrongInputException("Missing field 'pathInDatalake' or 'path' in the study with id '%s'." % study["studyId"])
+
+        # example of study_path: 17B76FEW/TCPEDITRICOABDOMINOPLVICO20150129
+        if study_path in self.studyPaths:
+            raise WrongInputException("The study with id '%s' seems duplicated, " % study["studyId"]
+                                        +"it has the same directory name '%s' as another study of the same subject '%s', " % (studyDirName, study["subjectName"])
+                                        +"this will cause a conflict when creating the dataset's directories structure." )
+        self.studyPaths.add(study_path)
+
+    def checkStudiesAgainstSubjects(self, previousId: str | None):
+        ''' The checks which require all the studies and subjects, to do at the end. '''
+        LOG.debug("Checking for studies with missing subjects...")
+        for subjectName, studyId in self.subjectsOfStudies.items():
+            if not subjectName in self.subjects:
+                raise WrongInputException("The study with id '%s' has a 'subjectName' which is not in the " % studyId
+                                            +"'subjects' array of the dataset." )
+        if self.firstStudyWithPath != None and previousId is None:
+            raise WrongInputException("One of the studies contains the 'path' field instead of 'pathInDatalake', but the previous dataset is not provided. "
+                                     +"Please specify the previous dataset, or use 'pathInDatake' converting path to be relative to datalake root directory." )
+
+def _readJSONArray(reader: json_stream.JSONStreamReader, propName: str):
+    if reader.peek() != '[': raise WrongInputException("'%s' property is required and must be an array." % propName)
+    return reader.iterArray()
+
+def _getRequestBodyStream():
+    ''' Returns the body of the request as a stream and the max size to read from it.
+        The input of the server is used directly (when the length is known) to avoid the buffering by bottle
+        (which keeps in memory the bodies up to MEMFILE_MAX).
+    '''
+    if bottle.request.chunked or bottle.request.content_length < 0 or 'bottle.request.body' in bottle.request.environ:
+        return bottle.request.body, -1
+    return bottle.request.environ['wsgi.input'], bottle.request.content_length
+
 @app.route('/api/datasets', method='POST')
 def postDataset():
-    if CONFIG is None \
-       or not isinstance(bottle.request.query, bottle.FormsDict) \
-       or not isinstance(bottle.request.forms, bottle.FormsDict) \
-       or not isinstance(bottle.request.files, bottle.FormsDict) \
-       or not isinstance(bottle.request.body, io.IOBase): 
+    if CONFIG is None or not isinstance(bottle.request.query, bottle.FormsDict):
         raise Exception()
     LOG.debug("Received %s %s" % (bottle.request.method, bottle.request.path))
     ret = getTokenFromAuthorizationHeader()
@@ -453,10 +748,21 @@ def postDataset():
 
     datasetDirName = ''
     datasetId = str(uuid.uuid4())
-    read_data = None
     try:
         content_type = _check_header_content_type(['multipart/form-data'] if isExternal else ['application/json', 'multipart/form-data'])
+
+        # The studies and subjects are written to the dataset directory as they are read (and checked),
+        # so the directory is created first.
+        LOG.debug("UUID generated: " + datasetId)
+        LOG.debug('Creating dataset directory...')
+        datasetDirName = datasetId
+        dataset_file_system.create_dataset_dir(CONFIG.self.datasets_mount_path, datasetDirName)
+        datasetDirPath = os.path.join(CONFIG.self.datasets_mount_path, datasetDirName)
+        inputChecker = _DatasetInputChecker(datasetDirPath)
+
         if content_type == 'multipart/form-data':
+            if not isinstance(bottle.request.forms, bottle.FormsDict) or not isinstance(bottle.request.files, bottle.FormsDict): 
+                raise Exception()
             LOG.debug("Reading request body as multipart/form-data...")
             if not "name" in bottle.request.forms: raise WrongInputException("Missing 'name' field in the request form.")
             if not "description" in bottle.request.forms: raise WrongInputException("Missing 'description' field in the request form.")
@@ -474,10 +780,15 @@ def postDataset():
             if 'collectionMethod' in bottle.request.forms: dataset['collectionMethod'] = bottle.request.forms.getall('collectionMethod')
         else:
             LOG.debug("Reading request body as JSON...")
-            read_data = bottle.request.body.read().decode('UTF-8')
-            #LOG.debug("BODY: " + read_data)
-            dataset = json.loads( read_data )
-            if not isinstance(dataset, dict): raise WrongInputException("The body must be a json object.")
+            # Streaming: the studies and subjects are not loaded entirely in memory.
+            reader = json_stream.JSONStreamReader(*_getRequestBodyStream())
+            if reader.peek() != '{': raise WrongInputException("The body must be a json object.")
+            dataset = dict()
+            for key in reader.iterObject():
+                if key == "studies": inputChecker.writeStudies(_readJSONArray(reader, key))
+                elif key == "subjects": inputChecker.writeSubjects(_readJSONArray(reader, key))
+                else: dataset[key] = reader.readValue()
+            reader.end()
 
         if not "name" in dataset or dataset["name"] is None: raise WrongInputException("'name' property is required.")
         if not "description" in dataset or dataset["description"] is None: raise WrongInputException("'description' property is required.")
@@ -508,10 +819,12 @@ def postDataset():
                 if os.path.exists(indexFilePath):
                     LOG.debug('index file found, loading: ' + indexFilePath)
                     with open(indexFilePath , 'rb') as inputStream:
-                        dataset["studies"] = json.load(inputStream)
+                        reader = json_stream.JSONStreamReader(inputStream)
+                        inputChecker.writeStudies(_readJSONArray(reader, "studies"))
+                        reader.end()
                 else:
                     LOG.debug("Loading studies from directories structure in: " + externalDatasetPath)
-                    dataset["studies"] = _buildDatasetStudiesListFromDirectoryStructure(externalDatasetPath)
+                    inputChecker.writeStudies(_buildDatasetStudiesListFromDirectoryStructure(externalDatasetPath))
             else:
                 if "index" in bottle.request.files:
                     indexFile = bottle.request.files["index"]
@@ -519,17 +832,18 @@ def postDataset():
                     if ext != '.json':
                         raise WrongInputException('Wrong extension for the index file, only JSON is supported.')
                     try:
-                        dataset["studies"] = json.load(indexFile.file)
+                        reader = json_stream.JSONStreamReader(indexFile.file)
+                        inputChecker.writeStudies(_readJSONArray(reader, "studies"))
+                        reader.end()
                     except json.decoder.JSONDecodeError as e:
                         raise WrongInputException("Error decoding the index file as JSON: " + str(e))
                 else:
                     raise WrongInputException("Missing 'index' field as file in the request form.")
         
-        if not 'studies' in dataset.keys() or not isinstance(dataset["studies"], list): 
+        if inputChecker.studiesCount < 0: 
             raise WrongInputException("'studies' property is required and must be an array.")
-        if not isExternal and len(dataset["studies"]) == 0:
+        if not isExternal and inputChecker.studiesCount == 0:
             raise WrongInputException("'studies' property is an empty array.")
-        LOG.debug("%s studies received." % len(dataset["studies"]))
 
         # Get subjects list when content is multipart/form-data
         if content_type == 'multipart/form-data':
@@ -537,10 +851,12 @@ def postDataset():
                 clinicalDataFile = bottle.request.files["clinicalData"]
                 name, ext = os.path.splitext(clinicalDataFile.filename)
                 if ext == '.csv':
-                    dataset["subjects"] = _buildDatasetSubjectsListFromCSV(clinicalDataFile.file)
+                    inputChecker.writeSubjects(_buildDatasetSubjectsListFromCSV(clinicalDataFile.file))
                 elif ext == '.json':
                     try:
-                        dataset["subjects"] = json.load(clinicalDataFile.file)
+                        reader = json_stream.JSONStreamReader(clinicalDataFile.file)
+                        inputChecker.writeSubjects(_readJSONArray(reader, "subjects"))
+                        reader.end()
                     except json.decoder.JSONDecodeError as e:
                         raise WrongInputException("Error decoding the clinical data file as JSON: " + str(e))
                 else:
@@ -550,13 +866,14 @@ def postDataset():
                 if os.path.exists(eformsFilePath):
                     LOG.debug('E-FORMs file found, loading: ' + eformsFilePath)
                     with open(eformsFilePath , 'rb') as inputStream:
-                        dataset["subjects"] = json.load(inputStream)
+                        reader = json_stream.JSONStreamReader(inputStream)
+                        inputChecker.writeSubjects(_readJSONArray(reader, "subjects"))
+                        reader.end()
             
-            if not "subjects" in dataset: # if there are not subjects yet, we create the list with empty content
-                subjects = set([s["subjectName"] for s in dataset["studies"]])
-                dataset["subjects"] = [{'subjectName': s,'eForm': {} } for s in subjects]
+            if inputChecker.subjectsCount < 0: # if there are not subjects yet, we create the list with empty content
+                inputChecker.writeSubjects({'subjectName': s,'eForm': {} } for s in inputChecker.subjectsOfStudies.keys())
 
-        if not 'subjects' in dataset.keys() or not isinstance(dataset["subjects"], list): 
+        if inputChecker.subjectsCount < 0: 
             raise WrongInputException("'subjects' property is required and must be an array.")
         
         if not 'version' in dataset.keys(): dataset["version"] = '??'
@@ -569,39 +886,8 @@ def postDataset():
             _checkPropertyAsArrayOfStrings('collectionMethod', dataset["collectionMethod"], ITEM_POSSIBLE_VALUES_FOR_COLLECTION_METHOD)
         else: dataset["collectionMethod"] = []
 
-        # Integrity checks
-        subjects = set()
-        study_paths = set()
-        LOG.debug("Checking for duplicated subjects...")
-        for subject in dataset["subjects"]:
-            if subject["subjectName"] in subjects:
-                raise WrongInputException("The subjectName '%s' is duplicated in 'subjects' array of the dataset." % subject["subjectName"])
-            else:
-                subjects.add(subject["subjectName"])
-        LOG.debug("Checking for studies with missing subjects or conflicting paths...")
-        for study in dataset["studies"]:
-            if not study["subjectName"] in subjects:
-                raise WrongInputException("The study with id '%s' has a 'subjectName' which is not in the " % study["studyId"]
-                                            +"'subjects' array of the dataset." )
-            if 'pathInDatalake' in study:
-                study['pathInDatalake'] = str(study['pathInDatalake']).removesuffix('/')
-                studyDirName = os.path.basename(study['pathInDatalake'])
-                study_path = os.path.join(study["subjectName"], studyDirName)
-            elif 'path' in study:
-                if not "previousId" in bottle.request.forms:
-                    raise WrongInputException("One of the studies contains the 'path' field instead of 'pathInDatalake', but the previous dataset is not provided. "
-                                             +"Please specify the previous dataset, or use 'pathInDatake' converting path to be relative to datalake root directory." )
-                study_path = str(study['path']).removesuffix('/')
-            else:
-                raise WrongInputException("Missing field 'pathInDatalake' or 'path' in the study with id '%s'." % study["studyId"])
-
-            # example of study_path: 17B76FEW/TCPEDITRICOABDOMINOPLVICO20150129
-            if study_path in study_paths:
-                raise WrongInputException("The study with id '%s' seems duplicated, " % study["studyId"]
-                                            +"it has the same directory name '%s' as another study of the same subject '%s', " % (studyDirName, study["subjectName"])
-                                            +"this will cause a conflict when creating the dataset's directories structure." )
-            study_paths.add(study_path)
-        
+        # Integrity checks (the rest have been done while reading studies and subjects)
+        inputChecker.checkStudiesAgainstSubjects(dataset.get("previousId"))
 
         with DB(CONFIG.db) as db:
             dbdatasets = DBDatasetsOperator(db)
@@ -628,12 +914,12 @@ def postDataset():
                 if previousDataset is None:
                     raise WrongInputException("The dataset selected as previous (%s) does not exist" % dataset["previousId"])
                 if not user.canModifyDataset(previousDataset):
+                    dataset_file_system.remove_dataset(CONFIG.self.datasets_mount_path, datasetDirName)
                     return setErrorResponse(401, "The dataset selected as previous (%s) " % previousDataset["id"]
                                                + "must be editable by the user (%s)" % user.username)
             else:
                 dataset["previousId"] = None
 
-            LOG.debug("UUID generated: " + datasetId)
             dataset["id"] = datasetId
             dataset["creationDate"] = datetime.now()
             #if not "public" in dataset.keys(): 
@@ -651,32 +937,20 @@ def postDataset():
                 dbdatasets.setDatasetContactInfo(datasetId, projectConfig["defaultContactInfo"])
                 dbdatasets.setDatasetLicense(datasetId, projectConfig["defaultLicense"]["title"], projectConfig["defaultLicense"]["url"])
 
-            LOG.debug('Creating dataset directory...')
-            datasetDirName = datasetId
-            dataset_file_system.create_dataset_dir(CONFIG.self.datasets_mount_path, datasetDirName)
-            datasetDirPath = os.path.join(CONFIG.self.datasets_mount_path, datasetDirName)
-
-            LOG.debug('Writing E-FORMs file: ' + CONFIG.self.eforms_file_name)
-            with open(os.path.join(datasetDirPath, CONFIG.self.eforms_file_name) , 'w') as outputStream:
-                json.dump(dataset["subjects"], outputStream)
-
+            # The E-FORMs file and the studies temporal list have been written while reading the input.
             # The index file will be written later when the final list of studies is obtained.
 
-            LOG.debug('Writing studies temporal list: ' + CONFIG.self.studies_tmp_file_name)
-            with open(os.path.join(datasetDirPath, CONFIG.self.studies_tmp_file_name) , 'w') as outputStream:
-                json.dump(dataset["studies"], outputStream)
-
             LOG.debug('Creating status in DB...')
             dbdatasets.createDatasetCreationStatus(datasetId, "pending", "Launching dataset creation job...")
             LOG.debug('Launching dataset creation job...')
-            k8sClient = k8s.K8sClient()
+            if DATASET_CREATION_EXECUTOR is None: raise Exception()
             try:
-                k8sClient.add_dataset_creation_job(datasetId)
-            except k8s.K8sException as e:
+                DATASET_CREATION_EXECUTOR.launch(db, datasetId)
+            except (k8s.K8sException, OSError) as e:
                 dbdatasets.setDatasetCreationStatus(datasetId, "error", "Unexpected error launching dataset creation job.")
                 raise e
 
-        LOG.debug('Dataset successfully created in DB and creation job launched in K8s.')
+        LOG.debug('Dataset successfully created in DB and creation job launched.')
         bottle.response.status = 201
         bottle.response.content_type = "application/json"
         return json.dumps(dict(apiUrl = "/api/datasets/" + datasetId,
@@ -686,15 +960,14 @@ def postDataset():
         if datasetDirName != '': dataset_file_system.remove_dataset(CONFIG.self.datasets_mount_path, datasetDirName)
         return setErrorResponse(400, str(e))
     except json.decoder.JSONDecodeError as e:
+        if datasetDirName != '': dataset_file_system.remove_dataset(CONFIG.self.datasets_mount_path, datasetDirName)
         return setErrorResponse(400, "Error decoding the body as JSON: " + str(e))
-    except k8s.K8sException as e:
+    except (k8s.K8sException, OSError) as e:
         LOG.exception(e)
         if datasetDirName != '': dataset_file_system.remove_dataset(CONFIG.self.datasets_mount_path, datasetDirName)
         return setErrorResponse(500, "Error launching dataset creation job: " + str(e))
     except Exception as e:
         LOG.exception(e)
-        if read_data != None:
-            LOG.error("May be the body of the request is wrong: %s" % read_data)
         if datasetDirName != '': dataset_file_system.remove_dataset(CONFIG.self.datasets_mount_path, datasetDirName)
         return setErrorResponse(500, "Unexpected error, may be the input is wrong")
         #return setErrorResponse(500, "Unexpected error, may be the input is wrong\n%s" % str(e))
@@ -718,7 +991,7 @@ def readjustFilePermissions(id):
         dbdatasets = DBDatasetsOperator(db)
         if not dbdatasets.existsDataset(datasetId):
             return setErrorResponse(404, "not found")
-        datasetStudies, total = dbdatasets.getStudiesFromDataset(datasetId)
+        datasetStudies, total, _ = dbdatasets.getStudiesFromDataset(datasetId)
         dataset_file_system.adjust_file_permissions_in_datalake(CONFIG.self.datalake_mount_path, datasetStudies)
 
         # # After adjust the file permissions with chmod 700, the ACL in studies dirs is still there but it has not effect, so we have to readjust them also
@@ -753,11 +1026,12 @@ def _recollectMetadataForDataset(datasetId):
         _addAdditionalInfoToDataset(dataset, dbdatasets)
         if "creating" in dataset and dataset["creating"]:
             return dict(success=False, msg="Not recollected: it is still being created.")
-        datasetStudies, total = dbdatasets.getStudiesFromDataset(datasetId)
+        datasetStudies, total, _ = dbdatasets.getStudiesFromDataset(datasetId)
         dataset["studies"] = datasetStudies
         eformsFilePath = os.path.join(CONFIG.self.datasets_mount_path, datasetId, CONFIG.self.eforms_file_name)
         try:
-            dataset_file_system.collectMetadata(dataset, CONFIG.self.datalake_mount_path, eformsFilePath, CONFIG.self.skip_subproject_id_security_check)
+            dataset_file_system.collectMetadata(dataset, CONFIG.self.datalake_mount_path, eformsFilePath, CONFIG.self.skip_subproject_id_security_check,
+                                                CONFIG.self.metadata_collection_workers)
         except Exception as e:
             LOG.exception(e)
             return dict(success=False, msg="Not recollected: exception catched (corrupt dataset?).")
@@ -806,20 +1080,21 @@ def recollectMetadataForAllDatasets():
     with DB(CONFIG.db) as db:
         searchFilter = authorization.Search_filter()
         searchFilter.adjustByUser(user)
-        datasets, total =  DBDatasetsOperator(db).getDatasets(0, 0, '', searchFilter, '', '')
+        datasets, total, _ = DBDatasetsOperator(db).getDatasets(0, 0, '', searchFilter, '', '')
     LOG.debug("Total datasets to process: %d" % total)
-    results = []
-    i = 0
-    for ds in datasets:
-        i += 1
-        LOG.debug('Collecting metadata for dataset %s [%d/%d]' % (ds['id'], i, total))
-        result = _recollectMetadataForDataset(ds['id'])
-        results.append(dict(id=ds['id'], result=result))
-        LOG.debug('Result: %s' % json.dumps(result))
-    LOG.debug('End of datasets metadata recollection.')
+    def recollect():
+        i = 0
+        for ds in datasets:
+            i += 1
+            LOG.debug('Collecting metadata for dataset %s [%d/%d]' % (ds['id'], i, total))
+            result = _recollectMetadataForDataset(ds['id'])
+            LOG.debug('Result: %s' % json.dumps(result))
+            yield dict(id=ds['id'], result=result)
+        LOG.debug('End of datasets metadata recollection.')
     bottle.response.status = 200
     bottle.response.content_type = "application/json"
-    return json.dumps(results)
+    # Each result is sent as soon as it is obtained (it can take long for all the datasets).
+    return _streamJSONArray(recollect(), bufferSize=0)
 
 @app.route('/api/datasets/<id>/restartCreation', method='POST')
 def relaunchDatasetCreationJob(id):
@@ -842,21 +1117,18 @@ def relaunchDatasetCreationJob(id):
         _addAdditionalInfoToDataset(dataset, dbdatasets)
         if not user.canRestartCreationOfDataset(dataset):
             return setErrorResponse(401, "unauthorized user")
-        k8sClient = k8s.K8sClient()
-        job = k8sClient.exist_dataset_creation_job(datasetId)
-        if job:
-            if k8sClient.is_running_job(job):
-                return setErrorResponse(400, "there is a creation job running for this dataset, please stop or delete it before relaunch")
-            else: k8sClient.delete_dataset_creation_job(datasetId)
+        if DATASET_CREATION_EXECUTOR is None: raise Exception()
+        if DATASET_CREATION_EXECUTOR.isRunning(db, datasetId):
+            return setErrorResponse(400, "there is a creation job running for this dataset, please stop or delete it before relaunch")
         LOG.debug('Updating status in DB...')
         dbdatasets.setDatasetCreationStatus(datasetId, "pending", "Relaunching dataset creation job...")
-        LOG.debug('Relaunching dataset creation job in k8s...')
+        LOG.debug('Relaunching dataset creation job...')
         try:
-            k8sClient.add_dataset_creation_job(datasetId)
-        except k8s.K8sException as e:
+            DATASET_CREATION_EXECUTOR.relaunch(db, datasetId)
+        except (k8s.K8sException, OSError) as e:
             dbdatasets.setDatasetCreationStatus(datasetId, "error", "Unexpected error launching dataset creation job.")
             raise e
-    LOG.debug('Dataset creation job successfully launched in K8s.')
+    LOG.debug('Dataset creation job successfully launched.')
     bottle.response.status = 204
     
 @app.route('/api/datasets/<id>/creationStatus', method='GET')
@@ -913,11 +1185,13 @@ def _checkDatasetIntegrity(datasetId):
             else: ok, integrityStr = True, "OK" 
             return dict(success=ok,  msg="Integrity %s (checked on %s)" % (integrityStr, lastCheck))
         
-        studies, total = dbdatasets.getStudiesFromDataset(datasetId)
+        studies, total, _ = dbdatasets.getStudiesFromDataset(datasetId)
         for study in studies:
             studiesHashes[study["studyId"]] = study["hash"]
     
-    hashesOperator = hash.datasetHashesOperator(CONFIG.db, CONFIG.self.series_hash_cache_life_days)
+    hashesOperator = hash.datasetHashesOperator(CONFIG.db, CONFIG.self.series_hash_cache_life_days,
+                                                CONFIG.self.series_hash_workers, CONFIG.self.series_hash_workers_mode,
+                                                CONFIG.self.hash_read_buffer_size, CONFIG.self.series_hash_manifest)
     wrongHash = tracer.checkDatasetIntegrity(AUTH_CLIENT, CONFIG.tracer.url, datasetId, datasetDirPath,
                                                 CONFIG.self.index_file_name, CONFIG.self.eforms_file_name,
                                                 studiesHashes, hashesOperator)
@@ -956,16 +1230,14 @@ def checkAllDatasetsIntegrity():
     with DB(CONFIG.db) as db:
         searchFilter = authorization.Search_filter()
         searchFilter.adjustByUser(user)
-        datasets, total =  DBDatasetsOperator(db).getDatasets(0, 0, '', searchFilter, '', '')
+        datasets, total, _ = DBDatasetsOperator(db).getDatasets(0, 0, '', searchFilter, '', '')
     LOG.debug("Total datasets to check: %d" % total)
-    results = []
-    for ds in datasets:
-        result = _checkDatasetIntegrity(ds['id'])
-        results.append(dict(id=ds['id'], result=result))
+    results = (dict(id=ds['id'], result=_checkDatasetIntegrity(ds['id'])) for ds in datasets)
 
     bottle.response.status = 200
     bottle.response.content_type = "application/json"
-    return json.dumps(results)
+    # Each result is sent as soon as it is obtained (it can take long for all the datasets).
+    return _streamJSONArray(results, bufferSize=0)
 
 @app.route('/api/datasets/<id>', method='GET')
 def getDataset(id):
@@ -978,12 +1250,17 @@ def getDataset(id):
     datasetId = id
     with DB(CONFIG.db) as db:
         dbdatasets = DBDatasetsOperator(db)
+        # The revision is read before the dataset, so in case of concurrent change the content is newer than the ETag (never older).
+        revision = dbdatasets.getDatasetRevision(datasetId)
         dataset = dbdatasets.getDataset(datasetId)
-        if dataset is None: return setErrorResponse(404, "not found")
+        if dataset is None or revision is None: return setErrorResponse(404, "not found")
+        if not user.canViewDatasetDetails(dataset):
+            return setErrorResponse(401, "unauthorized user")
+        if _checkNotModified(_buildETag("dataset", datasetId, revision, user.getAuthorizationFingerprint(), 
+                                        CONFIG.self.external_datasets_project_code)): 
+            return ''
         _addAdditionalInfoToDataset(dataset, dbdatasets)
         datasetACL = dbdatasets.getDatasetACL(id)
-    if not user.canViewDatasetDetails(dataset):
-        return setErrorResponse(401, "unauthorized user")
     dataset["editablePropertiesByTheUser"] = user.getEditablePropertiesByTheUser(dataset)
     dataset["allowedActionsForTheUser"] = user.getAllowedActionsForTheUser(dataset, datasetACL)
     if not user.canViewDatasetExtraDetails(dataset["project"]):
@@ -992,6 +1269,15 @@ def getDataset(id):
     bottle.response.content_type = "application/json"
     return json.dumps(dataset)
 
+def _adjustStudyForUser(study: dict, user: authorization.User) -> dict:
+    # pathInDatalake is an internal info not interesting for the normal user nor unregistered user
+    del study['pathInDatalake']
+    del study['hash']
+    # QuibimPrecision requires to set the username in the url
+    username = "unregistered" if user.isUnregistered() else user.username
+    study['url'] = str(study['url']).replace("<USER>", username, 1)
+    return study
+
 @app.route('/api/datasets/<id>/studies', method='GET')
 def getDatasetStudies(id):
     if CONFIG is None or not isinstance(bottle.request.query, bottle.FormsDict): raise Exception()
@@ -1005,28 +1291,44 @@ def getDatasetStudies(id):
     limit = int(bottle.request.query['limit']) if 'limit' in bottle.request.query else 30
     if skip < 0: skip = 0
     if limit < 0: limit = 0
+    try:
+        pageCursor = _getPageCursorParam()
+    except PageCursorException as e:
+        return setErrorResponse(400, str(e))
+    if pageCursor is not None: skip = pageCursor.position
 
     with DB(CONFIG.db) as db:
         dbdatasets = DBDatasetsOperator(db)
+        revision = dbdatasets.getDatasetRevision(datasetId)
         dataset = dbdatasets.getDataset(datasetId)
-        if dataset is None: return setErrorResponse(404, "not found")
+        if dataset is None or revision is None: return setErrorResponse(404, "not found")
         _addAdditionalInfoToDataset(dataset, dbdatasets)
         if not user.canViewDatasetDetails(dataset):
             return setErrorResponse(401, "unauthorized user")
-        studies, total = dbdatasets.getStudiesFromDataset(datasetId, limit, skip)
+        # Note the total may be estimated (list_total_estimation_threshold) and so change without a new revision, 
+        # but it is approximate anyway.
+        if _checkNotModified(_buildETag("studies", datasetId, revision, user.getAuthorizationFingerprint(), 
+                                        bottle.request.query_string)): 
+            return ''
+        if limit == 0:
+            # All the studies: the list can be very long, so it is sent in streaming.
+            bottle.response.content_type = "application/json"
+            return _streamListFromDB(lambda db: DBDatasetsOperator(db).streamStudiesFromDataset(datasetId, skip, pageCursor, 
+                                                                                                STREAMING_FETCH_SIZE),
+                                     lambda study: _adjustStudyForUser(study, user), skip)
+        try:
+            studies, total, nextCursor = dbdatasets.getStudiesFromDataset(datasetId, limit, skip, 
+                                                                          CONFIG.self.list_total_estimation_threshold, pageCursor)
+        except PageCursorException as e:
+            return setErrorResponse(400, str(e))
     
-    username = "unregistered" if user.isUnregistered() else user.username
-    for study in studies: 
-        # pathInDatalake is an internal info not interesting for the normal user nor unregistered user
-        del study['pathInDatalake']
-        del study['hash']
-        # QuibimPrecision requires to set the username in the url
-        study['url'] = str(study['url']).replace("<USER>", username, 1)
+    for study in studies: _adjustStudyForUser(study, user)
     bottle.response.content_type = "application/json"
     return json.dumps({ "total": total,
                         "returned": len(studies),
                         "skipped": skip,
                         "limit": limit,
+                        "nextCursor": _encodePageCursor(nextCursor),
                         "list": studies })
 
 def createZenodoDeposition(db: DB, dataset):
@@ -1034,7 +1336,7 @@ def createZenodoDeposition(db: DB, dataset):
     if dataset["pids"]["urls"]["zenodoDoi"] is None: 
         datasetId = dataset["id"]
         dbdatasets = DBDatasetsOperator(db)
-        studies, total = dbdatasets.getStudiesFromDataset(datasetId)
+        studies, total, _ = dbdatasets.getStudiesFromDataset(datasetId)
         projectConfig = DBProjectsOperator(db).getProjectConfig(dataset["project"])
         if projectConfig is None: raise Exception()
         author = projectConfig["zenodoAuthor"] if projectConfig["zenodoAuthor"] != '' else dataset["authorName"]
@@ -1348,11 +1650,16 @@ def getDatasets():
         sortBy =        str(bottle.request.query['sortBy']).strip()        if 'sortBy' in bottle.request.query else ""
         sortDirection = str(bottle.request.query['sortDirection']).strip() if 'sortDirection' in bottle.request.query else ""
         onlyLastVersions = ('onlyLastVersions' in bottle.request.query and bool(parse_flag_value(bottle.request.query['onlyLastVersions'])))
-    except WrongInputException as e:
+        pageCursor = _getPageCursorParam()
+        if pageCursor is not None: skip = pageCursor.position
+
+        with DB(CONFIG.db) as db:
+            datasets, total, nextCursor = DBDatasetsOperator(db).getDatasets(skip, limit, searchString, searchFilter, sortBy, sortDirection, 
+                                                                             searchSubject, onlyLastVersions, 
+                                                                             CONFIG.self.list_total_estimation_threshold, pageCursor)
+    except (WrongInputException, PageCursorException) as e:
         return setErrorResponse(400, str(e))
     
-    with DB(CONFIG.db) as db:
-        datasets, total = DBDatasetsOperator(db).getDatasets(skip, limit, searchString, searchFilter, sortBy, sortDirection, searchSubject, onlyLastVersions)
     for dataset in datasets:
         if not user.canViewDatasetExtraDetails(dataset["project"]): 
             del dataset["authorName"]
@@ -1361,6 +1668,7 @@ def getDatasets():
                         "returned": len(datasets),
                         "skipped": skip,
                         "limit": limit,
+                        "nextCursor": _encodePageCursor(nextCursor),
                         "list": datasets,
                         "allowedActionsForTheUser": user.getAllowedActionsOnDatasetsForTheUser()})
     
@@ -1384,9 +1692,17 @@ def eucaimSearchDatasets():
         if not 'ast' in search_rq: raise WrongInputException("Missing property 'ast' in the request object.")
         if not isinstance(search_rq['ast'], dict): raise WrongInputException("The value of property 'ast' must be a json object.")
         #parseAST()
+        if EUCAIM_SEARCH_CACHE is None: raise Exception()
+        # the key is obtained before the search because it modifies the ast
+        cacheKey = EUCAIMSearchResultsCache.getKey(search_rq['ast'], CONFIG.self.eucaim_search_filter_by_tag)
         with DB(CONFIG.db) as db:
-            result = DBDatasetsEUCAIMSearcher(db).eucaimSearchDatasets(
-                search_rq['ast'], CONFIG.self.eucaim_search_filter_by_tag, 0, 0)
+            searcher = DBDatasetsEUCAIMSearcher(db)
+            searchRevision = searcher.getSearchRevision()
+            result = EUCAIM_SEARCH_CACHE.get(cacheKey, searchRevision)
+            if result is None:
+                result = searcher.eucaimSearchDatasets(search_rq['ast'], CONFIG.self.eucaim_search_filter_by_tag, 0, 0)
+                EUCAIM_SEARCH_CACHE.put(cacheKey, searchRevision, result)
+            else: LOG.debug('Result obtained from cache.')
             
         LOG.debug('Result: '+json.dumps({'collections': result}))
         bottle.response.status = 200
@@ -1402,6 +1718,16 @@ def eucaimSearchDatasets():
             LOG.error("May be the body of the request is wrong: %s" % read_data)
         return setErrorResponse(500, "Unexpected error, may be the input is wrong")
 
+@app.route('/api/datasets/eucaimSearch/cacheStats', method='GET')
+def getEucaimSearchCacheStats():
+    if CONFIG is None or EUCAIM_SEARCH_CACHE is None: raise Exception()
+    LOG.debug("Received %s %s" % (bottle.request.method, bottle.request.path))
+    if CONFIG.self.eucaim_search_token == "":
+        return setErrorResponse(404, "Not found: '%s'" % bottle.request.path)
+    if bottle.request.get_header("Authorization") != "Secret " + CONFIG.self.eucaim_search_token:
+        return setErrorResponse(401, "unauthorized user")
+    bottle.response.content_type = "application/json"
+    return json.dumps(EUCAIM_SEARCH_CACHE.getStats())
 
 @app.route('/api/upgradableDatasets', method='GET')
 def getUpgradableDatasets():
@@ -1456,13 +1782,19 @@ def deleteDataset(id):
         if not user.canDeleteDataset(dataset):
             return setErrorResponse(401, "unauthorized user")
 
-        if "creating" in dataset and dataset["creating"]:
-            #First of all stop the job
-            LOG.debug('Deleting dataset creation job...')
-            k8sClient = k8s.K8sClient()
-            ok = k8sClient.delete_dataset_creation_job(datasetId)
-            if not ok: return setErrorResponse(500, "Unexpected error")
-        
+        creating = "creating" in dataset and dataset["creating"]
+
+    if creating:
+        #First of all stop the job (out of the transaction, the cancelation must be committed to be seen by the job)
+        LOG.debug('Deleting dataset creation job...')
+        if DATASET_CREATION_EXECUTOR is None: raise Exception()
+        ok = DATASET_CREATION_EXECUTOR.cancel(datasetId)
+        if not ok: return setErrorResponse(500, "Unexpected error")
+
+    with DB(CONFIG.db) as db:
+        dbdatasets = DBDatasetsOperator(db)
+        if creating and dbdatasets.getDataset(datasetId) is None:
+            return setErrorResponse(404, "not found")
         db_ds_accesses = DBDatasetAccessesOperator(db)
         accesses = db_ds_accesses.getOpenDatasetAccesses(datasetId)
         if len(accesses) > 0:
@@ -1501,7 +1833,7 @@ def getLicenses():
     with DB(CONFIG.db) as db:
         licenses = DBDatasetsOperator(db).getLicenses()
     bottle.response.content_type = "application/json"
-    return json.dumps(licenses)
+    return _bodyWithContentETag(json.dumps(licenses))
 
 
 def _getProjects(user: authorization.User) -> set[str]:
@@ -1546,7 +1878,7 @@ def getProjects():
         ret = {"list": projects, 
                "allowedActionsForTheUser": user.getAllowedActionsOnProjectsForTheUser()}
     bottle.response.content_type = "application/json"
-    return json.dumps(ret)
+    return _bodyWithContentETag(json.dumps(ret))
 
 def _checkUserCanModifyProject(code):
     if CONFIG is None: raise Exception()
@@ -1928,7 +2260,7 @@ def deleteProject(code):
                 return setErrorResponse(404, "not found")
             searchFilter = authorization.Search_filter(projects=set([code]))
             #searchFilter.adjustByUser(user)
-            datasets, total =  DBDatasetsOperator(db).getDatasets(0, 0, '', searchFilter, '', '')
+            datasets, total, _ = DBDatasetsOperator(db).getDatasets(0, 0, '', searchFilter, '', '')
             if total > 0: 
                 return setErrorResponse(400, "The project is not empty, try to delete the datasets of the project previously.")
 
@@ -2529,6 +2861,11 @@ def getDatasetAccessHistory(id):
     limit = int(bottle.request.query['limit']) if 'limit' in bottle.request.query else 30
     if skip < 0: skip = 0
     if limit < 0: limit = 0
+    try:
+        pageCursor = _getPageCursorParam()
+    except PageCursorException as e:
+        return setErrorResponse(400, str(e))
+    if pageCursor is not None: skip = pageCursor.position
 
     with DB(CONFIG.db) as db:
         dbdatasets = DBDatasetsOperator(db)
@@ -2537,13 +2874,24 @@ def getDatasetAccessHistory(id):
         _addAdditionalInfoToDataset(dataset, dbdatasets)
         if not user.canViewDatasetDetails(dataset):
             return setErrorResponse(401, "unauthorized user")
+        if limit == 0:
+            # All the accesses: the list can be very long, so it is sent in streaming.
+            bottle.response.content_type = "application/json"
+            return _streamListFromDB(lambda db: DBDatasetAccessesOperator(db).streamDatasetAccesses(datasetId, skip, pageCursor, 
+                                                                                                    STREAMING_FETCH_SIZE),
+                                     lambda access: access, skip)
 
-        accesses, total = DBDatasetAccessesOperator(db).getDatasetAccesses(datasetId, limit, skip)    
+        try:
+            accesses, total, nextCursor = DBDatasetAccessesOperator(db).getDatasetAccesses(datasetId, limit, skip, 
+                                                                                           CONFIG.self.list_total_estimation_threshold, pageCursor)
+        except PageCursorException as e:
+            return setErrorResponse(400, str(e))
     bottle.response.content_type = "application/json"
     return json.dumps({ "total": total,
                         "returned": len(accesses),
                         "skipped": skip,
                         "limit": limit,
+                        "nextCursor": _encodePageCursor(nextCursor),
                         "list": accesses })
 
 @app.route('/api-doc', method='GET')
@@ -1,5 +1,9 @@
 import logging
 import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from dataset_service.POSIX import *
 
 class Roles:
@@ -12,6 +16,42 @@ class Roles:
         self.admin_datasetAccess = roles["admin_datasetAccess"]
         self.admin_projects = roles["admin_projects"]
 
+class ValidatedTokensCache:
+    ''' Cache of the tokens already validated (signature, claims and User.validateToken), shared by the threads of the process,
+        to not repeat the validation in each request from the same user (the web UI sends many of them with the same token).
+        The key is the hash of the encoded token, and each entry expires when the token does (claim "exp").
+        The least recently used entries are evicted when there are more than maxEntries.
+    '''
+    def __init__(self, maxEntries: int):
+        self.maxEntries = maxEntries
+        self._entries = OrderedDict()   # hash of encoded token -> decoded token (including the derived properties)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _getKey(encodedToken: str) -> str:
+        return hashlib.sha256(encodedToken.encode()).hexdigest()
+
+    def get(self, encodedToken: str) -> dict | None:
+        if self.maxEntries <= 0: return None
+        key = self._getKey(encodedToken)
+        with self._lock:
+            token = self._entries.get(key)
+            if token is None: return None
+            if token["exp"] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return token
+
+    def put(self, encodedToken: str, token: dict):
+        if self.maxEntries <= 0: return
+        key = self._getKey(encodedToken)
+        with self._lock:
+            self._entries[key] = token
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
 class User:
     roles = Roles(None)
     client_id = ""
@@ -50,8 +90,18 @@ class User:
         if User.roles.superadmin_datasets in token["appRoles"]:
             cls._appendIfNotExists(token["appRoles"], User.roles.use_datasets)
             cls._appendIfNotExists(token["appRoles"], User.roles.admin_datasets)
+
+        # the projects are obtained now from the groups to not parse them again in each check
+        token["appProjects"] = cls._getProjectsFromGroups(token, User.PROJECT_GROUP_PREFIX)
+        token["appAdminProjects"] = cls._getProjectsFromGroups(token, User.PROJECT_ADMINS_GROUP_PREFIX)
         return True, None
 
+    @classmethod
+    def _getProjectsFromGroups(cls, token, prefix) -> list[str]:
+        if not "groups" in token.keys(): return []
+        prefix_len = len(prefix)
+        return [g[prefix_len:] for g in token["groups"] if g.startswith(prefix)]
+
     @property
     def uid(self):
         if self._token is None: raise Exception("Unregistered user doesn't have uid")
@@ -72,6 +122,14 @@ class User:
     def isUnregistered(self):
         return self._token is None
 
+    def getAuthorizationFingerprint(self) -> str:
+        ''' Summary of the user info used in the authorization checks:
+            the responses adjusted to the user (allowed actions, etc.) are the same while it doesn't change.
+        '''
+        if self._token is None: return "unregistered"
+        return json.dumps([self._token["sub"], self._token.get("preferred_username"), sorted(self._token["appRoles"]),
+                           sorted(self._token["appProjects"]), sorted(self._token["appAdminProjects"])])
+
     def isSuperAdminDatasets(self):
         return self._token != None and User.roles.superadmin_datasets in self._token["appRoles"]
 
@@ -196,13 +254,8 @@ class User:
         return allowedActions
     
     def getProjects(self) -> set[str]:
-        projects = set()
-        if self._token is None or not "groups" in self._token.keys(): return projects
-        prefix_len = len(User.PROJECT_GROUP_PREFIX)
-        for g in self._token["groups"]:
-            if g.startswith(User.PROJECT_GROUP_PREFIX):
-                projects.add(g[prefix_len:])
-        return projects
+        if self._token is None: return set()
+        return set(self._token["appProjects"])
 
     def canModifyDataset(self, dataset):
         if self._token is None: return False
@@ -227,11 +280,8 @@ class User:
     
     def canModifyProject(self, projectCode: str):
         if self.canAdminProjects(): return True
-        if self._token is None or not "groups" in self._token.keys(): return False
-        prefix_len = len(User.PROJECT_ADMINS_GROUP_PREFIX)
-        for g in self._token["groups"]:
-            if g.startswith(User.PROJECT_ADMINS_GROUP_PREFIX) and g[prefix_len:] == projectCode: return True
-        return False
+        if self._token is None: return False
+        return projectCode in self._token["appAdminProjects"]
     
     def canViewSubprojects(self):
         return self._token != None
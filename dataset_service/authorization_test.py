@@ -0,0 +1,39 @@
+import time
+import unittest
+from dataset_service.authorization import ValidatedTokensCache
+
+def _token(expiresIn = 60):
+    return dict(sub="u1", exp=time.time() + expiresIn)
+
+class ValidatedTokensCacheTest(unittest.TestCase):
+    def test_getPut(self):
+        cache = ValidatedTokensCache(10)
+        self.assertIsNone(cache.get("t1"))
+        token = _token()
+        cache.put("t1", token)
+        self.assertIs(cache.get("t1"), token)
+        self.assertIsNone(cache.get("t2"))
+
+    def test_expired(self):
+        cache = ValidatedTokensCache(10)
+        cache.put("t1", _token(-1))
+        self.assertIsNone(cache.get("t1"))
+        self.assertEqual(len(cache._entries), 0)
+
+    def test_leastRecentlyUsedEvicted(self):
+        cache = ValidatedTokensCache(2)
+        cache.put("t1", _token())
+        cache.put("t2", _token())
+        self.assertIsNotNone(cache.get("t1"))   # now t2 is the least recently used
+        cache.put("t3", _token())
+        self.assertIsNone(cache.get("t2"))
+        self.assertIsNotNone(cache.get("t1"))
+        self.assertIsNotNone(cache.get("t3"))
+
+    def test_disabled(self):
+        cache = ValidatedTokensCache(0)
+        cache.put("t1", _token())
+        self.assertIsNone(cache.get("t1"))
+
+if __name__ == '__main__':
+    unittest.main()
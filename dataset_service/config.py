@@ -84,6 +84,10 @@ class Config:
             self.dbname = db["dbname"]
             self.user = db["user"]
             self.password = db["password"]
+            self.pool_min_size = db["pool_min_size"]
+            self.pool_max_size = db["pool_max_size"]
+            self.pool_max_idle_seconds = db["pool_max_idle_seconds"]
+            self.pool_health_check_idle_seconds = db["pool_health_check_idle_seconds"]
 
     class Auth:
         def __init__(self, auth: dict):
@@ -101,6 +105,7 @@ class Config:
                 self.roles = token_validation["roles"]
                 self.project_group_prefix = token_validation["project_group_prefix"]
                 self.project_admins_group_prefix = token_validation["project_admins_group_prefix"]
+                self.cache_max_entries = token_validation["cache_max_entries"]
 
         class Client:
             def __init__(self, client: dict):
@@ -144,6 +149,15 @@ class Config:
             self.name = config["name"]
             self.host = config["host"]
             self.port = config["port"]
+            self.server_threads = config["server_threads"]
+            self.server_accept_backlog = config["server_accept_backlog"]
+            self.server_accepted_queue_size = config["server_accepted_queue_size"]
+            self.server_keep_alive_timeout_seconds = config["server_keep_alive_timeout_seconds"]
+            self.server_keep_alive_connections_limit = config["server_keep_alive_connections_limit"]
+            self.server_shutdown_timeout_seconds = config["server_shutdown_timeout_seconds"]
+            self.server_processes = config["server_processes"]
+            self.response_gzip_min_size = config["response_gzip_min_size"]
+            self.response_gzip_level = config["response_gzip_level"]
             self.root_url = config["root_url"]
             self.log = Config.Self.Log(config["log"])
             self.static_api_doc_dir_path = config["static_api_doc_dir_path"]
@@ -164,8 +178,19 @@ class Config:
             self.dataset_link_format = config["dataset_link_format"]
             self.eucaim_search_token = config["eucaim_search_token"]
             self.eucaim_search_filter_by_tag = config["eucaim_search_filter_by_tag"]
+            self.eucaim_search_cache_max_entries = config["eucaim_search_cache_max_entries"]
+            self.eucaim_search_cache_ttl_seconds = config["eucaim_search_cache_ttl_seconds"]
             self.dataset_integrity_check_life_days = config["dataset_integrity_check_life_days"]
             self.series_hash_cache_life_days = config["series_hash_cache_life_days"]
+            self.series_hash_workers = config["series_hash_workers"]
+            self.series_hash_workers_mode = config["series_hash_workers_mode"]
+            self.hash_read_buffer_size = config["hash_read_buffer_size"]
+            self.series_hash_manifest = config["series_hash_manifest"]
+            self.metadata_collection_workers = config["metadata_collection_workers"]
+            self.dataset_creation_executor = config["dataset_creation_executor"]
+            self.dataset_creation_local_workers = config["dataset_creation_local_workers"]
+            self.dataset_creation_local_workers_mode = config["dataset_creation_local_workers_mode"]
+            self.list_total_estimation_threshold = config["list_total_estimation_threshold"]
 
         class Log:
             def __init__(self, log: dict):
@@ -1,5 +1,6 @@
 import shutil
 import logging
+import concurrent.futures
 from dataset_service.POSIX import *
 from dataset_service import dicom, eform
 
@@ -170,16 +171,51 @@ def invalidate_dataset(datasets_dir_path, dataset_dir_name):
     ## Delete ACLs in directories of studies
     ## It is complex because many datasets can include the same study.
 
-def _getFirstDicomFile(DirPath) -> dicom.Dicom | None:
-    for fileName in os.listdir(DirPath):
-        if fileName.lower().endswith(".dcm"):
-            dicomFilePath = os.path.join(DirPath, fileName)
-            try:
-                return dicom.Dicom(dicomFilePath)
-            except WrongInputException as ex:
-                logging.root.error("Error reading DICOM file: " + dicomFilePath)
-                raise ex
-    return None
+class SeriesDirectoryScan:
+    ''' Result of scanning a series directory (see scanSeriesDirectory). '''
+    def __init__(self, filesCount: int, sizeInBytes: int, firstDicomFilePath: str | None):
+        self.filesCount = filesCount
+        self.sizeInBytes = sizeInBytes
+        self.firstDicomFilePath = firstDicomFilePath
+
+def scanSeriesDirectory(seriesDirPath) -> SeriesDirectoryScan | None:
+    '''
+    Visits the series directory only once (one scandir pass) to obtain the number of files, 
+    the total size (sum of the sizes of all the entries) and the first DICOM file found.
+    Returns None if the directory does not exist.
+    '''
+    filesCount, sizeInBytes, firstDicomFilePath = 0, 0, None
+    try:
+        it = os.scandir(seriesDirPath)
+    except FileNotFoundError: return None
+    with it:
+        for entry in it:
+            sizeInBytes += entry.stat().st_size
+            if entry.is_dir(): continue
+            filesCount += 1
+            if firstDicomFilePath is None and entry.name.lower().endswith(".dcm"): 
+                firstDicomFilePath = entry.path
+    return SeriesDirectoryScan(filesCount, sizeInBytes, firstDicomFilePath)
+
+def scanSeriesOfStudies(studies, datalake_mount_path, workers = 1) -> dict[str, SeriesDirectoryScan | None]:
+    '''
+    Scans the directories of all the series of the studies (concurrently if workers > 1).
+    Returns a dict with the path of each series directory as key and the result of scanSeriesDirectory as value.
+    It can be passed to collectMetadata() to avoid scanning them again.
+    '''
+    seriesDirPaths = [os.path.join(datalake_mount_path, study['pathInDatalake'], series['folderName']) 
+                      for study in studies for series in study['series']]
+    if workers <= 1:
+        return {path: scanSeriesDirectory(path) for path in seriesDirPaths}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan") as executor:
+        return dict(zip(seriesDirPaths, executor.map(scanSeriesDirectory, seriesDirPaths)))
+
+def _readDicomFile(dicomFilePath) -> dicom.Dicom:
+    try:
+        return dicom.Dicom(dicomFilePath)
+    except WrongInputException as ex:
+        logging.root.error("Error reading DICOM file: " + dicomFilePath)
+        raise ex
 
 def _checkMetadataItemAndSave(study, item, newValue, filename):
     if newValue is None: return
@@ -209,22 +245,29 @@ def _addMetadataFromDicomOfASeriesToStudyAndSeries(dcm: dicom.Dicom, study, seri
     series["modality"] = dcm.getModality()
     series["manufacturer"] = dcm.getManufacturer()
 
-def _readStudyMetadataFromFirstDicomFileOfAllSeries(studyPathInDatalake, study):
+def _readStudyMetadataFromFirstDicomFileOfAllSeries(studyPathInDatalake, study, seriesScans: dict | None = None):
+    ''' Also obtains the total size of the study, all from one scan of each series directory (taken from seriesScans if there). '''
     study["ageInDays"] = None
     study["sex"] = None
     study["studyDate"] = None
     study["diagnosis"] = None
     study["subprojectId"] = None
+    studySize = 0
     for series in study['series']:
         seriesDirName = series['folderName']
         seriesDirPathInDatalake = os.path.join(studyPathInDatalake, seriesDirName)
-        dcm = _getFirstDicomFile(seriesDirPathInDatalake)
-        if dcm != None:
-            _addMetadataFromDicomOfASeriesToStudyAndSeries(dcm, study, series)
+        if seriesScans != None and seriesDirPathInDatalake in seriesScans:
+            scan = seriesScans[seriesDirPathInDatalake]
+        else: scan = scanSeriesDirectory(seriesDirPathInDatalake)
+        if scan is None: raise FileNotFoundError("Series directory not found: " + seriesDirPathInDatalake)
+        studySize += scan.sizeInBytes
+        if scan.firstDicomFilePath != None:
+            _addMetadataFromDicomOfASeriesToStudyAndSeries(_readDicomFile(scan.firstDicomFilePath), study, series)
         else:
             logging.root.warning("There is a series without any dicom file"
                 + "[studyId: %s, seriesFolderPath: %s]" % (study["studyId"], seriesDirPathInDatalake))
             series["bodyPart"], series["modality"], series["manufacturer"] = None, None, None
+    study["sizeInBytes"] = studySize
 
 def _completeStudyMetadataWithSubjectEform(study, eform: eform.Eform):
     if not "diagnosisYear" in study: study["diagnosisYear"] = None
@@ -264,16 +307,39 @@ def _getValuesAndCountsFromCountDict(countDict: dict[str|None, int]) -> tuple[li
     counts = list(countDict.values())
     return values, counts
 
-def _getTotalStudySizeInBytes(studyPathInDatalake, study):
-    studySize = 0
-    for series in study['series']:
-        seriesDirName = series['folderName']
-        seriesDirPathInDatalake = os.path.join(studyPathInDatalake, seriesDirName)
-        for fileName in os.listdir(seriesDirPathInDatalake):
-            studySize += os.path.getsize(os.path.join(seriesDirPathInDatalake, fileName))
-    study["sizeInBytes"] = studySize
+def _readStudyMetadataFromDatalake(study, datalake_mount_path, seriesScans = None):
+    ''' The slow part of the metadata collection (reading files in datalake), it can be run concurrently for different studies. '''
+    if len(study['series']) == 0: return
+    studyPathInDatalake = os.path.join(datalake_mount_path, study['pathInDatalake'])
+    #logging.root.debug("Checking and collecting metadata from study %s" % (study['pathInDatalake']))
+    _readStudyMetadataFromFirstDicomFileOfAllSeries(studyPathInDatalake, study, seriesScans)
 
-def collectMetadata(dataset, datalake_mount_path, eformsFilePath, skip_subproject_id_security_check = False):
+def _readMetadataOfStudiesFromDatalake(studies, datalake_mount_path, workers = 1, seriesScans = None):
+    '''
+    Generator which yields each study (in the same order of the list) once its metadata has been read from datalake.
+    If workers > 1, the studies are read concurrently in a pool of threads (the network storage latency is the bottleneck), 
+    but yielded in order, so the aggregation and also the error raised (if any wrong study) are deterministic.
+    '''
+    if workers <= 1:
+        for study in studies:
+            _readStudyMetadataFromDatalake(study, datalake_mount_path, seriesScans)
+            yield study
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="metadata") as executor:
+        futures = [executor.submit(_readStudyMetadataFromDatalake, study, datalake_mount_path, seriesScans) for study in studies]
+        try:
+            for study, future in zip(studies, futures):
+                future.result()   # raises the exception of the task if any
+                yield study
+        finally:
+            for future in futures: future.cancel()
+
+def collectMetadata(dataset, datalake_mount_path, eformsFilePath, skip_subproject_id_security_check = False, workers = 1, 
+                    seriesScans = None):
+    ''' 
+    "workers" is the number of studies read concurrently from datalake (1 for reading them serially).
+    "seriesScans" is optional (just for optimization), the result of a previous scanSeriesOfStudies() on the same studies.
+    '''
     differentSubjects = set()
     studiesCount = 0
     minAgeInDays, maxAgeInDays = MAX_AGE_VALUE, 0
@@ -290,16 +356,12 @@ def collectMetadata(dataset, datalake_mount_path, eformsFilePath, skip_subprojec
     totalSizeInBytes = 0
     subjects = eform.Eforms(eformsFilePath)
     subprojectId = None
-    for study in dataset["studies"]:
+    for study in _readMetadataOfStudiesFromDatalake(dataset["studies"], datalake_mount_path, workers, seriesScans):
         studiesCount += 1
         if not study["subjectName"] in differentSubjects: 
             differentSubjects.add(study["subjectName"])
         if len(study['series']) == 0: continue
 
-        studyPathInDatalake = os.path.join(datalake_mount_path, study['pathInDatalake'])
-        #logging.root.debug("Checking and collecting metadata from study %s" % (study['pathInDatalake']))
-        _readStudyMetadataFromFirstDicomFileOfAllSeries(studyPathInDatalake, study)
-        _getTotalStudySizeInBytes(studyPathInDatalake, study)
         _completeStudyMetadataWithSubjectEform(study, subjects.getEform(study["subjectName"]))
 
         if not skip_subproject_id_security_check:
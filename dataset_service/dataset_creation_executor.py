@@ -0,0 +1,294 @@
+import os
+import socket
+import signal
+import logging
+import threading
+import time
+import uuid
+import multiprocessing
+from abc import ABC, abstractmethod
+from .config import Config
+from .storage import DB, DBDatasetsOperator
+from .dataset_creation_worker import dataset_creation_worker
+from .logger import config_logger
+from . import k8s
+
+# The relaunches (by an admin, after solving the problem which interrupted the creation) go before the new datasets in the queue.
+RELAUNCH_PRIORITY = 1
+
+class DatasetCreationExecutor(ABC):
+    ''' Runs the creation process (dataset_creation_worker) of the datasets previously created in DB
+        (with the entry in dataset_creation_status, which the worker updates with the progress).
+        The methods receiving "db" do the changes within the transaction of the caller.
+    '''
+    # Max time waiting for a canceled creation to stop.
+    CANCEL_WAIT_MAX_SECONDS = 120
+    CANCEL_WAIT_INTERVAL_SECONDS = 1
+
+    def start(self): pass
+    def stop(self): pass
+
+    @abstractmethod
+    def launch(self, db: DB, datasetId: str, priority: int = 0): ...
+
+    def relaunch(self, db: DB, datasetId: str, priority: int = RELAUNCH_PRIORITY):
+        ''' To launch again the creation of a dataset which has been interrupted or has failed (it must not be running). '''
+        self.launch(db, datasetId, priority)
+
+    @abstractmethod
+    def isRunning(self, db: DB, datasetId: str) -> bool: ...
+
+    @abstractmethod
+    def cancel(self, datasetId: str) -> bool:
+        ''' Cancels the creation and waits for it to stop, so the dataset can be removed after that.
+            The cancelation is committed immediately (to be seen by the process running the creation),
+            so it must not be called within a transaction (DB block).
+            Returns False in case of unexpected error or if the creation has not stopped in time.
+        '''
+
+
+class K8sDatasetCreationExecutor(DatasetCreationExecutor):
+    ''' Launches a job in kubernetes for each dataset, running start_dataset_creation_job.py '''
+    def launch(self, db: DB, datasetId: str, priority: int = 0):
+        k8s.K8sClient().add_dataset_creation_job(datasetId)
+
+    def relaunch(self, db: DB, datasetId: str, priority: int = RELAUNCH_PRIORITY):
+        k8sClient = k8s.K8sClient()
+        if k8sClient.exist_dataset_creation_job(datasetId):
+            k8sClient.delete_dataset_creation_job(datasetId)
+        k8sClient.add_dataset_creation_job(datasetId)
+
+    def isRunning(self, db: DB, datasetId: str) -> bool:
+        k8sClient = k8s.K8sClient()
+        job = k8sClient.exist_dataset_creation_job(datasetId)
+        return job != None and k8sClient.is_running_job(job)
+
+    def cancel(self, datasetId: str) -> bool:
+        k8sClient = k8s.K8sClient()
+        if not k8sClient.delete_dataset_creation_job(datasetId): return False
+        # The deletion is in foreground, so the job exists until the pod is deleted.
+        waitedSeconds = 0
+        while k8sClient.exist_dataset_creation_job(datasetId) != None:
+            if waitedSeconds >= self.CANCEL_WAIT_MAX_SECONDS: 
+                logging.root.error("The dataset creation job has not been deleted in time.")
+                return False
+            time.sleep(self.CANCEL_WAIT_INTERVAL_SECONDS)
+            waitedSeconds += self.CANCEL_WAIT_INTERVAL_SECONDS
+        return True
+
+
+def _runWorkerInProcess(config: Config, datasetId: str, lease: str, parentPid: int):
+    ''' Entry point of the process launched for a dataset creation by the local executor in "process" mode.
+        Like start_dataset_creation_job.py, the creation is canceled with SIGTERM.
+    '''
+    log_conf = config.self.log.dataset_creation_job
+    config_logger(log_conf.level, log_conf.file_path % datasetId, log_conf.max_size, 4)
+    worker = dataset_creation_worker(config, datasetId, lease)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    thread = threading.Thread(target=dataset_creation_worker.run, args=[worker])
+    thread.daemon = True
+    thread.start()
+    while thread.is_alive():
+        # If the service has died, just exit (without cancel): the creation will be resumed by another executor.
+        if os.getppid() != parentPid: os._exit(1)
+        time.sleep(0.1)
+
+class _LocalJob:
+    def __init__(self, config: Config, datasetId: str, lease: str, workersMode: str):
+        self.lease = lease
+        self.canceled = False
+        self.killed = False
+        if workersMode == "process":
+            self.worker = None
+            self.process = multiprocessing.get_context("spawn").Process(target=_runWorkerInProcess,
+                                                                        args=(config, datasetId, lease, os.getpid()),
+                                                                        name="dataset-creation-" + datasetId, daemon=True)
+            self.process.start()
+        else:
+            self.worker = dataset_creation_worker(config, datasetId, lease)
+            self.process = threading.Thread(target=dataset_creation_worker.run, args=[self.worker],
+                                            name="dataset-creation-" + datasetId, daemon=True)
+            self.process.start()
+
+    def isAlive(self) -> bool:
+        return self.process.is_alive()
+
+    def cancel(self):
+        if self.canceled: return
+        self.canceled = True
+        if self.worker != None: self.worker.stop()
+        else: self.process.terminate()
+
+    def kill(self):
+        ''' Stops the job without cancel the creation (to be resumed later or because it has been taken by other job).
+            In "thread" mode the worker stops in the next check of progress.
+        '''
+        self.killed = True
+        if self.worker != None: self.worker.abandon()
+        elif self.process.is_alive(): self.process.kill()
+
+    def join(self, timeoutSeconds: float) -> bool:
+        self.process.join(timeoutSeconds)
+        return not self.process.is_alive()
+
+class LocalDatasetCreationExecutor(DatasetCreationExecutor):
+    ''' Runs the dataset creations in this process (threads) or in child processes,
+        taking them from a queue in DB (dataset_creation_queue), by priority and in order of arrival.
+        The queue is shared by all the executors (all the processes of the service), which take the datasets
+        while the creations in progress (by all of them) are less than "workers".
+        While running, the executor updates periodically the heartbeat of the datasets it has taken,
+        so if it dies, other executor (or the same after the restart of the service) takes them again and resumes their creation.
+        Each time a dataset is taken, the owner set in the queue is a new lease (the executor id plus a random suffix),
+        which the job checks before each step, so it stops if the creation has been taken again (e.g. because the heartbeat
+        was delayed) and never runs twice at the same time.
+        A creation is canceled by removing the dataset from the queue.
+    '''
+    POLL_INTERVAL_SECONDS = 5
+    HEARTBEAT_TIMEOUT_SECONDS = 60
+    # Max time waiting for a job which has lost the lease to stop, before starting the new one for the same dataset.
+    KILL_WAIT_SECONDS = 5
+
+    def __init__(self, config: Config, workers: int, workersMode: str):
+        if workersMode not in ("thread", "process"): raise Exception("Unknown workers mode for dataset creation: %s" % workersMode)
+        self.log = logging.root
+        self.config = config
+        self.workers = workers
+        self.workersMode = workersMode
+        self.owner = ""
+        self._jobs = {}   # datasetId -> _LocalJob
+        self._jobsLock = threading.Lock()   # _jobs is changed by the loop thread and read by the request threads (cancel)
+        self._wakeUp = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        # The owner is set here because in pre-fork mode the executor is created before the fork.
+        self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+        self._stopping = False
+        self._thread = threading.Thread(target=self._loop, name="dataset-creation-executor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        ''' Stops taking datasets from the queue. The creations in progress are not canceled, they will be resumed later:
+            in "process" mode they are killed and released immediately to be taken again,
+            in "thread" mode they finish with this process and will be taken again when the heartbeat times out.
+        '''
+        if self._thread is None: return
+        self._stopping = True
+        self._wakeUp.set()
+        self._thread.join()
+        self._thread = None
+        if self.workersMode != "process": return
+        with self._jobsLock:
+            jobs = list(self._jobs.values())
+            self._jobs.clear()
+        for job in jobs: job.kill()
+        with DB(self.config.db) as db:
+            DBDatasetsOperator(db).releaseDatasetCreationsOfOwners([job.lease for job in jobs])
+
+    def launch(self, db: DB, datasetId: str, priority: int = 0):
+        DBDatasetsOperator(db).enqueueDatasetCreation(datasetId, priority)
+        self._wakeUp.set()
+
+    def isRunning(self, db: DB, datasetId: str) -> bool:
+        return DBDatasetsOperator(db).isDatasetCreationRunning(datasetId, self.HEARTBEAT_TIMEOUT_SECONDS)
+
+    def cancel(self, datasetId: str) -> bool:
+        with DB(self.config.db) as db:
+            dbdatasets = DBDatasetsOperator(db)
+            running = dbdatasets.isDatasetCreationRunning(datasetId, self.HEARTBEAT_TIMEOUT_SECONDS)
+            dbdatasets.deleteDatasetCreationFromQueue(datasetId)
+        if not running: return True
+        with self._jobsLock: job = self._jobs.get(datasetId)
+        if job != None:
+            # Run by this executor
+            job.cancel()
+            if job.join(self.CANCEL_WAIT_MAX_SECONDS):
+                self._endCanceledJob(datasetId)
+                return True
+        else:
+            # Run by other executor: the job stops when it sees the dataset removed from the queue (before the next step)
+            # and then the status is set to error (by the job or by the executor when it sees the job finished).
+            waitedSeconds = 0
+            while waitedSeconds < self.CANCEL_WAIT_MAX_SECONDS:
+                with DB(self.config.db) as db:
+                    status = DBDatasetsOperator(db).getDatasetCreationStatus(datasetId)
+                if status is None or status["status"] == "error": return True
+                time.sleep(self.CANCEL_WAIT_INTERVAL_SECONDS)
+                waitedSeconds += self.CANCEL_WAIT_INTERVAL_SECONDS
+        self.log.error("The creation of dataset %s has not stopped in time." % datasetId)
+        return False
+
+    def _endCanceledJob(self, datasetId: str):
+        # The job may have been stopped before updating the status (e.g. killed while starting).
+        with DB(self.config.db) as db:
+            DBDatasetsOperator(db).setDatasetCreationErrorIfNotFinished(datasetId, "Canceled by user")
+
+    def _loop(self):
+        while not self._stopping:
+            try:
+                self._checkJobs()
+                self._takeJobs()
+            except Exception as e:
+                self.log.exception(e)
+            self._wakeUp.wait(self.POLL_INTERVAL_SECONDS)
+            self._wakeUp.clear()
+
+    def _checkJobs(self):
+        with self._jobsLock: jobs = list(self._jobs.items())
+        if len(jobs) == 0: return
+        with DB(self.config.db) as db:
+            dbdatasets = DBDatasetsOperator(db)
+            for datasetId, job in jobs:
+                if not job.isAlive():
+                    dbdatasets.deleteDatasetCreationFromQueueIfOwner(datasetId, job.lease)
+                    if job.canceled: dbdatasets.setDatasetCreationErrorIfNotFinished(datasetId, "Canceled by user")
+                    with self._jobsLock: del self._jobs[datasetId]
+                elif not job.canceled and not job.killed and not dbdatasets.updateDatasetCreationHeartbeat(datasetId, job.lease):
+                    if dbdatasets.getDatasetCreationOwner(datasetId) is None:
+                        self.log.info("Canceling the creation of dataset %s..." % datasetId)
+                        job.cancel()
+                    else:
+                        # Taken by other executor: the job stops by itself when it checks the lease,
+                        # and the process can be killed without cancel (the status is updated by the other job).
+                        self.log.warning("The creation of dataset %s has been taken by other executor." % datasetId)
+                        job.kill()
+
+    def _takeJobs(self):
+        while not self._stopping and len(self._jobs) < self.workers:
+            lease = "%s/%s" % (self.owner, uuid.uuid4().hex)
+            with DB(self.config.db) as db:
+                datasetId = DBDatasetsOperator(db).takeDatasetCreationFromQueue(lease, self.workers,
+                                                                                 self.HEARTBEAT_TIMEOUT_SECONDS)
+            if datasetId is None: return
+            with self._jobsLock: previousJob = self._jobs.get(datasetId)
+            if previousJob != None and previousJob.isAlive():
+                # The previous job of this executor for the dataset has lost the lease (i.e. the heartbeat was delayed),
+                # it must stop before starting the new one, to not run the creation twice at the same time.
+                self.log.warning("Taking again the creation of dataset %s, stopping the previous job..." % datasetId)
+                previousJob.kill()
+                if not previousJob.join(self.KILL_WAIT_SECONDS):
+                    # Let's release the dataset to be taken again in the next poll (or by other executor)
+                    with DB(self.config.db) as db:
+                        DBDatasetsOperator(db).releaseDatasetCreationsOfOwners([lease])
+                    return
+            self.log.info("Starting the creation of dataset %s..." % datasetId)
+            try:
+                job = _LocalJob(self.config, datasetId, lease, self.workersMode)
+                with self._jobsLock: self._jobs[datasetId] = job
+            except Exception as e:
+                # Let's not leave the dataset in creating state (it would be taken again and again)
+                self.log.exception(e)
+                with DB(self.config.db) as db:
+                    dbdatasets = DBDatasetsOperator(db)
+                    dbdatasets.deleteDatasetCreationFromQueueIfOwner(datasetId, lease)
+                    dbdatasets.setDatasetCreationStatus(datasetId, "error", "Unexpected error launching dataset creation job.")
+
+
+def createDatasetCreationExecutor(config: Config) -> DatasetCreationExecutor:
+    if config.self.dataset_creation_executor == "k8s":
+        return K8sDatasetCreationExecutor()
+    if config.self.dataset_creation_executor == "local":
+        return LocalDatasetCreationExecutor(config, config.self.dataset_creation_local_workers,
+                                            config.self.dataset_creation_local_workers_mode)
+    raise Exception("Unknown dataset creation executor: %s" % config.self.dataset_creation_executor)
@@ -4,7 +4,7 @@ import time
 from pathlib import Path
 import json
 from .auth import AuthClient, LoginException
-from .storage import DB, DBDatasetsOperator, DBProjectsOperator
+from .storage import DB, DBSession, DBDatasetsOperator, DBProjectsOperator
 from .hash import datasetHashesOperator
 from .config import Config
 from . import dataset as dataset_file_system
@@ -14,16 +14,43 @@ class WrongInputException(Exception): pass
 
 class dataset_creation_worker:
 
-    def __init__(self, config: Config, datasetId: str):
+    def __init__(self, config: Config, datasetId: str, lease: str | None = None):
+        ''' lease: the owner set in the creation queue when the dataset was taken by the local executor (None if not launched by it).
+                   The job stops if it is not the owner anymore, i.e. the creation has been canceled (removed from the queue)
+                   or taken again by other executor (because this one has been supposed dead).
+        '''
         self.log = logging.root
         self.config = config
         self.datasetId = datasetId
+        self.lease = lease
+        self.leaseLost = False
+        self._lastLeaseCheckTime = 0.0
+
+    # Max time between checks of the lease while a step is running (it is always checked before each step).
+    LEASE_CHECK_INTERVAL_SECONDS = 10
+
+    def _checkLease(self) -> bool:
+        self._lastLeaseCheckTime = time.monotonic()
+        with DB(self.config.db) as db:
+            owner = DBDatasetsOperator(db).getDatasetCreationOwner(self.datasetId)
+        if owner == self.lease: return True
+        if owner is None:
+            self.log.info("The creation has been removed from the queue, canceling...")
+        else:
+            # Other job is running (or will run) the creation, so this one must stop without changing anything.
+            self.log.warning("The creation has been taken by other executor, stopping...")
+            self.leaseLost = True
+        self.stopping = True
+        return False
 
     def updateProgress(self, message: str, log = True) -> bool:
         ''' Returns True if the user have canceled the process and so all current tasks must stop.
             The message can be empty string to avoid changing the status message and just to know whether to continue o cancel.
         '''
         if self.stopping: return True
+        if self.lease is not None and (message != "" or 
+                                       time.monotonic() - self._lastLeaseCheckTime >= self.LEASE_CHECK_INTERVAL_SECONDS):
+            if not self._checkLease(): return True
         if message != "":
             if log: self.log.debug(message)
             with DB(self.config.db) as db:
@@ -33,6 +60,13 @@ class dataset_creation_worker:
     def _endProgress(self, errorMessage: str | None = None):
         with DB(self.config.db) as db:
             dbdatasets = DBDatasetsOperator(db)
+            if self.lease is not None and not self.leaseLost:
+                # The lease is checked again because the job may have failed due to other job which has taken the creation.
+                owner = dbdatasets.getDatasetCreationOwner(self.datasetId)
+                if owner is None:
+                    if errorMessage is not None: errorMessage = "Canceled by user"
+                elif owner != self.lease: self.leaseLost = True
+            if self.leaseLost: return   # the status is updated by the job which has taken the creation
             if errorMessage is None:    # end successfully
                 dbdatasets.deleteDatasetCreationStatus(self.datasetId)
             else:                       # end with error
@@ -47,6 +81,11 @@ class dataset_creation_worker:
         with DB(self.config.db) as db:
             DBDatasetsOperator(db).setDatasetCreationStatus(self.datasetId, "running", "Canceling...")
 
+    def abandon(self):
+        ''' Stops the job without changing the status, because the creation has been taken by other job. '''
+        self.leaseLost = True
+        self.stopping = True
+
     WAIT_FOR_DATASET_INTERVAL_SECONDS = 5
     WAIT_FOR_DATASET_MAX_SECONDS = 120
 
@@ -93,13 +132,14 @@ class dataset_creation_worker:
         for study in studies:
             self._checkPath(datasetDirPath, study['subjectName'])
     
-    def _removeSeriesMissingInDatalake(self, studies):
+    def _removeSeriesMissingInDatalake(self, studies, seriesScans):
+        ''' "seriesScans" is the result of dataset_file_system.scanSeriesOfStudies() for the studies. '''
         studiesToDelete = []
         for study in studies:
             seriesToDelete = []
             for serie in study["series"]:
                 seriePathInDatalake = os.path.join(self.config.self.datalake_mount_path, study['pathInDatalake'], serie['folderName'])
-                if not os.path.exists(seriePathInDatalake):
+                if seriesScans[seriePathInDatalake] is None:
                     self.log.warn("The directory '%s' does not exist. That series will not be included in the dataset." % seriePathInDatalake)
                     seriesToDelete.append(serie)
             for serie in seriesToDelete: 
@@ -110,6 +150,13 @@ class dataset_creation_worker:
         for study in studiesToDelete:
             studies.remove(study)
 
+    def _scanSeriesAndRemoveMissingInDatalake(self, studies):
+        ''' Returns the scans of the series directories, to be reused in the metadata collection. '''
+        seriesScans = dataset_file_system.scanSeriesOfStudies(studies, self.config.self.datalake_mount_path, 
+                                                              self.config.self.metadata_collection_workers)
+        self._removeSeriesMissingInDatalake(studies, seriesScans)
+        return seriesScans
+
     def _writeIndexFile(self, studies, indexFilePath):
         # dataset["studies"] contains all the information we want to save in the index.json file,
         # but we have to take only some of the properties for each study and set paths relative to the dataset directory
@@ -134,6 +181,11 @@ class dataset_creation_worker:
             json.dump(outStudies, outputStream)
 
     def run(self):
+        # All the DB objects created by the job (e.g. on each progress update) share one connection.
+        with DBSession():
+            self._run()
+
+    def _run(self):
         auth_client = AuthClient(self.config.auth.client.auth_url, self.config.auth.client.client_id, self.config.auth.client.client_secret)
         try:
             if self.config.self.datasets_mount_path == '':
@@ -152,10 +204,11 @@ class dataset_creation_worker:
             datasetDirPath = os.path.join(self.config.self.datasets_mount_path, datasetDirName)
             studiesTmpFilePath = os.path.join(datasetDirPath, self.config.self.studies_tmp_file_name)
 
+            seriesScans = None   # Scans of the series directories, to visit each one only once in the whole process.
             with DB(self.config.db) as db:
                 dataset = self._getDataset(db)
                 if dataset is None: raise Exception("dataset not found in database")
-                datasetStudies, total = DBDatasetsOperator(db).getStudiesFromDataset(self.datasetId)
+                datasetStudies, total, _ = DBDatasetsOperator(db).getStudiesFromDataset(self.datasetId)
             if total > 0:  
                 # This is true only when the creation of dataset has been interrupted previously 
                 # and the studies are already stored in DB. 
@@ -181,15 +234,14 @@ class dataset_creation_worker:
                 if self.config.self.datalake_mount_path != '':
                     stop = self.updateProgress("Checking for missing series in datalake...")
                     if stop: self._cancelProgress(); return
-                    self._removeSeriesMissingInDatalake(dataset["studies"])
+                    seriesScans = self._scanSeriesAndRemoveMissingInDatalake(dataset["studies"])
 
                 stop = self.updateProgress('Creating studies in DB...')
                 if stop: self._cancelProgress(); return
                 with DB(self.config.db) as db:
-                    dbdatasets = DBDatasetsOperator(db)
                     for study in dataset["studies"]:
                         if not "studyName" in study: study["studyName"] = "-"
-                        dbdatasets.createOrUpdateStudy(study, self.datasetId)
+                    DBDatasetsOperator(db).createOrUpdateStudies(dataset["studies"], self.datasetId)
 
             isExternalDataset = (dataset['project'] == self.config.self.external_datasets_project_code)
 
@@ -201,7 +253,8 @@ class dataset_creation_worker:
                 # Collect metadata doing some checks and adding as new properties to dataset, to the studies inside, 
                 # and to the series inside the studies.
                 dataset_file_system.collectMetadata(dataset, self.config.self.datalake_mount_path, eformsFilePath, 
-                                                    self.config.self.skip_subproject_id_security_check)
+                                                    self.config.self.skip_subproject_id_security_check,
+                                                    self.config.self.metadata_collection_workers, seriesScans=seriesScans)
                 if not isExternalDataset and not self.config.self.skip_subproject_id_security_check:
                     # Security check: It is important to check the subprojectId to avoid create dataset with studies from other project
                     with DB(self.config.db) as db:
@@ -234,7 +287,9 @@ class dataset_creation_worker:
                 studiesHashes = []
                 stop = self.updateProgress("Calculating the hashes of the dataset...")
                 if stop: self._cancelProgress(); return
-                hashesOperator = datasetHashesOperator(self.config.db, self.config.self.series_hash_cache_life_days)
+                hashesOperator = datasetHashesOperator(self.config.db, self.config.self.series_hash_cache_life_days,
+                                                       self.config.self.series_hash_workers, self.config.self.series_hash_workers_mode,
+                                                       self.config.self.hash_read_buffer_size, self.config.self.series_hash_manifest)
                 tracer.traceDatasetCreation(auth_client, self.config.tracer.url, 
                                             datasetDirPath, self.config.self.index_file_name, self.config.self.eforms_file_name, 
                                             self.datasetId, authorId, hashesOperator, None, studiesHashes, self.updateProgress)
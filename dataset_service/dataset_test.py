@@ -0,0 +1,68 @@
+import os
+import json
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from dataset_service import dataset
+from dataset_service.dataset_creation_worker import dataset_creation_worker
+
+def _writeFile(path, content: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f: f.write(content)
+
+class ScanSeriesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.datalake = self.tmpDir.name
+        _writeFile(os.path.join(self.datalake, "st1", "se1", "b.dcm"), b'12345')
+        _writeFile(os.path.join(self.datalake, "st1", "se1", "a.txt"), b'123')
+        os.makedirs(os.path.join(self.datalake, "st1", "se1", "subdir"))
+        _writeFile(os.path.join(self.datalake, "st1", "se2", "c.DCM"), b'1')
+        self.studies = [dict(studyId="1", subjectName="s1", pathInDatalake="st1",
+                             series=[dict(folderName="se1", tags=[]), dict(folderName="se2", tags=[]),
+                                     dict(folderName="missing", tags=[])])]
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def test_scanSeriesDirectory(self):
+        scan = dataset.scanSeriesDirectory(os.path.join(self.datalake, "st1", "se1"))
+        self.assertIsNotNone(scan)
+        self.assertEqual(scan.filesCount, 2)
+        self.assertEqual(scan.firstDicomFilePath, os.path.join(self.datalake, "st1", "se1", "b.dcm"))
+        # the size includes the entries of subdirectories (as the baseline, the size of the entry itself)
+        subdirSize = os.stat(os.path.join(self.datalake, "st1", "se1", "subdir")).st_size
+        self.assertEqual(scan.sizeInBytes, 8 + subdirSize)
+
+    def test_scanSeriesDirectory_missing(self):
+        self.assertIsNone(dataset.scanSeriesDirectory(os.path.join(self.datalake, "st1", "missing")))
+
+    def test_scanSeriesOfStudies(self):
+        for workers in [1, 4]:
+            scans = dataset.scanSeriesOfStudies(self.studies, self.datalake, workers)
+            self.assertEqual(set(scans.keys()), {os.path.join(self.datalake, "st1", s) for s in ["se1", "se2", "missing"]})
+            self.assertEqual(scans[os.path.join(self.datalake, "st1", "se2")].filesCount, 1)
+            self.assertIsNone(scans[os.path.join(self.datalake, "st1", "missing")])
+
+    def test_workerScansOnceForCheckAndMetadata(self):
+        ''' The scans done by the creation job for the missing series check are reused in the metadata collection. '''
+        config = SimpleNamespace(self=SimpleNamespace(datalake_mount_path=self.datalake, metadata_collection_workers=2))
+        worker = dataset_creation_worker(config, "d1")
+        seriesScans = worker._scanSeriesAndRemoveMissingInDatalake(self.studies)
+        self.assertEqual([s["folderName"] for s in self.studies[0]["series"]], ["se1", "se2"])
+
+        # Without DICOM files to read (only the scans are used)
+        for path, scan in seriesScans.items():
+            if scan is not None: scan.firstDicomFilePath = None
+        eformsFilePath = os.path.join(self.datalake, "eforms.json")
+        _writeFile(eformsFilePath, json.dumps([dict(subjectName="s1", eForm={})]).encode())
+        ds = dict(studies=self.studies)
+        with mock.patch.object(dataset, "scanSeriesDirectory", side_effect=AssertionError("scanned again")):
+            dataset.collectMetadata(ds, self.datalake, eformsFilePath, True, 2, seriesScans=seriesScans)
+        self.assertEqual(ds["studiesCount"], 1)
+        self.assertEqual(ds["sizeInBytes"],
+                         seriesScans[os.path.join(self.datalake, "st1", "se1")].sizeInBytes + 1 + os.path.getsize(eformsFilePath))
+
+if __name__ == '__main__':
+    unittest.main()
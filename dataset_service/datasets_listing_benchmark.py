@@ -0,0 +1,114 @@
+'''
+Benchmark of the query of the datasets list (GET /datasets) for each sort criteria,
+with and without the indexes created for it (DB schema v51), to make visible any regression.
+It seeds synthetic datasets in the database (ids starting with "benchmark-") and removes them at the end.
+The measure "without indexes" drops them within a transaction which is rolled back after.
+
+WARNING: use a database for testing, not the one in production (the tables are locked during the measure).
+
+Usage (from the root directory of the repository):
+    python -m dataset_service.datasets_listing_benchmark [config file] [--datasets N] [--repetitions N] [--limit N]
+'''
+import sys
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+import psycopg2.extras
+from dataset_service.config import load_config
+from dataset_service.storage import DB, DBDatasetsOperator
+from dataset_service import authorization
+
+LISTING_INDEXES = ["dataset_author_id_index", "dataset_project_code_index",
+                   "dataset_published_creation_date_index", "dataset_published_name_index",
+                   "dataset_published_studies_count_index", "dataset_published_subjects_count_index",
+                   "dataset_published_times_used_index"]
+SORT_BY = ["creationDate", "name", "authorName", "studiesCount", "subjectsCount", "timesUsed"]
+ID_PREFIX = "benchmark-"
+PROJECTS = ["BENCHMARK-%d" % i for i in range(20)]
+
+def _seed(db: DB, count: int):
+    authors = [(ID_PREFIX + str(i), ID_PREFIX + str(i), "Author %d" % i, "author%d@benchmark" % i) for i in range(50)]
+    psycopg2.extras.execute_values(db.cursor,
+        "INSERT INTO author (id, username, name, email) VALUES %s ON CONFLICT DO NOTHING", authors)
+    rnd = random.Random(1)
+    start = datetime(2020, 1, 1)
+    rows = []
+    for i in range(count):
+        # Most of them published (as in production), a few drafts and invalidated.
+        draft = rnd.random() < 0.05
+        invalidated = not draft and rnd.random() < 0.05
+        rows.append(("%s%08d" % (ID_PREFIX, i), "Dataset %s %d" % (rnd.choice(["lung", "breast", "colon", "prostate"]), i),
+                     rnd.choice(PROJECTS), rnd.choice(authors)[0], start + timedelta(minutes=rnd.randrange(3000000)),
+                     draft, rnd.random() < 0.3, invalidated, rnd.randrange(1, 5000), rnd.randrange(1, 2000), rnd.randrange(100)))
+    psycopg2.extras.execute_values(db.cursor, """
+        INSERT INTO dataset (id, name, project_code, author_id, creation_date, draft, public, invalidated,
+                             studies_count, subjects_count, times_used)
+        VALUES %s""", rows, page_size=1000)
+
+def _cleanup(db: DB):
+    db.cursor.execute("DELETE FROM dataset WHERE id LIKE %s", (ID_PREFIX + '%',))
+    db.cursor.execute("DELETE FROM author WHERE id LIKE %s", (ID_PREFIX + '%',))
+
+def _getSearchFilters():
+    # As adjusted by Search_filter.adjustByUser()
+    unregistered = authorization.Search_filter(draft = False, invalidated = False)
+    unregistered._projectsForNonPublic = set()
+    user = authorization.Search_filter(draft = False, invalidated = False)
+    user._projectsForNonPublic = set(PROJECTS[:3])
+    return [("unregistered", unregistered), ("user in 3 projects", user)]
+
+def _measure(db: DB, repetitions: int, limit: int):
+    results = {}
+    dbdatasets = DBDatasetsOperator(db)
+    for filterName, searchFilter in _getSearchFilters():
+        for sortBy in SORT_BY:
+            best = float("inf")
+            for i in range(repetitions):
+                start = time.perf_counter()
+                dbdatasets.getDatasets(0, limit, '', searchFilter, sortBy, '')
+                best = min(best, time.perf_counter() - start)
+            results[(filterName, sortBy)] = best
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the query of the datasets list.")
+    parser.add_argument("config", nargs="?", default=None, help="configuration file (the db section is used)")
+    parser.add_argument("--datasets", type=int, default=50000, help="number of synthetic datasets to seed")
+    parser.add_argument("--repetitions", type=int, default=5)
+    parser.add_argument("--limit", type=int, default=30, help="page size")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if config is None: return 1
+    with DB(config.db) as db:
+        db.setup()
+        db.cursor.execute("SELECT count(*) FROM dataset WHERE id LIKE %s", (ID_PREFIX + '%',))
+        if db.cursor.fetchone()[0] > 0: _cleanup(db)   # from a previous interrupted run
+        print("Seeding %d datasets..." % args.datasets)
+        _seed(db, args.datasets)
+    try:
+        with DB(config.db) as db:
+            db.cursor.execute("ANALYZE dataset")
+            db.cursor.execute("ANALYZE author")
+        with DB(config.db) as db:
+            withIndexes = _measure(db, args.repetitions, args.limit)
+        db = DB(config.db)
+        try:
+            for index in LISTING_INDEXES:
+                db.cursor.execute("DROP INDEX IF EXISTS " + index)
+            withoutIndexes = _measure(db, args.repetitions, args.limit)
+        finally:
+            db.close()   # rollback, the indexes are kept
+    finally:
+        with DB(config.db) as db:
+            _cleanup(db)
+
+    print("%-20s %-15s %12s %12s %9s" % ("Filter", "sortBy", "Without (ms)", "With (ms)", "Speedup"))
+    for (filterName, sortBy), seconds in withIndexes.items():
+        before = withoutIndexes[(filterName, sortBy)]
+        print("%-20s %-15s %12.2f %12.2f %8.1fx" % (filterName, sortBy, before * 1000, seconds * 1000, before / seconds))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
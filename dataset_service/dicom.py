@@ -1,5 +1,6 @@
 from datetime import datetime
 import pydicom
+import pydicom.filereader
 import logging
 
 # List of tags with types (VR):
@@ -35,9 +36,30 @@ PROJECT_NAME_PRIVATE_TAG = 0x70D1, 0x2000
 # Value examples: 6436b3f00011ce501f0aa4fc (the QPI project id in case of QPI managed datasets)
 #                 "Colon cancer CT_only", "Lung cancer CT_only" (the QP project name in case of QP managed datasets)
 
+SPECIFIC_CHARACTER_SET_TAG = 0x0008, 0x0005
+# Required to decode correctly the string values.
+
+# The only tags read from the files by default (see Dicom.__init__).
+TAGS_TO_READ = [SPECIFIC_CHARACTER_SET_TAG, DATASET_TYPE_TAG, STUDY_DATE_TAG, MODALITY_TAG, MANUFACTURER_TAG, 
+                SEX_TAG, AGE_TAG, BODY_PART_TAG, PROJECT_NAME_PRIVATE_TAG]
+_LAST_TAG_TO_READ = max(pydicom.tag.Tag(t) for t in TAGS_TO_READ)
+
+def _isAfterLastTagToRead(tag, VR, length) -> bool:
+    return tag > _LAST_TAG_TO_READ
+
 class Dicom:
-    def __init__(self, dicomFilePath):
-        self.dcm = pydicom.dcmread(dicomFilePath, stop_before_pixels=True, force=True)
+    def __init__(self, dicomFilePath, onlyRequiredTags = True):
+        '''
+        By default only the TAGS_TO_READ are parsed: the values of other elements are skipped (seek) 
+        and the reading stops as soon as the last of them is passed (the elements are sorted by tag in the file).
+        Set "onlyRequiredTags" to False to parse the whole header (until the pixel data).
+        '''
+        if onlyRequiredTags:
+            with open(dicomFilePath, 'rb') as f:
+                self.dcm = pydicom.filereader.read_partial(f, stop_when=_isAfterLastTagToRead, force=True, 
+                                                           specific_tags=[pydicom.tag.Tag(t) for t in TAGS_TO_READ])
+        else:
+            self.dcm = pydicom.dcmread(dicomFilePath, stop_before_pixels=True, force=True)
     
     def getFileName(self) -> str:
         return str(self.dcm.filename)
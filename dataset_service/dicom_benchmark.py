@@ -0,0 +1,69 @@
+'''
+Benchmark of the DICOM header reading: the targeted reading of the required tags (the default in dicom.Dicom)
+versus the parsing of the whole header until the pixel data.
+It also checks that the values obtained with both ways are the same.
+
+Usage (from the root directory of the repository):
+    python -m dataset_service.dicom_benchmark <directory with .dcm files (recursively) or .dcm files...> [--repetitions N]
+
+Note the first pass is just to warm up the page cache, so the results measure mostly the CPU of parsing.
+To measure the effect over a network file system (e.g. CephFS) drop the caches before running it
+or use a directory not recently read.
+'''
+import os
+import sys
+import time
+import argparse
+from dataset_service import dicom
+
+def _findDicomFiles(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirPath, dirNames, fileNames in os.walk(path):
+                dirNames.sort()
+                for name in sorted(fileNames):
+                    if name.lower().endswith(".dcm"): files.append(os.path.join(dirPath, name))
+        else: files.append(path)
+    return files
+
+def _getValues(dcm: dicom.Dicom):
+    return (dcm.getProject(), dcm.getAge(), dcm.getStudyDate(), dcm.getBodyPart(), dcm.getSex(),
+            dcm.getModality(), dcm.getDatasetType(), dcm.getManufacturer(), dcm.getDiagnosis())
+
+def _readAll(files, onlyRequiredTags):
+    start = time.perf_counter()
+    values = [_getValues(dicom.Dicom(f, onlyRequiredTags)) for f in files]
+    return time.perf_counter() - start, values
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the DICOM header reading.")
+    parser.add_argument("paths", nargs="+", help="directories (searched recursively) or DICOM files")
+    parser.add_argument("--repetitions", type=int, default=5)
+    args = parser.parse_args()
+
+    files = _findDicomFiles(args.paths)
+    if len(files) == 0:
+        print("No DICOM files found.")
+        return 1
+    print("Files: %d" % len(files))
+
+    # warm up and check the results are the same
+    _, fullValues = _readAll(files, onlyRequiredTags=False)
+    _, targetedValues = _readAll(files, onlyRequiredTags=True)
+    differences = [f for f, v1, v2 in zip(files, fullValues, targetedValues) if v1 != v2]
+    for f in differences: print("DIFFERENT VALUES: " + f)
+
+    best = {False: float("inf"), True: float("inf")}
+    for i in range(args.repetitions):
+        for onlyRequiredTags in (False, True):
+            seconds, _ = _readAll(files, onlyRequiredTags)
+            best[onlyRequiredTags] = min(best[onlyRequiredTags], seconds)
+
+    print("Whole header:   %8.2f ms per file" % (best[False] * 1000 / len(files)))
+    print("Required tags:  %8.2f ms per file" % (best[True] * 1000 / len(files)))
+    print("Speedup:        %8.2fx" % (best[False] / best[True]))
+    return 1 if len(differences) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
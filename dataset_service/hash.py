@@ -3,32 +3,79 @@ import base64
 import hashlib
 import json
 import logging
+import threading
+import concurrent.futures
 from datetime import datetime
 from .storage import DB, DBDatasetsOperator
 
+def _adviseSequentialRead(fd):
+    ''' Hint the kernel to read ahead aggressively (just advisory, ignored if not supported). '''
+    if not hasattr(os, 'posix_fadvise'): return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except OSError: pass
+
+# Buffer for the file reads of each thread, reused for all the files hashed by it.
+_readBuffers = threading.local()
+
+def _getReadBuffer(size: int) -> memoryview:
+    buffer = getattr(_readBuffers, "buffer", None)
+    if buffer is None or len(buffer) != size:
+        buffer = memoryview(bytearray(size))
+        _readBuffers.buffer = buffer
+    return buffer
+
 class sha3:
-    def __init__(self, b: bytes=b''):
+    DEFAULT_READ_BUFFER_SIZE = 1048576  # 1MiB
+
+    def __init__(self, b: bytes=b'', readBufferSize: int | None = None):
         self._sha = hashlib.sha3_256(b)
+        self._readBufferSize = readBufferSize if readBufferSize else sha3.DEFAULT_READ_BUFFER_SIZE
 
-    def updateWithFile(self, filePath: str):
+    def updateWithFile(self, filePath: str, fileSha = None):
+        ''' "fileSha" is an optional additional hash object to update with the same contents (to get also the hash of the file). '''
         # We use a buffer to avoid load the complete file contents in memory, 
         # which can be a problem on big files.
-        BUF_SIZE = 65536  # 64kb
-        with open(filePath, 'rb') as f:
+        # The same buffer is reused (readinto) for all the chunks and files hashed by the thread, to avoid allocating 
+        # a new bytes object for each chunk, and the file is opened unbuffered to avoid another copy in the buffer of the file object.
+        buffer = _getReadBuffer(self._readBufferSize)
+        with open(filePath, 'rb', buffering=0) as f:
+            _adviseSequentialRead(f.fileno())
             while True:
-                data = f.read(BUF_SIZE)
-                if not data: break
-                self._sha.update(data)
+                n = f.readinto(buffer)
+                if not n: break
+                self._sha.update(buffer[:n])
+                if fileSha != None: fileSha.update(buffer[:n])
+
+    def _updateWithFileForManifest(self, filePath: str, relativePath: str, manifest: list, previousManifest: dict | None):
+        # The file contents are always read (the hash of the directory is the hash of all the contents),
+        # but the hash of the file is only calculated if its size or modification time have changed.
+        st = os.stat(filePath)
+        previous = previousManifest.get(relativePath) if previousManifest != None else None
+        if previous != None and previous[0] == st.st_size and previous[1] == st.st_mtime_ns:
+            self.updateWithFile(filePath)
+            fileHash = previous[2]
+        else:
+            fileSha = hashlib.sha3_256()
+            self.updateWithFile(filePath, fileSha)
+            fileHash = fileSha.digest()
+        manifest.append((relativePath, st.st_size, st.st_mtime_ns, fileHash))
 
-    def updateWithDirectoryContents(self, dirPath, notifyProgress = None):
+    def updateWithDirectoryContents(self, dirPath, notifyProgress = None, manifest = None, previousManifest = None, _relativeDirPath = ''):
+        '''
+        "manifest" is an optional (empty) list that will be filled with a tuple (relativePath, size, mtime_ns, hash) for each file.
+        "previousManifest" is an optional dict {relativePath: (size, mtime_ns, hash)} to reuse the hashes of unchanged files.
+        '''
         filesList = os.listdir(dirPath)
         # The order is important to obtain the correct hash.
         # Also recomendable: filter by extension (.dcm) if there are other files that can change.
         filesList.sort()
         for name in filesList:
             filePath = os.path.join(dirPath, name)
-            if os.path.isdir(filePath): self.updateWithDirectoryContents(filePath, notifyProgress)
-            else:                       self.updateWithFile(filePath)
+            relativePath = os.path.join(_relativeDirPath, name)
+            if os.path.isdir(filePath): self.updateWithDirectoryContents(filePath, notifyProgress, manifest, previousManifest, relativePath)
+            elif manifest is None:      self.updateWithFile(filePath)
+            else:                       self._updateWithFileForManifest(filePath, relativePath, manifest, previousManifest)
             if notifyProgress != None: 
                 stop = notifyProgress('')
                 if stop: return
@@ -61,14 +108,88 @@ def _getHashOfFile(filePath: str) -> bytes:
     sha.updateWithFile(filePath)
     return sha.getDigest()
 
-def _getHashOfDirectory(dirPath, notifyProgress = None):
-    sha = sha3()
-    sha.updateWithDirectoryContents(dirPath, notifyProgress)
+def _getHashOfDirectory(dirPath, notifyProgress = None, readBufferSize = None, manifest = None, previousManifest = None):
+    sha = sha3(readBufferSize=readBufferSize)
+    sha.updateWithDirectoryContents(dirPath, notifyProgress, manifest, previousManifest)
     if notifyProgress != None: 
         stop = notifyProgress('')
         if stop: return None
     return sha.getDigest()
 
+def _getFingerprintOfDirectory(dirPath) -> str | None:
+    '''
+    Cheap fingerprint of the directory contents (recursively), collected in one scandir pass without reading any file:
+    number of files, total size in bytes, max modification time and max status change time (in nanoseconds).
+    The times of the subdirectories (including dirPath) are also considered, to detect renamed or removed files.
+    Returns None if the directory does not exist.
+    '''
+    count, totalSize = 0, 0
+    try:
+        st = os.stat(dirPath)
+    except FileNotFoundError: return None
+    maxMTime, maxCTime = st.st_mtime_ns, st.st_ctime_ns
+    pendingDirs = [dirPath]
+    while len(pendingDirs) > 0:
+        with os.scandir(pendingDirs.pop()) as it:
+            for entry in it:
+                st = entry.stat()
+                if entry.is_dir(): pendingDirs.append(entry.path)
+                else:
+                    count += 1
+                    totalSize += st.st_size
+                maxMTime = max(maxMTime, st.st_mtime_ns)
+                maxCTime = max(maxCTime, st.st_ctime_ns)
+    return "%d:%d:%d:%d" % (count, totalSize, maxMTime, maxCTime)
+
+def _getAlteredFilesInManifest(previousManifest: dict, manifest: list) -> list[str]:
+    ''' Compares the manifests of a directory, returns the relative paths of files modified, added or removed. '''
+    altered = []
+    currentPaths = set()
+    for relativePath, size, mtime, fileHash in manifest:
+        currentPaths.add(relativePath)
+        previous = previousManifest.get(relativePath)
+        if previous is None: altered.append(relativePath + " (added)")
+        elif bytes(previous[2]) != bytes(fileHash): altered.append(relativePath + " (modified)")
+    for relativePath in previousManifest.keys():
+        if not relativePath in currentPaths: altered.append(relativePath + " (removed)")
+    return altered
+
+def _checkCachedHashOfSeries(cachedEntry, currentFingerprint, cacheLifeDays, seriesDirName):
+    ''' 
+    "cachedEntry" is the tuple (hash, last_time_calculated, fingerprint) stored in the cache (all None if not cached).
+    Returns the hash cached if still valid (or None) and the residual hash cached (maybe outdated, or None).
+    The cached hash is valid if the fingerprint stored with it is the same as the current one, whatever its age.
+    If there is no fingerprint stored (hash cached by previous versions) or the directory does not exist (no current fingerprint),
+    then it is valid only during cacheLifeDays (like before the fingerprints).
+    '''
+    seriesHash, last_time_calculated, fingerprint = cachedEntry
+    if seriesHash is None: return None, None
+    if fingerprint != None and currentFingerprint != None:
+        if fingerprint == currentFingerprint: return seriesHash, seriesHash
+        logging.root.debug('Fingerprint of series changed, the SHA must be calculated again: %s' % seriesDirName)
+        return None, seriesHash
+    if last_time_calculated != None and (datetime.now() - last_time_calculated).days <= cacheLifeDays: 
+        #logging.root.debug('Cached SHA of series: %s' % seriesDirName)
+        return seriesHash, seriesHash
+    return None, seriesHash
+
+def _getHashOfSeriesDirectory(seriesDirPath, cachedEntry, cacheLifeDays, stopEvent = None, readBufferSize = None, 
+                              withManifest = False, previousManifest = None):
+    ''' 
+    Worker task for the pool of datasetHashesOperator (must be a module-level function to be picklable).
+    The fingerprint of the directory is collected here too (it is also I/O), to check the cached hash 
+    and calculate the hash only if not valid.
+    Returns the hash (None if stopped), the residual hash cached, the fingerprint, 
+    the manifest (or None if not "withManifest") and whether the hash has been calculated (False if taken from the cache).
+    '''
+    fingerprint = _getFingerprintOfDirectory(seriesDirPath)
+    seriesHash, residualSeriesHash = _checkCachedHashOfSeries(cachedEntry, fingerprint, cacheLifeDays, os.path.basename(seriesDirPath))
+    if seriesHash != None: return seriesHash, residualSeriesHash, fingerprint, None, False
+    manifest = [] if withManifest else None
+    notifyProgress = None if stopEvent is None else lambda msg, log=True: stopEvent.is_set()
+    seriesHash = _getHashOfDirectory(seriesDirPath, notifyProgress, readBufferSize, manifest, previousManifest)
+    return seriesHash, residualSeriesHash, fingerprint, manifest, True
+
 def getHashOfString(s):
     return _bytesToBase64String(_getHashOfString(s))
 
@@ -77,28 +198,123 @@ def getHashOfFile(filePath):
 
 
 class datasetHashesOperator:
-    def __init__(self, dbconfig, series_hash_cache_life_days):
+    # Time between checks of the notifyProgress callback (for cancelation) while waiting for the workers.
+    WAIT_POLL_SECONDS = 1
+    # Number of new series hashes accumulated in memory before writing them to the cache in DB.
+    SERIES_HASH_CACHE_WRITE_BATCH_SIZE = 200
+
+    def __init__(self, dbconfig, series_hash_cache_life_days, workers = 1, workers_mode = "thread", read_buffer_size = None, 
+                 with_manifest = False):
+        '''
+        "workers" is the number of series hashed concurrently (0 or 1 to hash them serially in the calling thread).
+        "workers_mode" can be "thread" or "process".
+        "read_buffer_size" is the size in bytes of the chunks read from the files (None for the default).
+        "with_manifest" enables the manifest of series (the hash, size and modification time of each file stored along with 
+        the hash of the series), which allows to identify the files altered when the hash of a series changes.
+        '''
         self.log = logging.root
         self.dbconfig = dbconfig
         self.series_hash_cache_life_days = series_hash_cache_life_days
+        if workers_mode not in ("thread", "process"): raise Exception("Unknown workers mode for hashing: %s" % workers_mode)
+        self.workers = workers
+        self.workers_mode = workers_mode
+        self.read_buffer_size = read_buffer_size
+        self.with_manifest = with_manifest
+        # Filled with dict(studyId, series, files) for each series whose hash has changed since the last time cached,
+        # in the last call to getHashOfDatasetImages() or getHashesOfDataset().
+        self.alteredSeries = []
+        # In-memory copy of the series hash cache (and the manifests if enabled), loaded in bulk for all the studies of a dataset 
+        # (None when not loaded, then the DB is queried for each series).
+        self._seriesHashCache = None
+        self._seriesHashManifests = None
+        self._seriesHashCachePendingWrites = []
+        self._seriesHashManifestPendingWrites = []
 
-    def _getHashOfSeries(self, studyId, studyDirPath, seriesDirName, notifyProgress = None):
+    def _loadSeriesHashCache(self, studies):
         with DB(self.dbconfig) as db:
-            seriesHash, last_time_calculated = DBDatasetsOperator(db).getSeriesHashCache(studyId, seriesDirName)
-            if seriesHash != None and last_time_calculated != None \
-               and (datetime.now() - last_time_calculated).days <= self.series_hash_cache_life_days: 
-                #logging.root.debug('Cached SHA of series: %s' % seriesDirName)
-                return seriesHash
+            dbdatasets = DBDatasetsOperator(db)
+            studyIds = [study["studyId"] for study in studies]
+            self._seriesHashCache = dbdatasets.getSeriesHashCacheOfStudies(studyIds)
+            if self.with_manifest: self._seriesHashManifests = dbdatasets.getSeriesHashManifestsOfStudies(studyIds)
+        self._seriesHashCachePendingWrites = []
+        self._seriesHashManifestPendingWrites = []
 
-        seriesDirPath = os.path.join(studyDirPath, seriesDirName)
-        newSeriesHash = _getHashOfDirectory(seriesDirPath, notifyProgress)
-        if newSeriesHash is None: return None   # the process has been stopped
+    def _flushSeriesHashCache(self):
+        if len(self._seriesHashCachePendingWrites) == 0 and len(self._seriesHashManifestPendingWrites) == 0: return
+        with DB(self.dbconfig) as db:
+            dbdatasets = DBDatasetsOperator(db)
+            dbdatasets.setSeriesHashCacheBulk(self._seriesHashCachePendingWrites)
+            dbdatasets.setSeriesHashManifestBulk(self._seriesHashManifestPendingWrites)
+        self._seriesHashCachePendingWrites = []
+        self._seriesHashManifestPendingWrites = []
+
+    def _unloadSeriesHashCache(self):
+        self._flushSeriesHashCache()
+        self._seriesHashCache = None
+        self._seriesHashManifests = None
+
+    def _getCachedEntryOfSeries(self, studyId, seriesDirName):
+        ''' Returns the tuple (hash, last_time_calculated, fingerprint) stored in the cache (all None if not cached). '''
+        if self._seriesHashCache != None:
+            seriesHash, last_time_calculated, fingerprint = self._seriesHashCache.get((studyId, seriesDirName), (None, None, None))
+        else:
+            with DB(self.dbconfig) as db:
+                seriesHash, last_time_calculated, fingerprint = DBDatasetsOperator(db).getSeriesHashCache(studyId, seriesDirName)
+        # bytes instead of the memoryview returned by psycopg2 (which can't be pickled to be sent to the process workers)
+        if seriesHash != None: seriesHash = bytes(seriesHash)
+        return seriesHash, last_time_calculated, fingerprint
+
+    def _getPreviousManifestOfSeries(self, studyId, seriesDirName) -> dict | None:
+        if not self.with_manifest: return None
+        if self._seriesHashManifests != None:
+            manifest = self._seriesHashManifests.get((studyId, seriesDirName))
+        else:
+            with DB(self.dbconfig) as db:
+                manifest = DBDatasetsOperator(db).getSeriesHashManifest(studyId, seriesDirName)
+        if manifest is None: return None
+        return {relativePath: (size, mtime, base64.b64decode(fileHash)) for relativePath, size, mtime, fileHash in manifest}
+
+    def _setCachedHashOfSeries(self, studyId, seriesDirName, newSeriesHash, residualSeriesHash, fingerprint, 
+                               manifest = None, previousManifest = None):
         # let's take the chance to warn if the hash has been altered since last time calculated (outdated cache)
-        if seriesHash != None and base64.b64encode(newSeriesHash) != base64.b64encode(seriesHash): 
+        if residualSeriesHash != None and base64.b64encode(newSeriesHash) != base64.b64encode(residualSeriesHash): 
             logging.root.warn('Altered SHA of series (in residual cache): %s' % seriesDirName)
+            alteredFiles = None
+            if manifest != None and previousManifest != None:
+                alteredFiles = _getAlteredFilesInManifest(previousManifest, manifest)
+                for f in alteredFiles: logging.root.warn('  Altered file: %s' % f)
+            self.alteredSeries.append(dict(studyId = studyId, series = seriesDirName, files = alteredFiles))
         # Anotate the new hash or refresh the last time calculated
-        with DB(self.dbconfig) as db:
-            DBDatasetsOperator(db).setSeriesHashCache(studyId, seriesDirName, newSeriesHash, datetime.now())
+        now = datetime.now()
+        manifestToStore = None if manifest is None else \
+                          [[relativePath, size, mtime, _bytesToBase64String(fileHash)] for relativePath, size, mtime, fileHash in manifest]
+        if self._seriesHashCache != None:
+            self._seriesHashCache[(studyId, seriesDirName)] = (newSeriesHash, now, fingerprint)
+            self._seriesHashCachePendingWrites.append((studyId, seriesDirName, newSeriesHash, now, fingerprint))
+            if manifestToStore != None:
+                self._seriesHashManifestPendingWrites.append((studyId, seriesDirName, manifestToStore))
+                if self._seriesHashManifests != None: self._seriesHashManifests[(studyId, seriesDirName)] = manifestToStore
+            if len(self._seriesHashCachePendingWrites) >= self.SERIES_HASH_CACHE_WRITE_BATCH_SIZE:
+                self._flushSeriesHashCache()
+        else:
+            with DB(self.dbconfig) as db:
+                dbdatasets = DBDatasetsOperator(db)
+                dbdatasets.setSeriesHashCache(studyId, seriesDirName, newSeriesHash, now, fingerprint)
+                if manifestToStore != None:
+                    dbdatasets.setSeriesHashManifestBulk([(studyId, seriesDirName, manifestToStore)])
+
+    def _getHashOfSeries(self, studyId, studyDirPath, seriesDirName, notifyProgress = None):
+        seriesDirPath = os.path.join(studyDirPath, seriesDirName)
+        fingerprint = _getFingerprintOfDirectory(seriesDirPath)
+        seriesHash, residualSeriesHash = _checkCachedHashOfSeries(self._getCachedEntryOfSeries(studyId, seriesDirName), fingerprint, 
+                                                                  self.series_hash_cache_life_days, seriesDirName)
+        if seriesHash != None: return seriesHash
+
+        previousManifest = self._getPreviousManifestOfSeries(studyId, seriesDirName)
+        manifest = [] if self.with_manifest else None
+        newSeriesHash = _getHashOfDirectory(seriesDirPath, notifyProgress, self.read_buffer_size, manifest, previousManifest)
+        if newSeriesHash is None: return None   # the process has been stopped
+        self._setCachedHashOfSeries(studyId, seriesDirName, newSeriesHash, residualSeriesHash, fingerprint, manifest, previousManifest)
         return newSeriesHash
 
     def _getHashOfStudy(self, studyId, seriesList, studyDirPath, notifyProgress = None):
@@ -110,6 +326,18 @@ class datasetHashesOperator:
         return sha.getDigest()
 
     def _getHashOfDatasetImages(self, datasetDirPath, studies, studiesHashes = None, notifyProgress = None):
+        # The cached hashes (and manifests) of all the series are loaded in one query at the beginning,
+        # and the new ones are written in batches (also the pending ones if the process is stopped, to be able to resume it).
+        self._loadSeriesHashCache(studies)
+        self.alteredSeries = []
+        try:
+            if self.workers > 1:
+                return self._getHashOfDatasetImagesConcurrently(datasetDirPath, studies, studiesHashes, notifyProgress)
+            return self._getHashOfDatasetImagesSerially(datasetDirPath, studies, studiesHashes, notifyProgress)
+        finally:
+            self._unloadSeriesHashCache()
+
+    def _getHashOfDatasetImagesSerially(self, datasetDirPath, studies, studiesHashes = None, notifyProgress = None):
         sha = sha3()
         total = len(studies)
         count = 0
@@ -126,6 +354,75 @@ class datasetHashesOperator:
             sha.updateWithBytes(studyHash)
         return sha.getDigest()
 
+    def _waitForSeriesHash(self, future, notifyProgress = None):
+        ''' Waits for the result of a worker (see _getHashOfSeriesDirectory), checking periodically if the process has been stopped 
+            (then returns None). '''
+        while True:
+            done, notDone = concurrent.futures.wait([future], timeout=self.WAIT_POLL_SECONDS)
+            if len(done) > 0: return future.result()
+            if notifyProgress != None: 
+                stop = notifyProgress('')
+                if stop: return None
+
+    def _getHashOfDatasetImagesConcurrently(self, datasetDirPath, studies, studiesHashes = None, notifyProgress = None):
+        '''
+        Same result as the serial way, but the series are checked (fingerprint) and hashed if required in a pool of workers.
+        The workers only access the files: the cache is consulted and updated here, in the calling thread,
+        and the hashes of series and studies are combined in exactly the same order (the order of the lists).
+        '''
+        if self.workers_mode == "process":
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            stopEvent = None   # the running tasks can't be interrupted, but the pending ones are canceled
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hash")
+            stopEvent = threading.Event()
+        try:
+            # Submit all the series, in order, so the workers read them roughly in the order they will be combined.
+            tasks = []   # for each study, the list of (seriesDirName, previousManifest, future)
+            for study in studies:
+                studyDirPath = os.path.join(datasetDirPath, study['path'])
+                studyTasks = []
+                for series in study["series"]:
+                    seriesDirName = series["folderName"]
+                    seriesDirPath = os.path.join(studyDirPath, seriesDirName)
+                    previousManifest = self._getPreviousManifestOfSeries(study["studyId"], seriesDirName)
+                    future = executor.submit(_getHashOfSeriesDirectory, seriesDirPath, 
+                                             self._getCachedEntryOfSeries(study["studyId"], seriesDirName), 
+                                             self.series_hash_cache_life_days, stopEvent, self.read_buffer_size, 
+                                             self.with_manifest, previousManifest)
+                    studyTasks.append((seriesDirName, previousManifest, future))
+                tasks.append(studyTasks)
+                if notifyProgress != None: 
+                    stop = notifyProgress('')
+                    if stop: return None
+
+            sha = sha3()
+            total = len(studies)
+            count = 0
+            for study, studyTasks in zip(studies, tasks):
+                count += 1
+                logging.root.debug('Calculating SHA of study (%d/%d) [%s] ...' % (count, total, study['path']))
+                if notifyProgress != None and (count == 1 or count % 2 == 0):
+                    notifyProgress('Calculating SHA of study %d of %d) ...' % (count, total), log=False)
+                studySha = sha3()
+                for seriesDirName, previousManifest, future in studyTasks:
+                    result = self._waitForSeriesHash(future, notifyProgress)
+                    if result is None or result[0] is None: return None   # the process has been stopped
+                    seriesHash, residualSeriesHash, fingerprint, manifest, calculated = result
+                    if calculated:
+                        self._setCachedHashOfSeries(study["studyId"], seriesDirName, seriesHash, residualSeriesHash, fingerprint,
+                                                    manifest, previousManifest)
+                    studySha.updateWithBytes(seriesHash)
+                studyHash = studySha.getDigest()
+                if studiesHashes != None: studiesHashes.append(dict(studyId = study["studyId"], 
+                                                                    hash = _bytesToBase64String(studyHash)))
+                sha.updateWithBytes(studyHash)
+            return sha.getDigest()
+        finally:
+            # If stopped (or any error), the pending tasks are canceled and the running ones notified to end as soon as possible.
+            if stopEvent != None: stopEvent.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
     def getHashOfSeries(self, datasetDirPath, studyId, studyPath, seriesDirName):
         studyDirPath = os.path.join(datasetDirPath, studyPath)
         seriesHash = self._getHashOfSeries(studyId, studyDirPath, seriesDirName)
@@ -0,0 +1,137 @@
+'''
+Incremental reading of JSON documents from a stream, to process big inputs (like the list of studies of a dataset)
+item by item, without loading the whole document (and all the objects) in memory.
+Example, for a document like {"name": "...", "studies": [{...}, {...}, ...]}:
+
+    reader = JSONStreamReader(inputStream)
+    for key in reader.iterObject():
+        if key == "studies":
+            for study in reader.iterArray(): process(study)
+        else: properties[key] = reader.readValue()
+    reader.end()
+
+The errors in the document are raised as json.JSONDecodeError (the position is the char offset from the beginning of the document).
+'''
+import json
+import codecs
+
+class JSONStreamDecodeError(json.JSONDecodeError):
+    def __init__(self, msg: str, pos: int):
+        ValueError.__init__(self, "%s: char %d" % (msg, pos))
+        self.msg = msg
+        self.doc = ''
+        self.pos = pos
+        self.lineno = 0
+        self.colno = 0
+
+    def __reduce__(self):
+        return self.__class__, (self.msg, self.pos)
+
+_WHITESPACE = ' \t\n\r'
+_DELIMITERS = _WHITESPACE + ',:]}'
+
+class JSONStreamReader:
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, inputStream, maxSize: int = -1):
+        ''' inputStream: binary file-like object with a read(size) method, the content must be encoded in UTF-8.
+            maxSize: max number of bytes to read from inputStream (-1 to read until the end),
+                     useful when the stream is the body of an HTTP request.
+        '''
+        self._inputStream = inputStream
+        self._remaining = maxSize
+        self._textDecoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self._jsonDecoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0          # position in buffer
+        self._offset = 0       # chars of the document discarded from the buffer
+        self._eof = False
+
+    def _read(self, size: int) -> bool:
+        ''' Appends to the buffer at least size bytes (if not eof) and discards the already consumed part.
+            Returns False if the end of the stream has been reached before. '''
+        if self._eof: return False
+        if self._remaining >= 0: size = min(size, self._remaining)
+        data = self._inputStream.read(size) if size > 0 else b''
+        if self._remaining >= 0: self._remaining -= len(data)
+        if self._pos > 0:
+            self._offset += self._pos
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        if len(data) == 0:
+            self._eof = True
+            try:
+                self._buffer += self._textDecoder.decode(b'', final=True)
+            except UnicodeDecodeError: raise self._error("Invalid UTF-8 content", len(self._buffer))
+            return False
+        try:
+            self._buffer += self._textDecoder.decode(data)
+        except UnicodeDecodeError: raise self._error("Invalid UTF-8 content", len(self._buffer))
+        return True
+
+    def _error(self, msg: str, pos: int | None = None):
+        return JSONStreamDecodeError(msg, self._offset + (self._pos if pos is None else pos))
+
+    def peek(self) -> str:
+        ''' Returns the next char (not whitespace) without consuming it, or empty string at the end of the document. '''
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE: self._pos += 1
+            if self._pos < len(self._buffer): return self._buffer[self._pos]
+            if not self._read(self.CHUNK_SIZE): return ''
+
+    def _expect(self, char: str, description: str):
+        if self.peek() != char: raise self._error("Expecting " + description)
+        self._pos += 1
+
+    def readValue(self):
+        ''' Reads and returns the next value (object, array, string, number, true, false or null) entirely. '''
+        if self.peek() == '': raise self._error("Expecting value")
+        while True:
+            try:
+                value, end = self._jsonDecoder.raw_decode(self._buffer, self._pos)
+                # If the value is not followed by a delimiter it may be incomplete (i.e. a number), unless the stream has ended.
+                if self._eof or (end < len(self._buffer) and self._buffer[end] in _DELIMITERS):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self._eof: raise self._error(e.msg, e.pos)
+            # Read at least as much as pending, to not decode again and again a big value.
+            self._read(max(self.CHUNK_SIZE, len(self._buffer) - self._pos))
+
+    def iterObject(self):
+        ''' Iterates the keys of the next value, which must be an object.
+            The value of each key must be consumed (with readValue, iterArray or iterObject) before the next iteration. '''
+        self._expect('{', "'{'")
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            if self.peek() != '"': raise self._error("Expecting property name enclosed in double quotes")
+            key = self.readValue()
+            self._expect(':', "':' delimiter")
+            yield key
+            char = self.peek()
+            self._pos += 1
+            if char == '}': return
+            if char != ',':
+                self._pos -= 1
+                raise self._error("Expecting ',' delimiter")
+
+    def iterArray(self):
+        ''' Iterates the items of the next value, which must be an array. Each item is read entirely with readValue. '''
+        self._expect('[', "'['")
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.readValue()
+            char = self.peek()
+            self._pos += 1
+            if char == ']': return
+            if char != ',':
+                self._pos -= 1
+                raise self._error("Expecting ',' delimiter")
+
+    def end(self):
+        ''' Checks there is nothing more than whitespace after the document. '''
+        if self.peek() != '': raise self._error("Extra data")
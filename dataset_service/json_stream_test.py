@@ -0,0 +1,57 @@
+import io
+import json
+import unittest
+from dataset_service.json_stream import JSONStreamReader, JSONStreamDecodeError
+
+DOC = {"name": "ds1", "size": 12345, "studies": [{"studyId": "1", "series": ["a", "b"]}, {"studyId": "2", "n": -1.5e3}, "é€"],
+       "empty": [], "emptyObject": {}, "flags": [True, False, None]}
+
+def _reader(text: str, chunkSize: int = 3, maxSize: int = -1) -> JSONStreamReader:
+    reader = JSONStreamReader(io.BytesIO(text.encode()), maxSize)
+    reader.CHUNK_SIZE = chunkSize   # small chunks to cut the values and the multibyte chars
+    return reader
+
+def _readDocument(reader: JSONStreamReader) -> dict:
+    properties = {}
+    for key in reader.iterObject():
+        if key == "studies": properties[key] = list(reader.iterArray())
+        else: properties[key] = reader.readValue()
+    reader.end()
+    return properties
+
+class JSONStreamReaderTest(unittest.TestCase):
+    def test_readDocument(self):
+        for chunkSize in [1, 2, 3, 7, 64 * 1024]:
+            for text in [json.dumps(DOC), json.dumps(DOC, indent=4, ensure_ascii=False)]:
+                self.assertEqual(_readDocument(_reader(text, chunkSize)), DOC, msg="%d %s" % (chunkSize, text))
+
+    def test_numberAtTheEndOfChunk(self):
+        # "12345" must not be read as 1 or 12 when the chunk ends inside the number
+        reader = _reader('[12345, 6]', 2)
+        self.assertEqual(list(reader.iterArray()), [12345, 6])
+        reader = _reader('12345', 2)
+        self.assertEqual(reader.readValue(), 12345)
+        reader.end()
+
+    def test_bom(self):
+        reader = JSONStreamReader(io.BytesIO(b'\xef\xbb\xbf' + json.dumps(DOC).encode()))
+        self.assertEqual(_readDocument(reader), DOC)
+
+    def test_maxSize(self):
+        text = '{"a": 1}'
+        self.assertEqual(_readDocument(_reader(text + 'garbage', 3, len(text))), {"a": 1})
+        with self.assertRaises(JSONStreamDecodeError): _readDocument(_reader(text, 3, len(text) - 1))
+
+    def test_errors(self):
+        for text, pos in [('{"a": 1,}', 8), ('{"a" 1}', 5), ('{"a": 1 "b": 2}', 8), ('{"studies": [1 2]}', 15), ('{"studies": [1, 2', 17),
+                          ('{"a": tru}', 6), ('{"a": 1} x', 9), ('', 0), ('{', 1), ('[1]', 0), ('{a: 1}', 1)]:
+            with self.assertRaises(json.JSONDecodeError, msg=text) as cm:
+                _readDocument(_reader(text))
+            self.assertEqual(cm.exception.pos, pos, msg=text)
+
+    def test_invalidUtf8(self):
+        with self.assertRaises(json.JSONDecodeError):
+            list(JSONStreamReader(io.BytesIO(b'["a\xff"]')).iterArray())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,31 +1,437 @@
+import os
+import time
+import zlib
+import base64
+import json
 import logging
+import threading
+import itertools
+import weakref
+from datetime import datetime
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+from psycopg2 import sql
+
+class _ConnectionPool:
+    '''
+    Thread-safe pool of connections (over psycopg2 ThreadedConnectionPool) which waits for a free connection 
+    instead of failing when all of them are in use, and checks the connections before handing them out:
+    the closed or broken ones are replaced, the ones idle for too long are recycled (closed and replaced by new ones)
+    and the ones idle for some time are checked with a trivial query.
+    '''
+    ACQUIRE_TIMEOUT_SECONDS = 60
 
-class DB:
     def __init__(self, dbConfig):
-        self.conn = psycopg2.connect(host=dbConfig.host, port=dbConfig.port, 
-                                     dbname=dbConfig.dbname, user=dbConfig.user, password=dbConfig.password)
-        self.cursor = self.conn.cursor()
+        self._pool = psycopg2.pool.ThreadedConnectionPool(dbConfig.pool_min_size, dbConfig.pool_max_size,
+                                                          host=dbConfig.host, port=dbConfig.port, dbname=dbConfig.dbname, 
+                                                          user=dbConfig.user, password=dbConfig.password)
+        self._available = threading.BoundedSemaphore(dbConfig.pool_max_size)
+        self._maxSize = dbConfig.pool_max_size
+        self._maxIdleSeconds = dbConfig.pool_max_idle_seconds
+        self._healthCheckIdleSeconds = dbConfig.pool_health_check_idle_seconds
+        # conn -> time when it was returned to the pool (weak keys: the entries of the discarded connections disappear with them)
+        self._lastUseTime = weakref.WeakKeyDictionary()
+        self._lastUseTimeLock = threading.Lock()
+
+    @staticmethod
+    def _isAlive(conn) -> bool:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _isUsable(self, conn) -> bool:
+        if conn.closed: return False
+        with self._lastUseTimeLock:
+            lastUseTime = self._lastUseTime.pop(conn, None)
+        if lastUseTime is None: return True   # new connection
+        idleSeconds = time.monotonic() - lastUseTime
+        if self._maxIdleSeconds > 0 and idleSeconds > self._maxIdleSeconds: return False
+        if self._healthCheckIdleSeconds > 0 and idleSeconds > self._healthCheckIdleSeconds: return self._isAlive(conn)
+        return True
+
+    def getconn(self):
+        if not self._available.acquire(timeout=self.ACQUIRE_TIMEOUT_SECONDS):
+            raise Exception("Timeout waiting for a free connection to the database (pool_max_size: %d)." % self._maxSize)
+        try:
+            # The idle connections are checked until a usable one is found, when none is left a new one is created.
+            while True:
+                conn = self._pool.getconn()
+                if self._isUsable(conn): return conn
+                logging.root.debug("Discarding a DB connection from the pool (closed, broken or idle for too long).")
+                self._discard(conn)
+        except:
+            self._available.release()
+            raise
+
+    def putconn(self, conn):
+        ''' The connection is rolled back if there is a transaction in progress, and closed if broken. '''
+        try:
+            broken = conn.closed or conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+            if broken: self._discard(conn)
+            else:
+                with self._lastUseTimeLock:
+                    self._lastUseTime[conn] = time.monotonic()
+                self._pool.putconn(conn)
+        finally:
+            self._available.release()
+
+    def _discard(self, conn):
+        with self._lastUseTimeLock:
+            self._lastUseTime.pop(conn, None)
+        self._pool.putconn(conn, close=True)
+
+    def closeall(self):
+        self._pool.closeall()
+        with self._lastUseTimeLock:
+            self._lastUseTime.clear()
+
+
+_pools = {}
+_poolsLock = threading.Lock()
+
+def _getConnectionKey(dbConfig):
+    return (dbConfig.host, dbConfig.port, dbConfig.dbname, dbConfig.user)
+
+def _getConnectionPool(dbConfig) -> _ConnectionPool | None:
+    ''' Returns the process-wide pool for that DB config (created in the first use), or None if pooling is disabled. '''
+    if dbConfig.pool_max_size <= 0: return None
+    # The pid is included because the connections can not be shared with child processes (forked).
+    key = (os.getpid(),) + _getConnectionKey(dbConfig)
+    with _poolsLock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _ConnectionPool(dbConfig)
+            _pools[key] = pool
+        return pool
+
+def closeConnectionPools():
+    with _poolsLock:
+        for key, pool in list(_pools.items()):
+            if key[0] == os.getpid(): pool.closeall()
+            del _pools[key]
+
+def _openConnection(dbConfig):
+    ''' Returns the connection and the pool where it must be released (None if pooling is disabled). '''
+    pool = _getConnectionPool(dbConfig)
+    if pool is None:
+        return psycopg2.connect(host=dbConfig.host, port=dbConfig.port, 
+                                dbname=dbConfig.dbname, user=dbConfig.user, password=dbConfig.password), None
+    return pool.getconn(), pool
+
+def _releaseConnection(conn, pool):
+    if pool is None: conn.close()
+    else: pool.putconn(conn)
+
+
+_sessions = threading.local()
+
+class DBSession:
+    '''
+    Scope (a request, a job...) in which all the DB objects created by the current thread for the same database
+    share one connection, which is taken lazily (on the first use) and released at the end of the scope.
+    The transactions are kept: each outermost DB block commits (or rolls back) at its end, and the nested DB blocks 
+    join its transaction (with a savepoint to discard only their work in case of exception).
+    At the end of the scope, if some DB object was not closed, its work is committed (or rolled back on exception).
+    Sessions can be nested: the inner ones just continue the outermost.
+    Usage:
+        with DBSession():
+            with DB(dbConfig) as db: ...
+            with DB(dbConfig) as db: ...   # same connection
+    '''
+    def __init__(self):
+        self._active = False
+        self._conn = None
+        self._pool = None
+        self._key = None
+        self._depth = 0   # number of DB objects currently opened in the session
+        self._lastUseTime = None
 
     def __enter__(self):
+        if getattr(_sessions, "current", None) is None:
+            _sessions.current = self
+            self._active = True
         return self
 
     def __exit__(self, type, value, tb):
-        if tb is None:
-            # No exception, so commit
-            self.conn.commit()
+        if not self._active: return False
+        _sessions.current = None
+        self._active = False
+        if self._conn is None: return False
+        try:
+            if self._depth > 0:
+                if tb is None: self._conn.commit()
+                else: self._conn.rollback()
+        finally:
+            _releaseConnection(self._conn, self._pool)
+            self._conn = None
+            self._depth = 0
+        return False   # if an exception has been raised then it will be re-raised
+
+    def _acquire(self, dbConfig):
+        ''' Returns the connection of the session, or None if it is for another database. '''
+        key = _getConnectionKey(dbConfig)
+        if self._conn is not None and self._depth == 0 and key == self._key and not self._isUsable(dbConfig):
+            # broken while idle (the session can last long, e.g. in a job), let's replace it
+            logging.root.debug("Replacing the broken DB connection of the session.")
+            _releaseConnection(self._conn, self._pool)
+            self._conn = None
+        if self._conn is None:
+            self._conn, self._pool = _openConnection(dbConfig)
+            self._key = key
+        elif key != self._key: return None
+        self._depth += 1
+        return self._conn
+
+    def _isUsable(self, dbConfig) -> bool:
+        if self._conn.closed: return False
+        checkIdleSeconds = dbConfig.pool_health_check_idle_seconds
+        if checkIdleSeconds > 0 and time.monotonic() - self._lastUseTime > checkIdleSeconds: 
+            return _ConnectionPool._isAlive(self._conn)
+        return True
+
+    def _release(self):
+        self._depth -= 1
+        self._lastUseTime = time.monotonic()
+
+    @staticmethod
+    def getCurrent():
+        return getattr(_sessions, "current", None)
+
+
+class PageCursorException(Exception): pass
+
+class PageCursor:
+    '''
+    Opaque position in a paginated list, returned along with each page to get the next one (keyset pagination).
+    It contains the values of the sort keys in the last row returned, the number of rows returned until then
+    and the total of rows obtained in the first page.
+    '''
+    def __init__(self, position: int, total: int, keyValues: list, signature: int):
+        self.position = position
+        self.total = total
+        self.keyValues = keyValues
+        self.signature = signature   # of the sort criteria, to detect the cursor is not used for other list
+
+    def encode(self) -> str:
+        data = json.dumps([self.position, self.total, self.keyValues, self.signature], default=str, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode(cursor: str) -> 'PageCursor':
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            position, total, keyValues, signature = data
+            if not isinstance(position, int) or not isinstance(total, int) or not isinstance(keyValues, list) \
+               or not isinstance(signature, int):
+                raise ValueError()
+            return PageCursor(position, total, keyValues, signature)
+        except (ValueError, TypeError):
+            raise PageCursorException("Malformed cursor.")
+
+# Each sort key is a tuple (expression, descending, type of its values in the cursor: str, int or datetime).
+SortKey = tuple[sql.Composable, bool, type]
+
+def _checkKeyValue(value, valueType: type):
+    ''' Checks the type of a value taken from a cursor (received from the client) and converts it to bind it in the query. '''
+    if value is None: return None   # nullable keys
+    if valueType is datetime:
+        if isinstance(value, str):
+            try: 
+                return datetime.fromisoformat(value)
+            except ValueError: pass
+    elif valueType is int:
+        if isinstance(value, int) and not isinstance(value, bool): return value
+    elif isinstance(value, valueType): return value
+    raise PageCursorException("Malformed cursor.")
+
+def _getKeysetCondition(sortKeys: list[SortKey], keyValues: list) -> tuple[sql.Composable, list]:
+    ''' Condition to select the rows after the one with those key values, 
+        e.g. for keys (a ASC, b DESC): a > va OR (a = va AND b < vb) 
+        The values are returned apart, to be bound as params (placeholders in the condition) after the ones of the query. '''
+    values = [_checkKeyValue(v, valueType) for (_, _, valueType), v in zip(sortKeys, keyValues)]
+    alternatives = []
+    params = []
+    for i, (expr, descending, _) in enumerate(sortKeys):
+        conditions = [sql.SQL("{} = %s").format(e) for e, _, _ in sortKeys[:i]]
+        conditions.append(sql.SQL("{} {} %s").format(expr, sql.SQL("<" if descending else ">")))
+        params.extend(values[:i+1])
+        alternatives.append(sql.SQL("({})").format(sql.SQL(" AND ").join(conditions)))
+    return sql.SQL("({})").format(sql.SQL(" OR ").join(alternatives)), params
+
+def _getOrderByAndSignature(cursor, sortKeys: list[SortKey]) -> tuple[sql.Composable, int]:
+    orderBy = sql.SQL(", ").join(sql.SQL("{} {}").format(expr, sql.SQL("DESC" if descending else "ASC")) 
+                                 for expr, descending, _ in sortKeys)
+    return orderBy, zlib.crc32(orderBy.as_string(cursor).encode())
+
+def _addPageCursorCondition(cursor, fromAndWhere: sql.Composable, params, sortKeys: list[SortKey], 
+                            signature: int, after: PageCursor) -> tuple[sql.Composable, tuple]:
+    ''' Returns the fromAndWhere with the condition of the cursor and the params with its values. '''
+    if after.signature != signature or len(after.keyValues) != len(sortKeys):
+        raise PageCursorException("The cursor does not correspond to this list or sort criteria.")
+    condition, conditionParams = _getKeysetCondition(sortKeys, after.keyValues)
+    if params is None:
+        # The query was going to be executed without params, so it may contain '%' (e.g. in literals for LIKE) 
+        # which must be escaped now.
+        fromAndWhere = sql.SQL(fromAndWhere.as_string(cursor).replace('%', '%%'))
+        params = ()
+    return sql.SQL("{} AND {}").format(fromAndWhere, condition), tuple(params) + tuple(conditionParams)
+
+def selectPageWithTotal(cursor, columns: sql.Composable, fromAndWhere: sql.Composable, 
+                        sortKeys: list[SortKey], limit: int, skip: int, params = None, 
+                        estimateTotalAbove: int = 0, after: PageCursor | None = None) -> tuple[list[tuple], int, PageCursor | None]:
+    '''
+    Returns the rows of a page (limit, 0 means no limit), the total of rows without limit 
+    and the cursor to get the next page (None if it is the last one).
+    The page can be selected with skip (offset) or with the cursor returned along with the previous page (after):
+    then the rows are selected directly with a condition on the sort keys, without walking the previous ones.
+    The sortKeys (see SortKey) must identify univocally each row (usually the last one is the id).
+    The fromAndWhere must include the WHERE clause (the condition of the cursor is added at the end).
+    The total is obtained in the same statement (with an uncorrelated subquery, evaluated only once), or taken from the cursor.
+    Note a window function count(*) OVER() would prevent to stop reading rows at the limit when they are read in order from an index.
+    If estimateTotalAbove > 0 and the planner estimates more rows than that, the estimation is returned as total
+    to avoid the cost of the exact count (all the rows must be walked to count them).
+    '''
+    orderBy, signature = _getOrderByAndSignature(cursor, sortKeys)
+    position, total, estimated = skip, None, False
+    if after is not None:
+        fromAndWhere, params = _addPageCursorCondition(cursor, fromAndWhere, params, sortKeys, signature, after)
+        position, total, skip = after.position, after.total, 0
+    elif limit > 0 and estimateTotalAbove > 0:
+        cursor.execute(sql.SQL("EXPLAIN (FORMAT JSON) SELECT 1 {}").format(fromAndWhere), params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str): plan = json.loads(plan)
+        estimatedTotal = int(plan[0]["Plan"]["Plan Rows"])
+        if estimatedTotal > estimateTotalAbove: total, estimated = estimatedTotal, True
+    withCount = (limit > 0 and total is None)
+    # One more row is requested just to know if there are more pages.
+    cursor.execute(sql.SQL("SELECT {}, {}{} {} ORDER BY {} LIMIT {} OFFSET {}").format(
+                       columns, sql.SQL(", ").join(expr for expr, _, _ in sortKeys), 
+                       sql.SQL(", (SELECT count(*) {})").format(fromAndWhere) if withCount else sql.SQL(""),
+                       fromAndWhere, orderBy, sql.SQL(str(limit + 1) if limit > 0 else 'ALL'), sql.Literal(skip)), 
+                   (tuple(params) * 2 if withCount else params) if params is not None else None)
+    rows = cursor.fetchall()
+    if withCount:
+        if len(rows) > 0: total = rows[0][-1]
+        rows = [row[:-1] for row in rows]
+    if total is None and len(rows) == 0 and position > 0:
+        # The page is out of range, so the total is not known from the rows.
+        cursor.execute(sql.SQL("SELECT count(*) {}").format(fromAndWhere), params)
+        total = cursor.fetchone()[0]
+    nextCursor = None
+    if limit > 0 and len(rows) > limit:
+        rows = rows[:limit]
+        nextCursor = PageCursor(position + limit, total, list(rows[-1][-len(sortKeys):]), signature)
+    if total is None: total = position + len(rows)   # no limit
+    elif estimated: total = max(total, position + len(rows))
+    if nextCursor is not None: nextCursor.total = total
+    return [row[:-len(sortKeys)] for row in rows], total, nextCursor
+
+_streamedRowsIds = itertools.count(1)   # to name the server-side cursors
+
+class StreamedRows:
+    '''
+    All the rows of a list (from skip or after the cursor of a previous page, without limit, see selectPageWithTotal)
+    read with a server-side (named) cursor in chunks of fetchSize rows, so they are never loaded all in memory
+    and the first ones are available before the rest are read.
+    Each row (without the sort keys) is converted with toItem when iterating.
+    It must be iterated and closed within the transaction in which it has been created (before the end of the DB block).
+    The total of rows (without skip) is available at the end of the iteration.
+    '''
+    def __init__(self, cursor, columns: sql.Composable, fromAndWhere: sql.Composable, 
+                 sortKeys: list[SortKey], skip: int, params = None, 
+                 after: PageCursor | None = None, toItem = None, fetchSize: int = 1000):
+        orderBy, signature = _getOrderByAndSignature(cursor, sortKeys)
+        self.position, self._total = skip, None
+        if after is not None:
+            fromAndWhere, params = _addPageCursorCondition(cursor, fromAndWhere, params, sortKeys, signature, after)
+            self.position, self._total, skip = after.position, after.total, 0
+        self.returned = 0
+        self._cursor = cursor
+        self._countQuery = sql.SQL("SELECT count(*) {}").format(fromAndWhere)
+        self._params = params
+        self._toItem = toItem
+        self._namedCursor = cursor.connection.cursor(name = "streamed_rows_%d" % next(_streamedRowsIds))
+        self._namedCursor.itersize = fetchSize
+        self._namedCursor.execute(sql.SQL("SELECT {} {} ORDER BY {} OFFSET {}").format(
+                                      columns, fromAndWhere, orderBy, sql.Literal(skip)), params)
+
+    def __iter__(self):
+        for row in self._namedCursor:
+            self.returned += 1
+            yield self._toItem(row) if self._toItem is not None else row
+
+    def close(self):
+        if not self._namedCursor.closed: self._namedCursor.close()
+
+    @property
+    def total(self) -> int:
+        if self._total is None:
+            if self.returned == 0 and self.position > 0:
+                # Out of range, so the total is not known from the rows.
+                self._cursor.execute(self._countQuery, self._params)
+                self._total = self._cursor.fetchone()[0]
+            else: self._total = self.position + self.returned
+        return self._total
+
+
+class DB:
+    def __init__(self, dbConfig):
+        self._session = DBSession.getCurrent()
+        self._savepoint = None
+        conn = self._session._acquire(dbConfig) if self._session is not None else None
+        if conn is None:
+            self._session = None
+            self.conn, self._pool = _openConnection(dbConfig)
         else:
-            # Exception occurred, so rollback.
-            self.conn.rollback()
-        self.cursor.close()
-        self.conn.close()
+            self.conn = conn
+            if self._session._depth > 1: self._savepoint = "nested_db_%d" % self._session._depth
+        try:
+            self.cursor = self.conn.cursor()
+            if self._savepoint is not None: self.cursor.execute("SAVEPOINT " + self._savepoint)
+        except:
+            self._release()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        try:
+            if tb is None:
+                # No exception, so commit
+                if self._savepoint is None: self.conn.commit()
+                else: self.cursor.execute("RELEASE SAVEPOINT " + self._savepoint)
+            else:
+                # Exception occurred, so rollback.
+                self._rollback()
+        finally:
+            self._release()
         return False   # if an exception has been raised then it will be re-raised
         
     def close(self):
-        self.cursor.close()
-        self.conn.close()
+        ''' Without commit: if not commited the transaction is discarded. '''
+        try:
+            if self._session is not None: self._rollback()
+        finally:
+            self._release()
+
+    def _rollback(self):
+        if self._savepoint is None: self.conn.rollback()
+        else: self.cursor.execute("ROLLBACK TO SAVEPOINT " + self._savepoint)
+
+    def _release(self):
+        try:
+            if hasattr(self, "cursor"): self.cursor.close()
+        finally:
+            if self._session is not None: self._session._release()
+            else: _releaseConnection(self.conn, self._pool)
 
-    CURRENT_SCHEMA_VERSION = 47
+    CURRENT_SCHEMA_VERSION = 56
 
     def setup(self):
         version = self.getSchemaVersion()
@@ -60,6 +466,15 @@ class DB:
             if version < 45: self.updateDB_v44To45()
             if version < 46: self.updateDB_v45To46()
             if version < 47: self.updateDB_v46To47()
+            if version < 48: self.updateDB_v47To48()
+            if version < 49: self.updateDB_v48To49()
+            if version < 50: self.updateDB_v49To50()
+            if version < 51: self.updateDB_v50To51()
+            if version < 52: self.updateDB_v51To52()
+            if version < 53: self.updateDB_v52To53()
+            if version < 54: self.updateDB_v53To54()
+            if version < 55: self.updateDB_v54To55()
+            if version < 56: self.updateDB_v55To56()
             ### Finally update schema_version
             self.cursor.execute("UPDATE metadata set schema_version = %d;" % self.CURRENT_SCHEMA_VERSION)
 
@@ -77,9 +492,11 @@ class DB:
         #    self.cursor.execute(inputStream.read())
 
         self.cursor.execute("""
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
             CREATE TABLE metadata (
                 id integer DEFAULT 1 NOT NULL CHECK (id = 1),
                 schema_version integer NOT NULL,
+                search_revision integer NOT NULL DEFAULT 0,
                 constraint pk_metadata primary key (id)
             );
             INSERT INTO metadata (schema_version) 
@@ -110,6 +527,7 @@ class DB:
                 constraint un_gid unique (gid),
                 constraint fk_site foreign key (site_code) references site(code)
             );
+            CREATE INDEX author_name_trgm_index ON author USING GIN (name gin_trgm_ops);
             CREATE TABLE dataset (
                 id varchar(40),
                 name varchar(256) NOT NULL,
@@ -161,10 +579,25 @@ class DB:
                 size_in_bytes bigint DEFAULT NULL,
                 tags varchar(20) ARRAY NOT NULL DEFAULT ARRAY[]::varchar[],
                 times_used integer DEFAULT 0,
+                /* Increased on every change in the dataset, it is used to build the ETag of the responses. */
+                revision integer NOT NULL DEFAULT 0,
                 constraint pk_dataset primary key (id),
                 constraint fk_author foreign key (author_id) references author(id)
             );
             CREATE INDEX dataset_tags_index ON dataset USING GIN (tags);
+            /* Trigram indexes for the searches by substring (ILIKE) */
+            CREATE INDEX dataset_name_trgm_index ON dataset USING GIN (name gin_trgm_ops);
+            CREATE INDEX dataset_id_trgm_index ON dataset USING GIN (id gin_trgm_ops);
+            /* Indexes for the filters and sort criteria of the datasets list. 
+               The usual listing (for non-admin users) only includes the published datasets (not draft nor invalidated),
+               so there is a partial index for each sort criteria, also with the keys of the default order. */
+            CREATE INDEX dataset_author_id_index ON dataset (author_id);
+            CREATE INDEX dataset_project_code_index ON dataset (project_code, creation_date DESC, id DESC);
+            CREATE INDEX dataset_published_creation_date_index ON dataset (creation_date DESC, id DESC) WHERE draft = false AND invalidated = false;
+            CREATE INDEX dataset_published_name_index ON dataset (name, creation_date DESC, id DESC) WHERE draft = false AND invalidated = false;
+            CREATE INDEX dataset_published_studies_count_index ON dataset (studies_count DESC, creation_date DESC, id DESC) WHERE draft = false AND invalidated = false;
+            CREATE INDEX dataset_published_subjects_count_index ON dataset (subjects_count DESC, creation_date DESC, id DESC) WHERE draft = false AND invalidated = false;
+            CREATE INDEX dataset_published_times_used_index ON dataset ((COALESCE(times_used, 0)) DESC, creation_date DESC, id DESC) WHERE draft = false AND invalidated = false;
             /* Every dataset has one of this during the creation; it is deleted when the creation successfully finish.
                The creation job writes here the status of the process, so the UI can inform to the user. */
             CREATE TABLE dataset_creation_status (
@@ -174,6 +607,20 @@ class DB:
                 constraint pk_dataset_creation_status primary key (dataset_id),
                 constraint fk_dataset foreign key (dataset_id) references dataset(id)
             );
+            /* Datasets waiting to be created (or being created) by the local executor (self.dataset_creation_executor = "local").
+               owner and heartbeat_time are set when an executor takes it and the heartbeat is updated periodically while running,
+               so if the process dies, another executor can take it again.
+               Removing the row cancels the creation. */
+            CREATE TABLE dataset_creation_queue (
+                dataset_id varchar(40),
+                priority integer NOT NULL DEFAULT 0,
+                enqueue_time timestamp NOT NULL DEFAULT now(),
+                start_time timestamp DEFAULT NULL,
+                owner varchar(128) DEFAULT NULL,
+                heartbeat_time timestamp DEFAULT NULL,
+                constraint pk_dataset_creation_queue primary key (dataset_id),
+                constraint fk_dataset foreign key (dataset_id) references dataset(id)
+            );
             /* Allowed users to access to a dataset apart from the user joined to the project. */
             CREATE TABLE dataset_acl (
                 dataset_id varchar(40),
@@ -195,6 +642,7 @@ class DB:
                 study_date timestamp DEFAULT NULL,
                 constraint pk_study primary key (id)
             );
+            CREATE INDEX study_subject_name_trgm_index ON study USING GIN (subject_name gin_trgm_ops);
             /* A dataset can contain multiple studies and a study can be contained in multiple datasets. */
             CREATE TABLE dataset_study (
                 dataset_id varchar(40),
@@ -206,6 +654,7 @@ class DB:
                 constraint fk_dataset foreign key (dataset_id) references dataset(id),
                 constraint fk_study foreign key (study_id) references study(id)
             );
+            CREATE INDEX dataset_study_study_id_index ON dataset_study (study_id);
             CREATE TABLE series (
                 study_id varchar(64),
                 folder_name varchar(128),
@@ -214,6 +663,7 @@ class DB:
                 manufacturer varchar(64) DEFAULT NULL,
                 hash_cache bytea DEFAULT NULL,
                 hash_last_time_calculated timestamp DEFAULT NULL,
+                hash_fingerprint varchar(128) DEFAULT NULL,
                 constraint pk_series primary key (study_id, folder_name),
                 constraint fk_study foreign key (study_id) references study(id)
             );
@@ -226,6 +676,36 @@ class DB:
                 constraint fk_study foreign key (study_id) references study(id),
                 constraint fk_series foreign key (study_id, series_folder_name) references series(study_id, folder_name)
             );
+            CREATE INDEX dataset_study_series_series_index ON dataset_study_series (study_id, series_folder_name);
+            /* Denormalized copy of the searchable properties of each study in each dataset (the facets), 
+               including the properties of its series aggregated in arrays, to search (eucaimSearch) without joins. 
+               It is refreshed when the metadata of the dataset is collected. */
+            CREATE TABLE study_search_facets (
+                dataset_id varchar(40),
+                study_id varchar(64),
+                subject_name varchar(128) NOT NULL,
+                age_in_days integer DEFAULT NULL,
+                sex char(1) DEFAULT NULL,
+                diagnosis varchar(16) DEFAULT NULL,
+                diagnosis_year integer DEFAULT NULL,
+                modalities varchar(16)[] NOT NULL DEFAULT '{}',
+                body_parts varchar(16)[] NOT NULL DEFAULT '{}',
+                manufacturers varchar(64)[] NOT NULL DEFAULT '{}',
+                constraint pk_study_search_facets primary key (dataset_id, study_id),
+                constraint fk_dataset foreign key (dataset_id) references dataset(id)
+            );
+            CREATE INDEX study_search_facets_study_id_index ON study_search_facets (study_id);
+            CREATE INDEX study_search_facets_modalities_index ON study_search_facets USING GIN (modalities);
+            CREATE INDEX study_search_facets_body_parts_index ON study_search_facets USING GIN (body_parts);
+            CREATE INDEX study_search_facets_manufacturers_index ON study_search_facets USING GIN (manufacturers);
+            /* files: JSON list of [relative_path, size, mtime_ns, hash] of each file in the series directory */
+            CREATE TABLE series_hash_manifest (
+                study_id varchar(64),
+                folder_name varchar(128),
+                files text,
+                constraint pk_series_hash_manifest primary key (study_id, folder_name),
+                constraint fk_series foreign key (study_id, folder_name) references series(study_id, folder_name)
+            );
             
             /* access_type options: 'i' (interactive desktop or web app), 
                                     'b' (batch job) */
@@ -248,12 +728,14 @@ class DB:
                 constraint pk_dataset_access primary key (id),
                 constraint fk_user foreign key (user_gid) references author(gid)
             );
+            CREATE INDEX dataset_access_open_user_gid_index ON dataset_access (user_gid) WHERE closed IS NOT TRUE;
             CREATE TABLE dataset_access_dataset (
                 dataset_access_id varchar(128),
                 dataset_id varchar(40),
                 constraint pk_dataset_access_dataset primary key (dataset_access_id, dataset_id),
                 constraint fk_dataset foreign key (dataset_id) references dataset(id)
             );
+            CREATE INDEX dataset_access_dataset_dataset_id_index ON dataset_access_dataset (dataset_id);
 
             CREATE TABLE license (
                 id SERIAL,
@@ -434,5 +916,106 @@ class DB:
         self.cursor.execute("ALTER TABLE series ALTER COLUMN study_id TYPE varchar(64)")
         self.cursor.execute("ALTER TABLE dataset_study_series ALTER COLUMN study_id TYPE varchar(64)")
 
+    def updateDB_v47To48(self):
+        logging.root.info("Updating database from v47 to v48...")
+        self.cursor.execute("ALTER TABLE series ADD COLUMN hash_fingerprint varchar(128) DEFAULT NULL")
+
+    def updateDB_v48To49(self):
+        logging.root.info("Updating database from v48 to v49...")
+        self.cursor.execute("""
+            CREATE TABLE series_hash_manifest (
+                study_id varchar(64),
+                folder_name varchar(128),
+                files text,
+                constraint pk_series_hash_manifest primary key (study_id, folder_name),
+                constraint fk_series foreign key (study_id, folder_name) references series(study_id, folder_name)
+            );""")
+
+    def updateDB_v49To50(self):
+        logging.root.info("Updating database from v49 to v50...")
+        self.cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        self.cursor.execute("CREATE INDEX dataset_name_trgm_index ON dataset USING GIN (name gin_trgm_ops)")
+        self.cursor.execute("CREATE INDEX dataset_id_trgm_index ON dataset USING GIN (id gin_trgm_ops)")
+        self.cursor.execute("CREATE INDEX author_name_trgm_index ON author USING GIN (name gin_trgm_ops)")
+        self.cursor.execute("CREATE INDEX study_subject_name_trgm_index ON study USING GIN (subject_name gin_trgm_ops)")
+
+    def updateDB_v50To51(self):
+        logging.root.info("Updating database from v50 to v51...")
+        self.cursor.execute("CREATE INDEX dataset_author_id_index ON dataset (author_id)")
+        self.cursor.execute("CREATE INDEX dataset_project_code_index ON dataset (project_code, creation_date DESC, id DESC)")
+        self.cursor.execute("CREATE INDEX dataset_published_creation_date_index ON dataset (creation_date DESC, id DESC) WHERE draft = false AND invalidated = false")
+        self.cursor.execute("CREATE INDEX dataset_published_name_index ON dataset (name, creation_date DESC, id DESC) WHERE draft = false AND invalidated = false")
+        self.cursor.execute("CREATE INDEX dataset_published_studies_count_index ON dataset (studies_count DESC, creation_date DESC, id DESC) WHERE draft = false AND invalidated = false")
+        self.cursor.execute("CREATE INDEX dataset_published_subjects_count_index ON dataset (subjects_count DESC, creation_date DESC, id DESC) WHERE draft = false AND invalidated = false")
+        self.cursor.execute("CREATE INDEX dataset_published_times_used_index ON dataset ((COALESCE(times_used, 0)) DESC, creation_date DESC, id DESC) WHERE draft = false AND invalidated = false")
+
+    def updateDB_v51To52(self):
+        logging.root.info("Updating database from v51 to v52...")
+        # Indexes on the columns referenced but not leading in the primary keys (lookups in the reverse direction).
+        self.cursor.execute("CREATE INDEX dataset_study_study_id_index ON dataset_study (study_id)")
+        self.cursor.execute("CREATE INDEX dataset_study_series_series_index ON dataset_study_series (study_id, series_folder_name)")
+        self.cursor.execute("CREATE INDEX dataset_access_dataset_dataset_id_index ON dataset_access_dataset (dataset_id)")
+        self.cursor.execute("CREATE INDEX dataset_access_open_user_gid_index ON dataset_access (user_gid) WHERE closed IS NOT TRUE")
+
+    def updateDB_v52To53(self):
+        logging.root.info("Updating database from v52 to v53...")
+        self.cursor.execute("""
+            CREATE TABLE study_search_facets (
+                dataset_id varchar(40),
+                study_id varchar(64),
+                subject_name varchar(128) NOT NULL,
+                age_in_days integer DEFAULT NULL,
+                sex char(1) DEFAULT NULL,
+                diagnosis varchar(16) DEFAULT NULL,
+                diagnosis_year integer DEFAULT NULL,
+                modalities varchar(16)[] NOT NULL DEFAULT '{}',
+                body_parts varchar(16)[] NOT NULL DEFAULT '{}',
+                manufacturers varchar(64)[] NOT NULL DEFAULT '{}',
+                constraint pk_study_search_facets primary key (dataset_id, study_id),
+                constraint fk_dataset foreign key (dataset_id) references dataset(id)
+            );""")
+        logging.root.info("Filling the table study_search_facets (it may take some time)...")
+        self.cursor.execute("""
+            INSERT INTO study_search_facets (dataset_id, study_id, subject_name, age_in_days, sex, diagnosis, diagnosis_year, 
+                                             modalities, body_parts, manufacturers)
+            SELECT dataset_study.dataset_id, dataset_study.study_id, 
+                   study.subject_name, study.age_in_days, study.sex, study.diagnosis, study.diagnosis_year, 
+                   COALESCE(array_agg(DISTINCT series.modality) FILTER (WHERE series.modality IS NOT NULL), '{}'), 
+                   COALESCE(array_agg(DISTINCT series.body_part) FILTER (WHERE series.body_part IS NOT NULL), '{}'), 
+                   COALESCE(array_agg(DISTINCT series.manufacturer) FILTER (WHERE series.manufacturer IS NOT NULL), '{}')
+            FROM dataset_study
+                JOIN study ON study.id = dataset_study.study_id
+                LEFT JOIN dataset_study_series ON dataset_study_series.dataset_id = dataset_study.dataset_id 
+                                              AND dataset_study_series.study_id = dataset_study.study_id
+                LEFT JOIN series ON series.study_id = dataset_study_series.study_id 
+                                AND series.folder_name = dataset_study_series.series_folder_name
+            GROUP BY dataset_study.dataset_id, dataset_study.study_id, study.id;""")
+        self.cursor.execute("CREATE INDEX study_search_facets_study_id_index ON study_search_facets (study_id)")
+        self.cursor.execute("CREATE INDEX study_search_facets_modalities_index ON study_search_facets USING GIN (modalities)")
+        self.cursor.execute("CREATE INDEX study_search_facets_body_parts_index ON study_search_facets USING GIN (body_parts)")
+        self.cursor.execute("CREATE INDEX study_search_facets_manufacturers_index ON study_search_facets USING GIN (manufacturers)")
+
+    def updateDB_v53To54(self):
+        logging.root.info("Updating database from v53 to v54...")
+        self.cursor.execute("ALTER TABLE metadata ADD COLUMN search_revision integer NOT NULL DEFAULT 0")
+
+    def updateDB_v54To55(self):
+        logging.root.info("Updating database from v54 to v55...")
+        self.cursor.execute("""
+            CREATE TABLE dataset_creation_queue (
+                dataset_id varchar(40),
+                priority integer NOT NULL DEFAULT 0,
+                enqueue_time timestamp NOT NULL DEFAULT now(),
+                start_time timestamp DEFAULT NULL,
+                owner varchar(128) DEFAULT NULL,
+                heartbeat_time timestamp DEFAULT NULL,
+                constraint pk_dataset_creation_queue primary key (dataset_id),
+                constraint fk_dataset foreign key (dataset_id) references dataset(id)
+            );""")
+
+    def updateDB_v55To56(self):
+        logging.root.info("Updating database from v55 to v56...")
+        self.cursor.execute("ALTER TABLE dataset ADD COLUMN revision integer NOT NULL DEFAULT 0")
+
 #endregion
 
@@ -1,5 +1,5 @@
-from .DB import DB
+from .DB import DB, DBSession, closeConnectionPools, selectPageWithTotal, PageCursor, PageCursorException, StreamedRows
 from .projects import DBProjectsOperator
-from .eucaim_search import DBDatasetsEUCAIMSearcher, SearchValidationException
+from .eucaim_search import DBDatasetsEUCAIMSearcher, SearchValidationException, EUCAIMSearchResultsCache
 from .dataset_accesses import DBDatasetAccessesOperator
 from .datasets import DBDatasetsOperator
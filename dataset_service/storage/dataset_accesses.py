@@ -1,5 +1,6 @@
+from datetime import datetime
 from psycopg2 import sql
-from .DB import DB
+from .DB import DB, selectPageWithTotal, PageCursor, StreamedRows
 
 class DBDatasetAccessesOperator():
     def __init__(self, db: DB):
@@ -27,7 +28,7 @@ class DBDatasetAccessesOperator():
     def updateDatasetTimesUsed(self, id):
         self.cursor.execute("""
             UPDATE dataset
-            SET times_used = 
+            SET revision = revision + 1, times_used = 
                 (SELECT COUNT(*) FROM dataset_access_dataset WHERE dataset_id = %s) 
             WHERE id = %s;""", 
             (id, id))
@@ -78,44 +79,46 @@ class DBDatasetAccessesOperator():
                             toolName = row[1], toolVersion = row[2], datasetAccessId = row[3]))
         return res
 
-    def getDatasetAccesses(self, datasetId, limit = 0, skip = 0):
-        if limit == 0: limit = 'ALL'
+    _ACCESSES_OF_DATASET_COLUMNS = sql.SQL("""dataset_access.creation_time, author.username, dataset_access.access_type, 
+                                              dataset_access.tool_name, dataset_access.tool_version, dataset_access.image, 
+                                              dataset_access.resource_flavor, 
+                                              dataset_access.start_time, dataset_access.end_time, dataset_access.end_status, 
+                                              dataset_access.cmd_line, dataset_access.openchallenge_job_type, dataset_access.instance_name""")
+    _ACCESSES_OF_DATASET_FROM = sql.SQL("""FROM dataset_access, dataset_access_dataset, author
+                                           WHERE dataset_access_dataset.dataset_id = %s
+                                                 AND dataset_access_dataset.dataset_access_id = dataset_access.id 
+                                                 AND dataset_access.user_gid = author.gid""")
+    _ACCESSES_OF_DATASET_SORT_KEYS = [(sql.SQL("dataset_access.creation_time"), True, datetime), 
+                                      (sql.SQL("dataset_access.id"), True, str)]
 
-        # First get total rows without LIMIT and OFFSET
-        self.cursor.execute("""SELECT count(*) FROM dataset_access, dataset_access_dataset 
-                               WHERE dataset_access_dataset.dataset_id = %s
-                               AND dataset_access_dataset.dataset_access_id = dataset_access.id """, (datasetId,))
-        row = self.cursor.fetchone()
-        total = row[0] if row != None else 0
+    @staticmethod
+    def _accessOfDatasetRowToDict(row) -> dict:
+        startTime, endTime, duration = row[7], row[8], None
+        if startTime != None and endTime != None:
+            duration = (endTime - startTime).total_seconds()/60
+        creationTime = str(row[0].astimezone())   # row[0] is a datetime without time zone, just add the local tz.
+                                                  # If local tz is UTC, the string "+00:00" is added at the end.
+        startTime = str(startTime.astimezone()) if startTime != None else None
+        endTime = str(endTime.astimezone()) if endTime != None else None
+        return dict(creationTime = creationTime, username = row[1], accessType = row[2], 
+                    instanceName = row[12], toolName = row[3], toolVersion = row[4], image = row[5],
+                    resourcesFlavor = row[6], duration = duration,
+                    startTime = startTime, endTime = endTime, endStatus = row[9],
+                    cmdLine = row[10], openchallengeJobType = row[11])
 
-        self.cursor.execute(sql.SQL("""
-            SELECT dataset_access.creation_time, author.username, dataset_access.access_type, 
-                   dataset_access.tool_name, dataset_access.tool_version, dataset_access.image, 
-                   dataset_access.resource_flavor, 
-                   dataset_access.start_time, dataset_access.end_time, dataset_access.end_status, 
-                   dataset_access.cmd_line, dataset_access.openchallenge_job_type, dataset_access.instance_name
-            FROM dataset_access, dataset_access_dataset, author
-            WHERE dataset_access_dataset.dataset_id = %s
-                  AND dataset_access_dataset.dataset_access_id = dataset_access.id 
-                  AND dataset_access.user_gid = author.gid
-            ORDER BY dataset_access.creation_time DESC
-            LIMIT {} OFFSET {};""").format(sql.SQL(str(limit)), sql.SQL(str(skip))), 
-            (datasetId,))
-        res = []
-        for row in self.cursor:
-            startTime, endTime, duration = row[7], row[8], None
-            if startTime != None and endTime != None:
-                duration = (endTime - startTime).total_seconds()/60
-            creationTime = str(row[0].astimezone())   # row[0] is a datetime without time zone, just add the local tz.
-                                                      # If local tz is UTC, the string "+00:00" is added at the end.
-            startTime = str(startTime.astimezone()) if startTime != None else None
-            endTime = str(endTime.astimezone()) if endTime != None else None
-            res.append(dict(creationTime = creationTime, username = row[1], accessType = row[2], 
-                            instanceName = row[12], toolName = row[3], toolVersion = row[4], image = row[5],
-                            resourcesFlavor = row[6], duration = duration,
-                            startTime = startTime, endTime = endTime, endStatus = row[9],
-                            cmdLine = row[10], openchallengeJobType = row[11]))
-        return res, total
+    def getDatasetAccesses(self, datasetId, limit = 0, skip = 0, estimateTotalAbove = 0, 
+                           pageCursor: PageCursor | None = None) -> tuple[list[dict], int, PageCursor | None]:
+        rows, total, nextCursor = selectPageWithTotal(self.cursor, 
+            self._ACCESSES_OF_DATASET_COLUMNS, self._ACCESSES_OF_DATASET_FROM, self._ACCESSES_OF_DATASET_SORT_KEYS, 
+            limit, skip, (datasetId,), estimateTotalAbove, pageCursor)
+        return [self._accessOfDatasetRowToDict(row) for row in rows], total, nextCursor
+
+    def streamDatasetAccesses(self, datasetId, skip = 0, pageCursor: PageCursor | None = None, 
+                              fetchSize: int = 1000) -> StreamedRows:
+        ''' Like getDatasetAccesses without limit, but the accesses are read while iterating (see StreamedRows). '''
+        return StreamedRows(self.cursor, 
+            self._ACCESSES_OF_DATASET_COLUMNS, self._ACCESSES_OF_DATASET_FROM, self._ACCESSES_OF_DATASET_SORT_KEYS, 
+            skip, (datasetId,), pageCursor, self._accessOfDatasetRowToDict, fetchSize)
 
     def deleteDatasetAccess(self, datasetAccessId):
         self.cursor.execute("DELETE FROM dataset_access_dataset WHERE dataset_access_id=%s;", (datasetAccessId,))
@@ -1,11 +1,15 @@
 from psycopg2 import sql
+import psycopg2.extras
 from datetime import datetime
 import json
 import logging
-from .DB import DB
+from .DB import DB, selectPageWithTotal, PageCursor, StreamedRows
 from .. import authorization, output_formats
 
 class DBDatasetsOperator():
+    # Max number of rows sent in each statement by the bulk operations (execute_values).
+    BULK_PAGE_SIZE = 1000
+
     def __init__(self, db: DB):
         self.cursor = db.cursor
         self.conn = db.conn
@@ -23,8 +27,11 @@ class DBDatasetsOperator():
             self.cursor.execute("""
                 UPDATE author
                 SET username = %s, name = %s, email = %s
-                WHERE id = %s;""", 
-                (username, name, email, userId))
+                WHERE id = %s AND (username, name, email) IS DISTINCT FROM (%s, %s, %s);""", 
+                (username, name, email, userId, username, name, email))
+            # The author data is included in the datasets
+            if self.cursor.rowcount > 0:
+                self.cursor.execute("UPDATE dataset SET revision = revision + 1 WHERE author_id = %s;", (userId,))
     
     def createOrUpdateUser(self, userId, username, site: str | None, gid: int | None = None):
         self.cursor.execute("SELECT id FROM author WHERE id=%s LIMIT 1;", (userId,))
@@ -136,7 +143,7 @@ class DBDatasetsOperator():
         manufacturerList = [output_formats.manufacturerToOutputFormat(i) for i in dataset["manufacturer"]]
         self.cursor.execute("""
             UPDATE dataset 
-            SET studies_count = %s, subjects_count = %s, 
+            SET revision = revision + 1, studies_count = %s, subjects_count = %s, 
                 age_low_in_days = %s, age_low_unit = %s, 
                 age_high_in_days = %s, age_high_unit = %s, 
                 age_null_count = %s, 
@@ -162,38 +169,111 @@ class DBDatasetsOperator():
                 json.dumps(manufacturerList), json.dumps(dataset["manufacturerCount"]), 
                 json.dumps(dataset["seriesTags"]), dataset["sizeInBytes"],
                 dataset["id"]))
+        # The metadata of all the studies and series are sent in a few statements (UPDATE ... FROM (VALUES ...)).
+        # Note the casts in the templates are required for the columns where all the values may be NULL.
+        datasetStudyRows, studyRows, seriesRows = [], [], []
         for study in dataset["studies"]:
-            self.cursor.execute("""
-                UPDATE dataset_study set size_in_bytes=%s 
-                WHERE dataset_id = %s AND study_id = %s;""",
-                (study['sizeInBytes'], dataset["id"], study['studyId']))
-            self.cursor.execute("""
-                UPDATE study
-                SET age_in_days = %s, sex = %s, 
-                    diagnosis = %s, diagnosis_year = %s, study_date = %s 
-                WHERE id = %s;""", 
-                (study['ageInDays'], study['sex'], 
-                 study['diagnosis'], study['diagnosisYear'], study['studyDate'],
-                 study['studyId']))
+            datasetStudyRows.append((dataset["id"], study['studyId'], study['sizeInBytes']))
+            studyRows.append((study['studyId'], study['ageInDays'], study['sex'], 
+                              study['diagnosis'], study['diagnosisYear'], study['studyDate']))
             for series in study['series']:
-                self.cursor.execute("""
-                    UPDATE series
-                    SET body_part = %s, modality = %s, manufacturer = %s
-                    WHERE study_id = %s AND folder_name = %s;""", 
-                    (series['bodyPart'], series['modality'], series['manufacturer'], 
-                     study['studyId'], series['folderName']))
+                seriesRows.append((study['studyId'], series['folderName'], 
+                                   series['bodyPart'], series['modality'], series['manufacturer']))
+        if len(datasetStudyRows) > 0:
+            self._updateStudyAndSeriesMetadata(datasetStudyRows, studyRows, seriesRows)
+        self.refreshStudySearchFacets(dataset["id"])
+
+    def _updateStudyAndSeriesMetadata(self, datasetStudyRows, studyRows, seriesRows):
+        psycopg2.extras.execute_values(self.cursor, """
+            UPDATE dataset_study set size_in_bytes = v.size_in_bytes
+            FROM (VALUES %s) AS v (dataset_id, study_id, size_in_bytes)
+            WHERE dataset_study.dataset_id = v.dataset_id AND dataset_study.study_id = v.study_id;""",
+            datasetStudyRows, template="(%s, %s, %s::bigint)", page_size=self.BULK_PAGE_SIZE)
+        psycopg2.extras.execute_values(self.cursor, """
+            UPDATE study
+            SET age_in_days = v.age_in_days, sex = v.sex, 
+                diagnosis = v.diagnosis, diagnosis_year = v.diagnosis_year, study_date = v.study_date 
+            FROM (VALUES %s) AS v (id, age_in_days, sex, diagnosis, diagnosis_year, study_date)
+            WHERE study.id = v.id;""",
+            studyRows, template="(%s, %s::integer, %s::char(1), %s::varchar, %s::integer, %s::timestamp)", 
+            page_size=self.BULK_PAGE_SIZE)
+        if len(seriesRows) == 0: return
+        psycopg2.extras.execute_values(self.cursor, """
+            UPDATE series
+            SET body_part = v.body_part, modality = v.modality, manufacturer = v.manufacturer
+            FROM (VALUES %s) AS v (study_id, folder_name, body_part, modality, manufacturer)
+            WHERE series.study_id = v.study_id AND series.folder_name = v.folder_name;""",
+            seriesRows, template="(%s, %s, %s::varchar, %s::varchar, %s::varchar)", page_size=self.BULK_PAGE_SIZE)
+
+    def refreshStudySearchFacets(self, datasetId):
+        ''' Rewrites the rows of study_search_facets for the studies of the dataset, 
+            also in the other datasets including any of them, because the metadata of a study is shared.
+        '''
+        self.cursor.execute("""
+            DELETE FROM study_search_facets 
+            WHERE dataset_id = %s 
+              AND study_id NOT IN (SELECT study_id FROM dataset_study WHERE dataset_id = %s);""", (datasetId, datasetId))
+        self.cursor.execute("""
+            INSERT INTO study_search_facets (dataset_id, study_id, subject_name, age_in_days, sex, diagnosis, diagnosis_year, 
+                                             modalities, body_parts, manufacturers)
+            SELECT dataset_study.dataset_id, dataset_study.study_id, 
+                   study.subject_name, study.age_in_days, study.sex, study.diagnosis, study.diagnosis_year, 
+                   COALESCE(array_agg(DISTINCT series.modality) FILTER (WHERE series.modality IS NOT NULL), '{}'), 
+                   COALESCE(array_agg(DISTINCT series.body_part) FILTER (WHERE series.body_part IS NOT NULL), '{}'), 
+                   COALESCE(array_agg(DISTINCT series.manufacturer) FILTER (WHERE series.manufacturer IS NOT NULL), '{}')
+            FROM dataset_study
+                JOIN study ON study.id = dataset_study.study_id
+                LEFT JOIN dataset_study_series ON dataset_study_series.dataset_id = dataset_study.dataset_id 
+                                              AND dataset_study_series.study_id = dataset_study.study_id
+                LEFT JOIN series ON series.study_id = dataset_study_series.study_id 
+                                AND series.folder_name = dataset_study_series.series_folder_name
+            WHERE dataset_study.study_id IN (SELECT study_id FROM dataset_study WHERE dataset_id = %s)
+            GROUP BY dataset_study.dataset_id, dataset_study.study_id, study.id
+            ON CONFLICT (dataset_id, study_id) DO UPDATE 
+                SET subject_name = excluded.subject_name, age_in_days = excluded.age_in_days, sex = excluded.sex, 
+                    diagnosis = excluded.diagnosis, diagnosis_year = excluded.diagnosis_year, 
+                    modalities = excluded.modalities, body_parts = excluded.body_parts, 
+                    manufacturers = excluded.manufacturers;""", (datasetId,))
+        self.increaseSearchRevision()
+
+    def increaseSearchRevision(self):
+        ''' To be called on any change in datasets which may change the results of the eucaimSearch, 
+            this way the results cached (in any process) are discarded. 
+        '''
+        self.cursor.execute("UPDATE metadata SET search_revision = search_revision + 1;")
+
+    def increaseDatasetRevision(self, datasetId):
+        ''' To be called on any change in the dataset (or in its studies, ACL, etc.) which may change 
+            the responses of GET /datasets/<id> and /datasets/<id>/studies, this way the ETags of them change. 
+            The setDataset* methods already do it. 
+        '''
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1 WHERE id = %s;", (datasetId,))
+
+    def getDatasetRevision(self, datasetId) -> int | None:
+        ''' Returns None if the dataset not exists. '''
+        self.cursor.execute("SELECT revision FROM dataset WHERE id = %s LIMIT 1;", (datasetId,))
+        row = self.cursor.fetchone()
+        return None if row is None else row[0]
 
     def createDatasetCreationStatus(self, datasetId, status, firstMessage):
         self.cursor.execute("""
             INSERT INTO dataset_creation_status (dataset_id, status, last_message)
             VALUES (%s,%s,%s);""",
             (datasetId, status, firstMessage))
+        self.increaseDatasetRevision(datasetId)
     def setDatasetCreationStatus(self, datasetId, status, lastMessage):
         self.cursor.execute("""
             UPDATE dataset_creation_status 
             SET status = %s, last_message = %s
             WHERE dataset_id = %s;""",
             (status, lastMessage, datasetId))
+    def setDatasetCreationErrorIfNotFinished(self, datasetId, lastMessage):
+        ''' For the creations which have stopped without ending the status (e.g. the process has been killed). '''
+        self.cursor.execute("""
+            UPDATE dataset_creation_status 
+            SET status = 'error', last_message = %s
+            WHERE dataset_id = %s AND status IN ('pending', 'running');""",
+            (lastMessage, datasetId))
     def getDatasetCreationStatus(self, datasetId):
         """Returns None if the dataset creation status not exists.
         """
@@ -208,41 +288,129 @@ class DBDatasetsOperator():
         return dict(datasetId = row[0], status = row[1], lastMessage = row[2])
     def deleteDatasetCreationStatus(self, datasetId):
         self.cursor.execute("DELETE FROM dataset_creation_status WHERE dataset_id=%s;", (datasetId,))
+        self.increaseDatasetRevision(datasetId)
 
-    def createOrUpdateStudy(self, study, datasetId):
+    # Arbitrary key for the advisory lock which serializes the executors taking datasets from the creation queue.
+    DATASET_CREATION_QUEUE_LOCK_KEY = 7263001
+
+    def enqueueDatasetCreation(self, datasetId, priority = 0):
+        ''' Adds the dataset to the creation queue (or moves it back to waiting state if it is already there). '''
+        self.cursor.execute("""
+            INSERT INTO dataset_creation_queue (dataset_id, priority, enqueue_time) 
+            VALUES (%s, %s, now())
+            ON CONFLICT (dataset_id) DO UPDATE
+                SET priority = excluded.priority, enqueue_time = excluded.enqueue_time,
+                    start_time = NULL, owner = NULL, heartbeat_time = NULL;""", (datasetId, priority))
+
+    def deleteDatasetCreationFromQueue(self, datasetId) -> bool:
+        ''' Returns True if it was in the queue. If it was running, the executor owning it will stop it. '''
+        self.cursor.execute("DELETE FROM dataset_creation_queue WHERE dataset_id=%s;", (datasetId,))
+        return self.cursor.rowcount > 0
+
+    def isDatasetCreationRunning(self, datasetId, heartbeatTimeoutSeconds) -> bool:
         self.cursor.execute("""
+            SELECT 1 FROM dataset_creation_queue 
+            WHERE dataset_id = %s AND start_time IS NOT NULL 
+              AND heartbeat_time >= now() - make_interval(secs => %s);""", (datasetId, heartbeatTimeoutSeconds))
+        return self.cursor.fetchone() != None
+
+    def takeDatasetCreationFromQueue(self, owner, maxRunning, heartbeatTimeoutSeconds) -> str | None:
+        ''' Takes the next dataset to create (by priority and then FIFO), including the ones taken by an executor 
+            which has not updated the heartbeat in time (it is supposed dead). 
+            Returns None if the queue is empty or if there are already maxRunning creations in progress (by all the executors).
+        '''
+        self.cursor.execute("SELECT pg_advisory_xact_lock(%s);", (self.DATASET_CREATION_QUEUE_LOCK_KEY,))
+        self.cursor.execute("""
+            SELECT count(*) FROM dataset_creation_queue 
+            WHERE start_time IS NOT NULL AND heartbeat_time >= now() - make_interval(secs => %s);""", (heartbeatTimeoutSeconds,))
+        row = self.cursor.fetchone()
+        if row is None or row[0] >= maxRunning: return None
+        self.cursor.execute("""
+            UPDATE dataset_creation_queue 
+            SET start_time = now(), owner = %s, heartbeat_time = now()
+            WHERE dataset_id = (SELECT dataset_id FROM dataset_creation_queue
+                                WHERE start_time IS NULL OR heartbeat_time < now() - make_interval(secs => %s)
+                                ORDER BY priority DESC, enqueue_time
+                                LIMIT 1)
+            RETURNING dataset_id;""", (owner, heartbeatTimeoutSeconds))
+        row = self.cursor.fetchone()
+        return row[0] if row != None else None
+
+    def updateDatasetCreationHeartbeat(self, datasetId, owner) -> bool:
+        ''' Returns False if the dataset is not in the queue anymore or it is owned by another executor (i.e. canceled). '''
+        self.cursor.execute("""
+            UPDATE dataset_creation_queue SET heartbeat_time = now() 
+            WHERE dataset_id = %s AND owner = %s;""", (datasetId, owner))
+        return self.cursor.rowcount > 0
+
+    def getDatasetCreationOwner(self, datasetId) -> str | None:
+        ''' Returns None if the dataset is not in the queue (i.e. canceled), or empty string if it is waiting to be taken. '''
+        self.cursor.execute("SELECT COALESCE(owner, '') FROM dataset_creation_queue WHERE dataset_id = %s;", (datasetId,))
+        row = self.cursor.fetchone()
+        return None if row is None else row[0]
+
+    def deleteDatasetCreationFromQueueIfOwner(self, datasetId, owner):
+        self.cursor.execute("DELETE FROM dataset_creation_queue WHERE dataset_id = %s AND owner = %s;", (datasetId, owner))
+
+    def releaseDatasetCreationsOfOwners(self, owners: list[str]):
+        ''' Moves back to waiting state the datasets taken with those owners, to be taken again (by the same executor or another one). '''
+        self.cursor.execute("""
+            UPDATE dataset_creation_queue SET start_time = NULL, owner = NULL, heartbeat_time = NULL
+            WHERE owner = ANY(%s);""", (owners,))
+
+    def createOrUpdateStudy(self, study, datasetId):
+        self.createOrUpdateStudies([study], datasetId)
+
+    def createOrUpdateStudies(self, studies, datasetId):
+        ''' Creates (or updates if already exist) the studies and their series, and includes all of them in the dataset.
+            All the rows are sent in a few statements (execute_values) with set-based upserts.
+        '''
+        studiesRows = {}
+        datasetStudyRows = []
+        seriesRows = []
+        for study in studies:
+            # if the same study is twice, the last one is taken for the upsert 
+            # (and then the insert in dataset_study will fail, like inserting one by one)
+            studiesRows[study["studyId"]] = (study["studyId"], study["studyName"], study["subjectName"], 
+                                             study["pathInDatalake"], study["url"])
+            datasetStudyRows.append((datasetId, study["studyId"], json.dumps(study["series"])))
+            createdSeries = set()
+            for series in study['series']:
+                if series["folderName"] in createdSeries:
+                    logging.root.error("There are two series in the same folder name "
+                        +"[datasetId: %s, studyId: %s, folder: %s]" % (datasetId, study["studyId"], series["folderName"]))
+                    continue
+                createdSeries.add(series["folderName"])
+                seriesRows.append((study["studyId"], series["folderName"]))
+        if len(studiesRows) == 0: return
+        psycopg2.extras.execute_values(self.cursor, """
             INSERT INTO study (id, name, subject_name, path_in_datalake, url)
-            VALUES (%s,%s,%s,%s,%s)
+            VALUES %s
             ON CONFLICT (id) DO UPDATE
                 SET name = excluded.name,
                     subject_name = excluded.subject_name,
                     path_in_datalake = excluded.path_in_datalake,
                     url = excluded.url;""",
-            (study["studyId"], study["studyName"], study["subjectName"], 
-             study["pathInDatalake"], study["url"]))
+            list(studiesRows.values()), page_size=self.BULK_PAGE_SIZE)
+        # The studies may be included in other datasets, which show the upserted values.
         self.cursor.execute("""
+            UPDATE dataset SET revision = revision + 1
+            WHERE id = %s OR id IN (SELECT dataset_id FROM dataset_study WHERE study_id = ANY(%s));""",
+            (datasetId, list(studiesRows.keys())))
+        psycopg2.extras.execute_values(self.cursor, """
             INSERT INTO dataset_study (dataset_id, study_id, series)
-            VALUES (%s,%s,%s);""",
-            (datasetId, study["studyId"], json.dumps(study["series"])))
-        self.createSeries(datasetId, study["studyId"], study['series'])
-
-    def createSeries(self, datasetId, studyId, studySeries):
-        createdSeries = set()
-        for series in studySeries:
-            if series["folderName"] in createdSeries:
-                logging.root.error("There are two series in the same folder name "
-                    +"[datasetId: %s, studyId: %s, folder: %s]" % (datasetId, studyId, series["folderName"]))
-                continue
-            createdSeries.add(series["folderName"])
-            self.cursor.execute("""
-                INSERT INTO series (study_id, folder_name)
-                VALUES (%s,%s)
-                ON CONFLICT (study_id, folder_name) DO NOTHING;""",
-                (studyId, series["folderName"]))
-            self.cursor.execute("""
-                INSERT INTO dataset_study_series (dataset_id, study_id, series_folder_name)
-                VALUES (%s,%s,%s);""",
-                (datasetId, studyId, series["folderName"]))
+            VALUES %s;""",
+            datasetStudyRows, page_size=self.BULK_PAGE_SIZE)
+        if len(seriesRows) == 0: return
+        psycopg2.extras.execute_values(self.cursor, """
+            INSERT INTO series (study_id, folder_name)
+            VALUES %s
+            ON CONFLICT (study_id, folder_name) DO NOTHING;""",
+            seriesRows, page_size=self.BULK_PAGE_SIZE)
+        psycopg2.extras.execute_values(self.cursor, """
+            INSERT INTO dataset_study_series (dataset_id, study_id, series_folder_name)
+            VALUES %s;""",
+            [(datasetId, studyId, folderName) for studyId, folderName in seriesRows], page_size=self.BULK_PAGE_SIZE)
 
     def setDatasetStudyHash(self, datasetId, studyId, hash):
         self.cursor.execute("""
@@ -259,20 +427,71 @@ class DBDatasetsOperator():
     #     row = self.cursor.fetchone()
     #     return row[0]
 
-    def setSeriesHashCache(self, studyId, seriesDirName, hash, time: datetime):
+    def setSeriesHashCache(self, studyId, seriesDirName, hash, time: datetime, fingerprint: str|None = None):
         self.cursor.execute("""
-            UPDATE series set hash_cache=%s, hash_last_time_calculated=%s
+            UPDATE series set hash_cache=%s, hash_last_time_calculated=%s, hash_fingerprint=%s
             WHERE study_id = %s AND folder_name = %s;""",
-            (hash, time, studyId, seriesDirName))
+            (hash, time, fingerprint, studyId, seriesDirName))
 
-    def getSeriesHashCache(self, studyId, seriesDirName) -> tuple[bytes|None, datetime|None]:
+    def getSeriesHashCache(self, studyId, seriesDirName) -> tuple[bytes|None, datetime|None, str|None]:
         self.cursor.execute("""
-            SELECT hash_cache, hash_last_time_calculated FROM series
+            SELECT hash_cache, hash_last_time_calculated, hash_fingerprint FROM series
             WHERE study_id = %s AND folder_name = %s;""",
             (studyId, seriesDirName))
         row = self.cursor.fetchone()
-        if row is None: return None, None
-        return row[0], row[1]
+        if row is None: return None, None, None
+        return row[0], row[1], row[2]
+
+    def getSeriesHashCacheOfStudies(self, studyIds) -> dict[tuple[str, str], tuple[bytes, datetime|None, str|None]]:
+        ''' Loads in one query all the cached hashes of the series of the studies (usually all the studies of a dataset).
+            Returns a dict with key (studyId, seriesDirName) and value (hash, last_time_calculated, fingerprint).
+            The series without hash cached are not included.
+        '''
+        self.cursor.execute("""
+            SELECT study_id, folder_name, hash_cache, hash_last_time_calculated, hash_fingerprint FROM series
+            WHERE study_id = ANY(%s) AND hash_cache IS NOT NULL;""",
+            (list(studyIds),))
+        return {(row[0], row[1]): (row[2], row[3], row[4]) for row in self.cursor}
+
+    def setSeriesHashCacheBulk(self, entries: list[tuple[str, str, bytes, datetime, str|None]]):
+        ''' Same as setSeriesHashCache but for a batch of series in one statement. 
+            Each entry is a tuple (studyId, seriesDirName, hash, time, fingerprint).
+        '''
+        if len(entries) == 0: return
+        psycopg2.extras.execute_values(self.cursor, """
+            UPDATE series set hash_cache = v.hash_cache, hash_last_time_calculated = v.hash_last_time_calculated,
+                              hash_fingerprint = v.hash_fingerprint
+            FROM (VALUES %s) AS v (study_id, folder_name, hash_cache, hash_last_time_calculated, hash_fingerprint)
+            WHERE series.study_id = v.study_id AND series.folder_name = v.folder_name;""",
+            entries, template="(%s, %s, %s::bytea, %s::timestamp, %s::varchar)", page_size=len(entries))
+
+    def getSeriesHashManifest(self, studyId, seriesDirName) -> list | None:
+        ''' Returns the list of [relativePath, size, mtime_ns, hash] of the files of the series (or None if not stored). '''
+        self.cursor.execute("""
+            SELECT files FROM series_hash_manifest
+            WHERE study_id = %s AND folder_name = %s;""",
+            (studyId, seriesDirName))
+        row = self.cursor.fetchone()
+        if row is None: return None
+        return json.loads(row[0])
+
+    def getSeriesHashManifestsOfStudies(self, studyIds) -> dict[tuple[str, str], list]:
+        ''' Loads in one query the manifests of all the series of the studies (usually all the studies of a dataset).
+            Returns a dict with key (studyId, seriesDirName) and value the list of [relativePath, size, mtime_ns, hash].
+        '''
+        self.cursor.execute("""
+            SELECT study_id, folder_name, files FROM series_hash_manifest
+            WHERE study_id = ANY(%s);""",
+            (list(studyIds),))
+        return {(row[0], row[1]): json.loads(row[2]) for row in self.cursor}
+
+    def setSeriesHashManifestBulk(self, entries: list[tuple[str, str, list]]):
+        ''' Each entry is a tuple (studyId, seriesDirName, files), "files" is the list of [relativePath, size, mtime_ns, hash]. '''
+        if len(entries) == 0: return
+        psycopg2.extras.execute_values(self.cursor, """
+            INSERT INTO series_hash_manifest (study_id, folder_name, files) VALUES %s
+            ON CONFLICT (study_id, folder_name) DO UPDATE SET files = EXCLUDED.files;""",
+            [(studyId, seriesDirName, json.dumps(files)) for studyId, seriesDirName, files in entries], page_size=len(entries))
 
     def existsDataset(self, id):
         """Note: invalidated datasets also exist.
@@ -364,28 +583,30 @@ class DBDatasetsOperator():
         if ds["invalidated"]: ds["invalidationReason"] = row[43]
         return ds
 
-    def getStudiesFromDataset(self, datasetId, limit = 0, skip = 0):
-        if limit == 0: limit = 'ALL'
-
-        # First get total rows without LIMIT and OFFSET
-        self.cursor.execute("SELECT count(*) FROM dataset_study WHERE dataset_study.dataset_id = %s", (datasetId,))
-        row = self.cursor.fetchone()
-        total = row[0] if row != None else 0
-
-        self.cursor.execute(sql.SQL("""
-            SELECT study.id, study.name, study.subject_name, study.url, study.path_in_datalake, 
-                   dataset_study.series, dataset_study.hash, dataset_study.size_in_bytes
-            FROM study, dataset_study 
-            WHERE dataset_study.dataset_id = %s AND dataset_study.study_id = study.id 
-            ORDER BY study.name 
-            LIMIT {} OFFSET {};""").format(sql.SQL(str(limit)), sql.SQL(str(skip))),
-            (datasetId,)
-        )
-        res = []
-        for row in self.cursor:
-            res.append(dict(studyId = row[0], studyName = row[1], subjectName = row[2], pathInDatalake = row[4],
-                            series = json.loads(row[5]), url = row[3], hash = row[6], sizeInBytes = row[7]))
-        return res, total
+    _STUDIES_OF_DATASET_COLUMNS = sql.SQL("""study.id, study.name, study.subject_name, study.url, study.path_in_datalake, 
+                                             dataset_study.series, dataset_study.hash, dataset_study.size_in_bytes""")
+    _STUDIES_OF_DATASET_FROM = sql.SQL("""FROM study, dataset_study 
+                                          WHERE dataset_study.dataset_id = %s AND dataset_study.study_id = study.id""")
+    _STUDIES_OF_DATASET_SORT_KEYS = [(sql.SQL("study.name"), False, str), (sql.SQL("study.id"), False, str)]
+
+    @staticmethod
+    def _studyOfDatasetRowToDict(row) -> dict:
+        return dict(studyId = row[0], studyName = row[1], subjectName = row[2], pathInDatalake = row[4],
+                    series = json.loads(row[5]), url = row[3], hash = row[6], sizeInBytes = row[7])
+
+    def getStudiesFromDataset(self, datasetId, limit = 0, skip = 0, estimateTotalAbove = 0, 
+                              pageCursor: PageCursor | None = None) -> tuple[list[dict], int, PageCursor | None]:
+        rows, total, nextCursor = selectPageWithTotal(self.cursor, 
+            self._STUDIES_OF_DATASET_COLUMNS, self._STUDIES_OF_DATASET_FROM, self._STUDIES_OF_DATASET_SORT_KEYS, 
+            limit, skip, (datasetId,), estimateTotalAbove, pageCursor)
+        return [self._studyOfDatasetRowToDict(row) for row in rows], total, nextCursor
+
+    def streamStudiesFromDataset(self, datasetId, skip = 0, pageCursor: PageCursor | None = None, 
+                                 fetchSize: int = 1000) -> StreamedRows:
+        ''' Like getStudiesFromDataset without limit, but the studies are read while iterating (see StreamedRows). '''
+        return StreamedRows(self.cursor, 
+            self._STUDIES_OF_DATASET_COLUMNS, self._STUDIES_OF_DATASET_FROM, self._STUDIES_OF_DATASET_SORT_KEYS, 
+            skip, (datasetId,), pageCursor, self._studyOfDatasetRowToDict, fetchSize)
 
     def getPathsOfStudiesFromDataset(self, datasetId, returnDict: bool = False) -> list[str] | dict[str,str]:
         self.cursor.execute(sql.SQL("""
@@ -402,8 +623,8 @@ class DBDatasetsOperator():
 
     def getDatasets(self, skip, limit, searchString, searchFilter: authorization.Search_filter, 
                     sortBy = 'creationDate', sortDirection = '', searchSubject: str = '', 
-                    onlyLastVersions: bool = False):
-        fromExtra = sql.Composed([])
+                    onlyLastVersions: bool = False, estimateTotalAbove = 0, 
+                    pageCursor: PageCursor | None = None) -> tuple[list[dict], int, PageCursor | None]:
         whereClause = sql.Composed([])
 
         if searchFilter.invalidated == False:
@@ -462,18 +683,22 @@ class DBDatasetsOperator():
                     sql.SQL("(dataset.public = true {})").format(publicCondition)
                 )
         
+        # The searches by substring use the trigram indexes, so each condition must be on a single table 
+        # (the union of ids avoids the OR between columns of different tables).
         if searchString != '': 
             s = sql.Literal('%'+searchString+'%')
             whereClause += sql.SQL(
-                    " AND ( dataset.name ILIKE {} OR dataset.id LIKE {} OR author.name ILIKE {})"
+                    " AND dataset.id IN (SELECT id FROM dataset WHERE name ILIKE {} OR id LIKE {}"
+                    + " UNION SELECT dataset.id FROM dataset, author WHERE dataset.author_id = author.id AND author.name ILIKE {})"
                 ).format(s, s, s)
         
         if searchSubject != '':
-            fromExtra += sql.SQL(", dataset_study, study")
+            # Semi-join: each dataset is returned once, even if several subjects match.
             s = sql.Literal('%'+searchSubject+'%')
             whereClause += sql.SQL(
-                    " AND dataset.id = dataset_study.dataset_id AND dataset_study.study_id = study.id"
-                    + " AND study.subject_name ILIKE {}"
+                    " AND EXISTS (SELECT FROM dataset_study, study"
+                    + " WHERE dataset_study.dataset_id = dataset.id AND dataset_study.study_id = study.id"
+                    + " AND study.subject_name ILIKE {})"
                 ).format(s)
         
         if onlyLastVersions:
@@ -484,55 +709,46 @@ class DBDatasetsOperator():
                     " AND dataset.tags @> ARRAY[{}]::VARCHAR[]"
                 ).format(sql.SQL(', ').join(sql.Literal(item) for item in searchFilter.tags))
         
-        default = 'dataset.creation_date DESC'
+        # The sort keys end with the id to identify univocally each row (required for the pagination with cursor).
+        # The nullable columns are coalesced to be comparable with the values of the cursor.
+        default = [(sql.SQL('dataset.creation_date'), True, datetime), (sql.SQL('dataset.id'), True, str)]
         if sortBy == 'name':
-            dir = 'DESC' if sortDirection == 'descending' else 'ASC'
-            sortByClause = 'dataset.name %s, %s' % (dir, default)
+            desc = (sortDirection == 'descending')
+            sortKeys = [(sql.SQL('dataset.name'), desc, str)] + default
         elif sortBy == 'authorName':
-            dir = 'DESC' if sortDirection == 'descending' else 'ASC'
-            sortByClause = 'author.name %s, %s' % (dir, default)        
+            desc = (sortDirection == 'descending')
+            sortKeys = [(sql.SQL("COALESCE(author.name, '')"), desc, str)] + default
         elif sortBy == 'studiesCount':
-            dir = 'ASC' if sortDirection == 'ascending' else 'DESC'
-            sortByClause = 'dataset.studies_count %s, %s' % (dir, default)
+            desc = (sortDirection != 'ascending')
+            sortKeys = [(sql.SQL('dataset.studies_count'), desc, int)] + default
         elif sortBy == 'subjectsCount':
-            dir = 'ASC' if sortDirection == 'ascending' else 'DESC'
-            sortByClause = 'dataset.subjects_count %s, %s' % (dir, default)
+            desc = (sortDirection != 'ascending')
+            sortKeys = [(sql.SQL('dataset.subjects_count'), desc, int)] + default
         elif sortBy == 'timesUsed':
-            dir = 'ASC' if sortDirection == 'ascending' else 'DESC'
-            sortByClause = 'dataset.times_used %s, %s' % (dir, default)
+            desc = (sortDirection != 'ascending')
+            sortKeys = [(sql.SQL('COALESCE(dataset.times_used, 0)'), desc, int)] + default
         else:  # sortBy == 'creationDate' or ''
-            dir = 'ASC' if sortDirection == 'ascending' else 'DESC'
-            sortByClause = 'dataset.creation_date %s' % dir
-
-        if limit == 0: limit = 'ALL'
-
-        # First get total rows without LIMIT and OFFSET
-        self.cursor.execute(sql.SQL("""
-            SELECT count(*) FROM dataset, author{}
-            WHERE dataset.author_id = author.id {}""").format(fromExtra, whereClause))
-        row = self.cursor.fetchone()
-        total = row[0] if row != None else 0
+            desc = (sortDirection != 'ascending')
+            sortKeys = [(sql.SQL('dataset.creation_date'), desc, datetime), (sql.SQL('dataset.id'), desc, str)]
 
-        q = sql.SQL("""
-                SELECT dataset.id, dataset.name, author.name, dataset.creation_date, dataset.project_code, 
-                    dataset.draft, dataset.public, dataset.invalidated, dataset.corrupted,
-                    dataset.studies_count, dataset.subjects_count, dataset.version, dataset.tags, 
-                    dataset.times_used, dataset.public_use
-                FROM dataset, author{}
-                WHERE dataset.author_id = author.id {}
-                ORDER BY {} 
-                LIMIT {} OFFSET {};"""
-            ).format(fromExtra, whereClause, sql.SQL(str(sortByClause)), sql.SQL(str(limit)), sql.SQL(str(skip)))
-        logging.root.debug("QUERY: " + q.as_string(self.conn))
-        self.cursor.execute(q)
+        fromAndWhere = sql.SQL("""
+                FROM dataset, author
+                WHERE dataset.author_id = author.id {}""").format(whereClause)
+        logging.root.debug("QUERY: " + fromAndWhere.as_string(self.conn))
+        rows, total, nextCursor = selectPageWithTotal(self.cursor, 
+            sql.SQL("""dataset.id, dataset.name, author.name, dataset.creation_date, dataset.project_code, 
+                       dataset.draft, dataset.public, dataset.invalidated, dataset.corrupted,
+                       dataset.studies_count, dataset.subjects_count, dataset.version, dataset.tags, 
+                       dataset.times_used, dataset.public_use"""),
+            fromAndWhere, sortKeys, limit, skip, estimateTotalAbove = estimateTotalAbove, after = pageCursor)
         res = []
-        for row in self.cursor:
+        for row in rows:
             creationDate = str(row[3].astimezone())   # row[3] is a datetime without time zone, just add the local tz.
                                                       # If local tz is UTC, the string "+00:00" is added at the end.
             res.append(dict(id = row[0], name = row[1], version = row[11], authorName = row[2], creationDate = creationDate, project = row[4],
                             draft = row[5], public = row[6], publicUse = row[14], invalidated = row[7], corrupted = row[8], tags = row[12],
                             studiesCount = row[9], subjectsCount = row[10], timesUsed = row[13]))
-        return res, total
+        return res, total, nextCursor
     
     def getProjectsForSearchFilter(self, searchFilter: authorization.Search_filter):
         whereClause = sql.Composed([])
@@ -624,59 +840,66 @@ class DBDatasetsOperator():
                 VALUES (%s, %s)
                 ON CONFLICT (dataset_id, user_id) DO NOTHING;""", 
                 (datasetId, newUserId))
+        self.increaseDatasetRevision(datasetId)
         
     def deleteUserFromDatasetACL(self, datasetId, userId):
         self.cursor.execute(
             "DELETE FROM dataset_acl WHERE dataset_id=%s AND user_id = %s;", 
             (datasetId, userId))
+        self.increaseDatasetRevision(datasetId)
 
     def clearDatasetACL(self, datasetId):
         self.cursor.execute(
             "DELETE FROM dataset_acl WHERE dataset_id=%s;", (datasetId,))
+        self.increaseDatasetRevision(datasetId)
     
     def deleteDataset(self, datasetId):
         self.cursor.execute("DELETE FROM dataset_creation_status WHERE dataset_id=%s;", (datasetId,))
+        self.cursor.execute("DELETE FROM dataset_creation_queue WHERE dataset_id=%s;", (datasetId,))
+        self.cursor.execute("DELETE FROM study_search_facets WHERE dataset_id=%s;", (datasetId,))
         self.cursor.execute("DELETE FROM dataset_study WHERE dataset_id=%s;", (datasetId,))
         self.cursor.execute("DELETE FROM dataset_study_series WHERE dataset_id=%s;", (datasetId,))
         self.cursor.execute("DELETE FROM dataset WHERE id=%s;", (datasetId,))
+        self.increaseSearchRevision()
 
     def deleteOrphanStudies(self):
         '''This is a kind of garbage-collection that deletes all the studies not included in any dataset_study.'''
         self.cursor.execute("""
-            SELECT COUNT(*) FROM study as s
-            WHERE not exists (select ds.study_id 
-                              from dataset_study as ds
-                              where ds.study_id = s.id);""")
+            WITH deleted AS (
+                DELETE FROM study as s
+                WHERE not exists (select ds.study_id 
+                                  from dataset_study as ds
+                                  where ds.study_id = s.id)
+                RETURNING 1)
+            SELECT COUNT(*) FROM deleted;""")
         row = self.cursor.fetchone()
         total = row[0] if row != None else 0
         if total == 0:
             logging.root.debug("There are no orphan studies to remove (all of them were included in datasets).")
-            return
-        logging.root.debug("There are %d orphan studies (not included in any dataset), removing..." % total )
-        self.cursor.execute("""
-            DELETE FROM study as s
-            WHERE not exists (select ds.study_id 
-                              from dataset_study as ds
-                              where ds.study_id = s.id);""")
+        else:
+            logging.root.debug("Removed %d orphan studies (not included in any dataset)." % total)
 
     def deleteOrphanSeries(self):
         '''This is a kind of garbage-collection that deletes all the series not included in any dataset_study_series.'''
         self.cursor.execute("""
-            SELECT COUNT(*) FROM series as s
+            DELETE FROM series_hash_manifest as m
             WHERE not exists (select dss.study_id, dss.series_folder_name 
                               from dataset_study_series as dss
-                              where dss.study_id = s.study_id and dss.series_folder_name = s.folder_name );""")
+                              where dss.study_id = m.study_id and dss.series_folder_name = m.folder_name );""")
+        self.cursor.execute("""
+            WITH deleted AS (
+                DELETE FROM series as s
+                WHERE not exists (select dss.study_id, dss.series_folder_name 
+                                  from dataset_study_series as dss
+                                  where dss.study_id = s.study_id and dss.series_folder_name = s.folder_name )
+                RETURNING 1)
+            SELECT COUNT(*) FROM deleted;""")
         row = self.cursor.fetchone()
         total = row[0] if row != None else 0
         if total == 0:
             logging.root.debug("There are no orphan series to remove (all of them were included in datasets).")
-            return
-        logging.root.debug("There are %d orphan series (not included in any dataset), removing..." % total )
-        self.cursor.execute("""
-            DELETE FROM series as s
-            WHERE not exists (select dss.study_id, dss.series_folder_name 
-                              from dataset_study_series as dss
-                              where dss.study_id = s.study_id and dss.series_folder_name = s.folder_name );""")
+        else:
+            logging.root.debug("Removed %d orphan series (not included in any dataset)." % total)
 
     def getLicenses(self):
         self.cursor.execute("""
@@ -696,67 +919,73 @@ class DBDatasetsOperator():
         return dict(title = row[0], url = row[1])
 
     def setZenodoDOI(self, id, newValue: str | None):
-        self.cursor.execute("UPDATE dataset SET zenodo_doi = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, zenodo_doi = %s WHERE id = %s;", (newValue, id))
 
     def setDatasetInvalidated(self, id, newValue: bool):
-        self.cursor.execute("UPDATE dataset SET invalidated = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, invalidated = %s WHERE id = %s;", (newValue, id))
+        self.increaseSearchRevision()
 
     def setDatasetInvalidationReason(self, id, newValue: str | None):
-        self.cursor.execute("UPDATE dataset SET invalidation_reason = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, invalidation_reason = %s WHERE id = %s;", (newValue, id))
 
     def setDatasetPublic(self, id, newValue: bool):
-        self.cursor.execute("UPDATE dataset SET public = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, public = %s WHERE id = %s;", (newValue, id))
+        self.increaseSearchRevision()
 
     def setDatasetPublicUse(self, id, newValue: bool):
-        self.cursor.execute("UPDATE dataset SET public_use = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, public_use = %s WHERE id = %s;", (newValue, id))
         
     def setDatasetDraft(self, id, newValue: bool):
-        self.cursor.execute("UPDATE dataset SET draft = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, draft = %s WHERE id = %s;", (newValue, id))
+        self.increaseSearchRevision()
 
     def setDatasetName(self, id, newValue: str):
-        self.cursor.execute("UPDATE dataset SET name = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, name = %s WHERE id = %s;", (newValue, id))
+        self.increaseSearchRevision()
     
     def setDatasetVersion(self, id, newValue: str):
-        self.cursor.execute("UPDATE dataset SET version = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, version = %s WHERE id = %s;", (newValue, id))
 
     def setDatasetDescription(self, id, newValue: str):
-        self.cursor.execute("UPDATE dataset SET description = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, description = %s WHERE id = %s;", (newValue, id))
+        self.increaseSearchRevision()
     
     def setDatasetTags(self, id, newValue: list[str]):
-        self.cursor.execute("UPDATE dataset SET tags = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, tags = %s WHERE id = %s;", (newValue, id))
+        self.increaseSearchRevision()
     
     def setDatasetProvenance(self, id, newValue: str):
-        self.cursor.execute("UPDATE dataset SET provenance = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, provenance = %s WHERE id = %s;", (newValue, id))
 
     def setDatasetPurpose(self, id, newValue: str):
-        self.cursor.execute("UPDATE dataset SET purpose = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, purpose = %s WHERE id = %s;", (newValue, id))
 
     def setDatasetPreviousId(self, id, newValue: str | None):
-        self.cursor.execute("UPDATE dataset SET previous_id = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, previous_id = %s WHERE id = %s;", (newValue, id))
 
     def setDatasetNextId(self, id, newValue: str | None):
-        self.cursor.execute("UPDATE dataset SET next_id = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, next_id = %s WHERE id = %s;", (newValue, id))
 
     def setDatasetType(self, id, newValue: list[str]):
-        self.cursor.execute("UPDATE dataset SET type = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, type = %s WHERE id = %s;", (newValue, id))
     
     def setDatasetCollectionMethod(self, id, newValue: list[str]):
-        self.cursor.execute("UPDATE dataset SET collection_method = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, collection_method = %s WHERE id = %s;", (newValue, id))
     
     def setDatasetLicense(self, datasetId, newTitle: str, newUrl: str):
-        self.cursor.execute("UPDATE dataset SET license_title = %s, license_url = %s WHERE id = %s;", 
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, license_title = %s, license_url = %s WHERE id = %s;", 
                             (newTitle, newUrl, datasetId))
 
     def setDatasetPid(self, id, preferred: str, custom: str | None = None):
         newValue = self.PREFERRED_ZENODO if preferred == "zenodoDoi" else custom
-        self.cursor.execute("UPDATE dataset SET pid_url = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, pid_url = %s WHERE id = %s;", (newValue, id))
 
     def setDatasetContactInfo(self, id, newValue: str | None):
-        self.cursor.execute("UPDATE dataset SET contact_info = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, contact_info = %s WHERE id = %s;", (newValue, id))
     
     def setDatasetAuthor(self, id, newValue: str):
-        self.cursor.execute("UPDATE dataset SET author_id = %s WHERE id = %s;", (newValue, id))
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, author_id = %s WHERE id = %s;", (newValue, id))
 
     def setDatasetLastIntegrityCheck(self, id, newStatusCorrupted: bool, newDate: datetime | None):
-        self.cursor.execute("UPDATE dataset SET corrupted = %s, last_integrity_check = %s WHERE id = %s;", 
+        self.cursor.execute("UPDATE dataset SET revision = revision + 1, corrupted = %s, last_integrity_check = %s WHERE id = %s;", 
                             (newStatusCorrupted, newDate, id))
@@ -1,6 +1,9 @@
 from psycopg2 import sql
 import logging
 import json
+import time
+import threading
+from collections import OrderedDict
 from .DB import DB
 from . import eucaim_formats
 
@@ -78,7 +81,7 @@ def _searchConditionNumValueToSQL(key, type, value) -> sql.Composed:
         raise SearchValidationException("unknown 'type' in condition for %s" % key)
 
 
-def _searchConditionStringToSQL(sr, key_translated, db_column, translate) -> sql.Composed:
+def _translateSearchConditionStringValue(sr, key_translated, translate):
     if sr['type'] in ["IN"]:
         _ensureValueIsArrayOfString(sr, key_translated)
         value_translated = []
@@ -94,6 +97,10 @@ def _searchConditionStringToSQL(sr, key_translated, db_column, translate) -> sql
         except Exception as e: 
             raise SearchValidationException("Unknown value '%s' in condition with key '%s' (%s)." % (sr['value'], sr['key'], key_translated))
     else: raise SearchValidationException("Unknown type '%s' in condition with key '%s' (%s)." % (sr['type'], sr['key'], key_translated))
+    return value_translated
+
+def _searchConditionStringToSQL(sr, key_translated, db_column, translate) -> sql.Composed:
+    value_translated = _translateSearchConditionStringValue(sr, key_translated, translate)
     return _searchConditionStringValueToSQL(db_column, sr['type'], value_translated)
 
 
@@ -123,40 +130,100 @@ def _searchConditionNumToSQL(sr, key_translated, db_column, translate) -> sql.Co
     else: raise SearchValidationException("Unknown type '%s' in condition with key '%s' (%s)." % (sr['type'], sr['key'], key_translated))
     return _searchConditionNumValueToSQL(db_column, sr['type'], value_translated)
 
-def _sqlSeriesConditionsToSqlStudiesCondition(sqlSeriesCondition: sql.Composable) -> sql.Composable:
-    return sql.SQL("""EXISTS (
+def _searchConditionStringValueToArraySQL(array_column, type, value) -> sql.Composed | None:
+    ''' Returns the condition over the array in study_search_facets (without NULLs) equivalent to 
+        "exists a series of the study satisfying the condition", or None if it can not be expressed (conditions on NULL).
+    '''
+    if type == "EQUALS":
+        if value is None: return None
+        return sql.SQL("{} @> ARRAY[{}]::varchar[]").format(sql.SQL(array_column), sql.Literal(value))
+    elif type == "NOT_EQUALS":
+        if value is None:
+            return sql.SQL("cardinality({}) > 0").format(sql.SQL(array_column))
+        else: return sql.SQL("NOT {} <@ ARRAY[{}]::varchar[]").format(sql.SQL(array_column), sql.Literal(value))
+    elif type == "IN":
+        if value.count(None) > 0 or len(value) == 0: return None
+        return sql.SQL("{} && ARRAY[{}]::varchar[]").format(sql.SQL(array_column), 
+                                                            sql.SQL(', ').join(sql.Literal(item) for item in value))
+    elif type == "CONTAINS":
+        return sql.SQL("EXISTS (SELECT FROM unnest({}) AS v WHERE v ILIKE {})").format(sql.SQL(array_column), 
+                                                                                     sql.Literal('%'+value+'%'))
+    else: 
+        raise SearchValidationException("unknown 'type' in condition for %s" % array_column)
+
+class _SeriesCondition():
+    ''' A condition on the series of a study.
+        seriesSql: the condition for each series (in the subquery on the tables dataset_study_series and series).
+        studyPrefilter: a condition on the arrays of study_search_facets which is satisfied at least 
+                        by all the studies with any series satisfying seriesSql (None if there is not).
+        isExact: the studyPrefilter is satisfied only by those studies, so the subquery is not required.
+    '''
+    def __init__(self, seriesSql: sql.Composable, studyPrefilter: sql.Composable | None = None, isExact: bool = False):
+        self.seriesSql = seriesSql
+        self.studyPrefilter = studyPrefilter
+        self.isExact = isExact and studyPrefilter is not None
+
+    @staticmethod
+    def join(operand: str, conditions: list) -> '_SeriesCondition':
+        seriesSql = sql.SQL("(") + sql.SQL(' %s ' % operand).join(c.seriesSql for c in conditions) + sql.SQL(")")
+        if len(conditions) == 1:
+            return _SeriesCondition(seriesSql, conditions[0].studyPrefilter, conditions[0].isExact)
+        prefilters = [c.studyPrefilter for c in conditions if c.studyPrefilter is not None]
+        if operand == 'AND':
+            # Not exact: all the conditions must be satisfied by the same series, not by any series of the study.
+            if len(prefilters) == 0: return _SeriesCondition(seriesSql)
+            return _SeriesCondition(seriesSql, sql.SQL("(") + sql.SQL(' AND ').join(prefilters) + sql.SQL(")"))
+        else:  # OR
+            if len(prefilters) < len(conditions): return _SeriesCondition(seriesSql)
+            return _SeriesCondition(seriesSql, sql.SQL("(") + sql.SQL(' OR ').join(prefilters) + sql.SQL(")"), 
+                                    all(c.isExact for c in conditions))
+
+    def toStudiesCondition(self) -> sql.Composable:
+        if self.isExact: return self.studyPrefilter
+        existsSql = sql.SQL("""EXISTS (
                         SELECT series.folder_name FROM dataset_study_series, series 
-                        WHERE dataset_study_series.dataset_id = dataset_study.dataset_id
-                            AND dataset_study_series.study_id = dataset_study.study_id
+                        WHERE dataset_study_series.dataset_id = study.dataset_id
+                            AND dataset_study_series.study_id = study.study_id
                             AND series.study_id = dataset_study_series.study_id
                             AND series.folder_name = dataset_study_series.series_folder_name
                             AND {}
-                        )""").format(sqlSeriesCondition)
+                        )""").format(self.seriesSql)
+        if self.studyPrefilter is None: return existsSql
+        return sql.SQL("(") + self.studyPrefilter + sql.SQL(" AND ") + existsSql + sql.SQL(")")
 
-def _searchRequestToSQL(sr: dict) -> tuple[sql.Composable, bool]:
+def _searchConditionSeriesToSQL(sr, key_translated, db_column, db_array_column, translate) -> _SeriesCondition:
+    value_translated = _translateSearchConditionStringValue(sr, key_translated, translate)
+    # the array condition first because the IN condition removes the None from the value
+    arraySql = _searchConditionStringValueToArraySQL(db_array_column, sr['type'], value_translated)
+    seriesSql = _searchConditionStringValueToSQL(db_column, sr['type'], value_translated)
+    if arraySql is None: return _SeriesCondition(sql.SQL("(") + seriesSql + sql.SQL(")"))
+    return _SeriesCondition(sql.SQL("(") + seriesSql + sql.SQL(")"), sql.SQL("(") + arraySql + sql.SQL(")"), isExact=True)
+
+def _searchRequestToSQL(sr: dict) -> sql.Composable | _SeriesCondition:
+    ''' Returns the SQL condition on the table study_search_facets (aliased as study),
+        or a _SeriesCondition if all the conditions in the request are on the series.
+    '''
     if 'operand' in sr:   # it is an OPERATION: AND/OR of CONDITIONs
         if not sr['operand'] in ['AND', 'OR']: raise SearchValidationException("unknown value for 'operand'")
         if not 'children' in sr:                raise SearchValidationException("missing 'children' in operation")
         if not isinstance(sr['children'], list): raise SearchValidationException("'children' in operation must be an array")
-        if len(sr['children']) == 0: return sql.SQL(""), False
+        if len(sr['children']) == 0: return sql.SQL("")
         sqlStudiesConditions = []
-        sqlSeriesConditions = []
+        seriesConditions = []
         for child in sr['children']:
-            sqlCondition, isSeriesCondition = _searchRequestToSQL(child)
-            if isSeriesCondition: sqlSeriesConditions.append(sqlCondition)
-            else:                 sqlStudiesConditions.append(sqlCondition)
+            condition = _searchRequestToSQL(child)
+            if isinstance(condition, _SeriesCondition): seriesConditions.append(condition)
+            else:                                       sqlStudiesConditions.append(condition)
         if len(sqlStudiesConditions) > 0:
-            if len(sqlSeriesConditions) > 0:  # both studies and series conditions
-                seriesOperation = sql.SQL(' %s ' % sr['operand']).join(sqlSeriesConditions)
-                seriesOperation = sql.SQL("(")+seriesOperation+sql.SQL(")")
-                seriesOperation = _sqlSeriesConditionsToSqlStudiesCondition(seriesOperation)
-                sqlStudiesConditions.append(seriesOperation)
+            if len(seriesConditions) > 0:  # both studies and series conditions
+                sqlStudiesConditions.append(_SeriesCondition.join(sr['operand'], seriesConditions).toStudiesCondition())
             operation = sql.SQL(' %s ' % sr['operand']).join(sqlStudiesConditions)
-            return sql.SQL("(")+operation+sql.SQL(")"), False
+            return sql.SQL("(")+operation+sql.SQL(")")
         else: # only series conditions
-            operation = sql.SQL(' %s ' % sr['operand']).join(sqlSeriesConditions)
-            return sql.SQL("(")+operation+sql.SQL(")"), True
+            return _SeriesCondition.join(sr['operand'], seriesConditions)
     elif 'key' in sr:   # it is a CONDITION
+        # Modality, body part and manufacturer are properties of series
+        isSeriesCondition = (sr['key'] in ['RID10311', 'SNOMEDCT123037004', 'C25392'])
         try:
             if not 'type' in sr: raise SearchValidationException("missing 'type' in condition")
             if not 'value' in sr: raise SearchValidationException("missing 'value' in condition")
@@ -169,29 +236,95 @@ def _searchRequestToSQL(sr: dict) -> tuple[sql.Composable, bool]:
             elif sr['key'] == 'SNOMEDCT432213005':  # year_of_diagnosis
                 res = _searchConditionNumToSQL(sr, 'year of diagnosis', 'study.diagnosis_year', eucaim_formats.getYear)
             elif sr['key'] == 'RID10311':  # modality   SNOMEDCT363679005
-                res = _searchConditionStringToSQL(sr, 'modality', 'series.modality', eucaim_formats.getModality)
+                return _searchConditionSeriesToSQL(sr, 'modality', 'series.modality', 'study.modalities', 
+                                                   eucaim_formats.getModality)
             elif sr['key'] == 'SNOMEDCT123037004':  # body part   # mejor SNOMEDCT38866009 ?
-                res = _searchConditionStringToSQL(sr, 'body part', 'series.body_part', eucaim_formats.getBodyPart)
+                return _searchConditionSeriesToSQL(sr, 'body part', 'series.body_part', 'study.body_parts', 
+                                                   eucaim_formats.getBodyPart)
             elif sr['key'] == 'C25392':  # manufacturer
-                res = _searchConditionStringToSQL(sr, 'Manufacturer', 'series.manufacturer', eucaim_formats.getManufacturer)
+                return _searchConditionSeriesToSQL(sr, 'Manufacturer', 'series.manufacturer', 'study.manufacturers', 
+                                                   eucaim_formats.getManufacturer)
             else: raise SearchValidationException("Unkown key '%s' in condition." % sr['key'])
         except SearchValidationException as e:
             logging.root.warn(str(e))
+            if isSeriesCondition: return _SeriesCondition(sql.SQL("(FALSE)"), sql.SQL("(FALSE)"), isExact=True)
             res = sql.SQL("FALSE")
-        # Modality, body part and manufacturer are properties of series
-        isSeriesCondition = (sr['key'] in ['RID10311', 'SNOMEDCT123037004', 'C25392'])
-        return sql.SQL("(") + res + sql.SQL(")"), isSeriesCondition
+        return sql.SQL("(") + res + sql.SQL(")")
     else: raise SearchValidationException("missing 'operand' or 'key'")
 
+def _canonicalizeSearchRequest(sr):
+    ''' Returns a copy of the search request with the children of operations and the values of IN conditions sorted, 
+        so the same search written in different order gets the same key in the cache. 
+    '''
+    if not isinstance(sr, dict): return sr
+    res = {k: _canonicalizeSearchRequest(v) for k, v in sr.items() if k != 'children'}
+    if 'children' in sr:
+        children = sr['children']
+        if isinstance(children, list):
+            children = sorted((_canonicalizeSearchRequest(c) for c in children), key=lambda c: json.dumps(c, sort_keys=True))
+        res['children'] = children
+    if res.get('type') == "IN" and isinstance(res.get('value'), list):
+        res['value'] = sorted(res['value'], key=lambda v: json.dumps(v))
+    return res
+
+class EUCAIMSearchResultsCache():
+    ''' Cache of the results of eucaimSearchDatasets, shared by the threads of the process.
+        Each entry expires after ttlSeconds and is discarded when the search revision in DB changes 
+        (any change in datasets which may change the results, see DBDatasetsOperator.increaseSearchRevision()).
+        The least recently used entries are evicted when there are more than maxEntries.
+    '''
+    def __init__(self, maxEntries: int, ttlSeconds: int):
+        self.maxEntries = maxEntries
+        self.ttlSeconds = ttlSeconds
+        self._entries = OrderedDict()   # key -> (expiration time, search revision, results)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def getKey(searchRequest: dict, tagFilter: str) -> str:
+        return json.dumps(_canonicalizeSearchRequest(searchRequest), sort_keys=True, separators=(',', ':')) + '|' + tagFilter
+
+    def get(self, key: str, searchRevision: int):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] < time.monotonic() or entry[1] != searchRevision):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key: str, searchRevision: int, results: list):
+        if self.maxEntries <= 0: return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttlSeconds, searchRevision, results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+    def getStats(self) -> dict:
+        with self._lock:
+            return dict(entries = len(self._entries), maxEntries = self.maxEntries, ttlSeconds = self.ttlSeconds,
+                        hits = self.hits, misses = self.misses)
+
 class DBDatasetsEUCAIMSearcher():
     def __init__(self, db: DB):
         self.cursor = db.cursor
         self.conn = db.conn
 
+    def getSearchRevision(self) -> int:
+        self.cursor.execute("SELECT search_revision FROM metadata LIMIT 1;")
+        row = self.cursor.fetchone()
+        return row[0] if row is not None else 0
+
     def eucaimSearchDatasets(self, searchRequest: dict, tagFilter: str = '', skip: int = 0, limit: int = 0):
-        whereClause, isSeriesCondition = _searchRequestToSQL(searchRequest)
-        if isSeriesCondition:
-            whereClause = _sqlSeriesConditionsToSqlStudiesCondition(whereClause)
+        whereClause = _searchRequestToSQL(searchRequest)
+        if isinstance(whereClause, _SeriesCondition):
+            whereClause = whereClause.toStudiesCondition()
         if whereClause != sql.SQL(""):
             whereClause = sql.SQL("AND ") + whereClause
         if tagFilter != '':
@@ -201,11 +334,11 @@ class DBDatasetsEUCAIMSearcher():
         q = sql.SQL("""
                 SELECT dataset.id, dataset.name, dataset.creation_date, 
                     dataset.draft, dataset.public, dataset.invalidated, 
-                    COUNT(study.id), COUNT(DISTINCT study.subject_name), 
+                    COUNT(study.study_id), COUNT(DISTINCT study.subject_name), 
                     dataset.age_low_in_days, dataset.age_high_in_days, dataset.sex, 
                     dataset.modality, dataset.body_part, dataset.description
-                FROM dataset, dataset_study, study
-                WHERE dataset.id = dataset_study.dataset_id AND dataset_study.study_id = study.id
+                FROM dataset, study_search_facets AS study
+                WHERE dataset.id = study.dataset_id
                       AND dataset.public = true AND dataset.draft = false AND dataset.invalidated = false {}
                 GROUP BY dataset.id
                 ORDER BY dataset.creation_date DESC
@@ -0,0 +1,73 @@
+import base64
+import json
+import unittest
+from datetime import datetime
+from psycopg2 import sql
+from dataset_service.storage import PageCursor, PageCursorException
+from dataset_service.storage.DB import _getKeysetCondition, _getOrderByAndSignature, _addPageCursorCondition
+
+SORT_KEYS = [(sql.SQL("dataset.name"), False, str), (sql.SQL("dataset.creation_date"), True, datetime),
+             (sql.SQL("dataset.id"), True, str)]
+
+def _encodeRaw(data) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+class PageCursorTest(unittest.TestCase):
+    def test_encodeDecode(self):
+        cursor = PageCursor(60, 1234, ["na%me", datetime(2024, 5, 6, 7, 8, 9, 123456), "id1"], 987)
+        decoded = PageCursor.decode(cursor.encode())
+        self.assertEqual((decoded.position, decoded.total, decoded.signature), (60, 1234, 987))
+        # the datetime is encoded as string (and converted again when it is bound in the query)
+        self.assertEqual(decoded.keyValues, ["na%me", "2024-05-06 07:08:09.123456", "id1"])
+        self.assertNotIn('=', cursor.encode())
+
+    def test_decodeMalformed(self):
+        for cursor in ["", "not base64!", _encodeRaw({"a": 1}), _encodeRaw([1, 2, 3]),
+                       _encodeRaw(["1", 2, [], 3]), _encodeRaw([1, 2, "x", 3])]:
+            with self.assertRaises(PageCursorException, msg=cursor): PageCursor.decode(cursor)
+
+
+class KeysetConditionTest(unittest.TestCase):
+    def test_condition(self):
+        condition, params = _getKeysetCondition(SORT_KEYS, ["a%b", "2024-01-02 03:04:05", "id1"])
+        self.assertEqual(condition.as_string(None),
+                         "((dataset.name > %s) OR (dataset.name = %s AND dataset.creation_date < %s) "
+                         "OR (dataset.name = %s AND dataset.creation_date = %s AND dataset.id < %s))")
+        date = datetime(2024, 1, 2, 3, 4, 5)
+        self.assertEqual(params, ["a%b", "a%b", date, "a%b", date, "id1"])
+
+    def test_wrongTypes(self):
+        for keyValues in [[1, "2024-01-02", "id1"], ["a", "not a date", "id1"], ["a", 5, "id1"],
+                          ["a", "2024-01-02", ["id1"]], ["a", "2024-01-02", {"x": 1}]]:
+            with self.assertRaises(PageCursorException, msg=str(keyValues)): _getKeysetCondition(SORT_KEYS, keyValues)
+        with self.assertRaises(PageCursorException): _getKeysetCondition([(sql.SQL("a"), False, int)], [True])
+        _getKeysetCondition([(sql.SQL("a"), False, int)], [3])
+
+    def test_addCondition(self):
+        orderBy, signature = _getOrderByAndSignature(None, SORT_KEYS)
+        self.assertEqual(orderBy.as_string(None), "dataset.name ASC, dataset.creation_date DESC, dataset.id DESC")
+        fromAndWhere = sql.SQL("FROM dataset WHERE dataset.project_code = %s")
+        after = PageCursor(30, 100, ["a", "2024-01-02", "id1"], signature)
+        query, params = _addPageCursorCondition(None, fromAndWhere, ("P1",), SORT_KEYS, signature, after)
+        self.assertTrue(query.as_string(None).startswith("FROM dataset WHERE dataset.project_code = %s AND ((dataset.name > %s)"))
+        self.assertEqual(params[0], "P1")
+        self.assertEqual(len(params), 7)
+
+    def test_addConditionWithoutParams(self):
+        ''' The query without params may contain '%' which must be escaped when the params of the cursor are added. '''
+        _, signature = _getOrderByAndSignature(None, SORT_KEYS)
+        fromAndWhere = sql.SQL("FROM dataset WHERE dataset.name ILIKE '%x%'")
+        after = PageCursor(30, 100, ["a", "2024-01-02", "id1"], signature)
+        query, params = _addPageCursorCondition(None, fromAndWhere, None, SORT_KEYS, signature, after)
+        self.assertTrue(query.as_string(None).startswith("FROM dataset WHERE dataset.name ILIKE '%%x%%' AND "))
+        self.assertEqual(len(params), 6)
+
+    def test_cursorOfOtherList(self):
+        _, signature = _getOrderByAndSignature(None, SORT_KEYS)
+        fromAndWhere = sql.SQL("FROM dataset WHERE true")
+        for after in [PageCursor(30, 100, ["a", "2024-01-02", "id1"], signature + 1), PageCursor(30, 100, ["a", "id1"], signature)]:
+            with self.assertRaises(PageCursorException):
+                _addPageCursorCondition(None, fromAndWhere, None, SORT_KEYS, signature, after)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -230,6 +230,19 @@ def checkStudiesHashes(studiesHashes0, studiesHashes):
             if wrongCount < 4: logging.root.info('Wrong study: '+studyId)
 
     logging.root.info('%d/%d studies wrong' % (wrongCount, len(studiesHashes)))
+
+def alteredSeriesToString(alteredSeries, maxItems = 10):
+    ''' Short description of the files altered (from datasetHashesOperator.alteredSeries) for the integrity report. '''
+    items = []
+    for series in alteredSeries:
+        if series["files"] is None or len(series["files"]) == 0:
+            items.append('%s/%s (unknown files)' % (series["studyId"], series["series"]))
+        else:
+            for f in series["files"]: items.append('%s/%s/%s' % (series["studyId"], series["series"], f))
+    if len(items) == 0: return ''
+    s = ', '.join(items[:maxItems])
+    if len(items) > maxItems: s += ' and %d more' % (len(items) - maxItems)
+    return s
     
 
 def checkDatasetIntegrity(authClient: auth.AuthClient, tracerUrl, datasetId, datasetDirPath, indexFileName, eformsFileName, 
@@ -241,6 +254,10 @@ def checkDatasetIntegrity(authClient: auth.AuthClient, tracerUrl, datasetId, dat
     if not checkHash(indexHash0,        indexHash,        'index'):        return 'index'
     if not checkHash(imagesHash0,       imagesHash,       'images'):       
         checkStudiesHashes(studiesHashes0, studiesHashes)
+        alteredFiles = alteredSeriesToString(hashOperator.alteredSeries)
+        if alteredFiles != '': 
+            logging.root.info('Altered files since the last time the hashes were cached: ' + alteredFiles)
+            return 'images (altered: %s)' % alteredFiles
         return 'images'
     logging.root.info('Dataset integrity OK.')
     return None
@@ -0,0 +1,21 @@
+import unittest
+from dataset_service.tracer import alteredSeriesToString
+
+class AlteredSeriesToStringTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(alteredSeriesToString([]), '')
+
+    def test_filesAndUnknown(self):
+        alteredSeries = [dict(studyId="st1", series="se1", files=["a.dcm", "b.dcm"]),
+                         dict(studyId="st2", series="se2", files=None),
+                         dict(studyId="st3", series="se3", files=[])]
+        self.assertEqual(alteredSeriesToString(alteredSeries),
+                         "st1/se1/a.dcm, st1/se1/b.dcm, st2/se2 (unknown files), st3/se3 (unknown files)")
+
+    def test_maxItems(self):
+        alteredSeries = [dict(studyId="st1", series="se1", files=["%d.dcm" % i for i in range(5)])]
+        self.assertEqual(alteredSeriesToString(alteredSeries, 3), "st1/se1/0.dcm, st1/se1/1.dcm, st1/se1/2.dcm and 2 more")
+        self.assertEqual(alteredSeriesToString(alteredSeries, 5).count(','), 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 #! /usr/bin/env python3
 
+import os
 import sys
 import logging
 import signal
@@ -7,27 +8,85 @@ import threading
 import time
 
 import dataset_service.RESTServer as RESTServer
+from dataset_service.storage import closeConnectionPools
 from dataset_service.config import load_config
 from dataset_service.logger import config_logger
 from dataset_service import __version__, __appname__
 
 THREAD = None
+CHILD_PROCESSES = set()   # only in the parent process of pre-fork mode
+IS_CHILD_PROCESS = False
+STOPPING = False
+RESPAWN_DELAY_SECONDS = 1
 
 def start_daemon(CONFIG):
     global THREAD
     logging.root.info( '------------- Starting %s v%s -------------' % (__appname__, __version__))
+    if CONFIG.self.server_processes > 1:
+        start_processes(CONFIG)
+        return
     THREAD = threading.Thread(target=RESTServer.run, args=(CONFIG.self.host, CONFIG.self.port, CONFIG))
     THREAD.daemon = True
     THREAD.start()
     while THREAD.is_alive():
         time.sleep(0.1)
 
+def start_processes(CONFIG):
+    ''' Pre-fork mode: initialization, listening socket creation and then fork of the processes which serve the requests. '''
+    RESTServer.init(CONFIG)
+    # The connections opened by the parent must not be shared with the children.
+    closeConnectionPools()
+    listeningSocket = RESTServer.createListeningSocket(CONFIG.self.host, CONFIG.self.port)
+    for i in range(CONFIG.self.server_processes):
+        start_child_process(CONFIG, listeningSocket)
+    while len(CHILD_PROCESSES) > 0:
+        pid, status = os.wait()
+        CHILD_PROCESSES.discard(pid)
+        if STOPPING: continue
+        logging.root.error("The process %d has finished unexpectedly (status %d), launching another one..." % (pid, status))
+        time.sleep(RESPAWN_DELAY_SECONDS)
+        if not STOPPING: start_child_process(CONFIG, listeningSocket)
+    listeningSocket.close()
+    logging.root.info( '------------- %s stopped -------------' % __appname__ )
+
+def start_child_process(CONFIG, listeningSocket):
+    global THREAD, IS_CHILD_PROCESS
+    pid = os.fork()
+    if pid != 0:   # parent
+        CHILD_PROCESSES.add(pid)
+        return
+    # child
+    exitCode = 0
+    try:
+        CHILD_PROCESSES.clear()
+        IS_CHILD_PROCESS = True
+        logging.root.info("Process %d serving requests..." % os.getpid())
+        THREAD = threading.Thread(target=RESTServer.serve, args=(CONFIG.self.host, CONFIG.self.port, listeningSocket))
+        THREAD.daemon = True
+        THREAD.start()
+        while THREAD.is_alive():
+            time.sleep(0.1)
+    except BaseException as e:
+        logging.root.exception(e)
+        exitCode = 1
+    finally:
+        os._exit(exitCode)
+
 def stop_daemon( ):
-    global THREAD
+    global THREAD, STOPPING
+    if len(CHILD_PROCESSES) > 0:   # parent in pre-fork mode: the children are stopped and the main loop waits for them
+        STOPPING = True
+        for pid in list(CHILD_PROCESSES):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError: pass
+        return
     RESTServer.stop()
     while THREAD != None and THREAD.is_alive():
         time.sleep(0.1)
-    logging.root.info( '------------- %s stopped -------------' % __appname__ )
+    closeConnectionPools()
+    if IS_CHILD_PROCESS: logging.root.info("Process %d stopped." % os.getpid())
+    else: logging.root.info( '------------- %s stopped -------------' % __appname__ )
 
 def signal_int_handler(signal, frame):
     """ Callback function to catch the system signals """